@@ -0,0 +1,85 @@
+from pathlib import Path
+import sys
+import time
+
+import chunk
+import common
+import register
+import unboxed
+import vm
+
+# Compares the stack VM with and without superinstructions, the register VM
+# and the unboxed VM on each script given on the command line: instructions
+# dispatched and wall time. The test/benchmark scripts are sized for clox,
+# so smaller inputs are a better fit here.
+
+executed = 0
+
+class CountingCode(list):
+    """Instruction list that counts every fetch the run loop makes."""
+    def __getitem__(self, index):
+        global executed
+        executed += 1
+        return list.__getitem__(self, index)
+
+def countDecoded(self, fused: bool=False):
+    decoded = decode(self, fused)
+    if not isinstance(decoded.code, CountingCode):
+        decoded.code = CountingCode(decoded.code)
+    return decoded
+
+def countTranslated(function):
+    result = translate(function)
+    result.code = CountingCode(result.code)
+    return result
+
+def countUnboxed(decoded):
+    return CountingCode(unboxCode(decoded))
+
+decode = chunk.Chunk.decode
+translate = register.translate
+unboxCode = unboxed.unboxCode
+
+def run(engine, source: str, counting: bool):
+    global executed
+    executed = 0
+    if counting:
+        chunk.Chunk.decode = countDecoded
+        register.translate = countTranslated
+        unboxed.unboxCode = countUnboxed
+    try:
+        start = time.perf_counter()
+        result = engine().interpret(source)
+        elapsed = time.perf_counter() - start
+    finally:
+        chunk.Chunk.decode = decode
+        register.translate = translate
+        unboxed.unboxCode = unboxCode
+    common.stdout.seek(0)
+    common.stdout.truncate()
+    common.stderr.seek(0)
+    common.stderr.truncate()
+    return result, executed, elapsed
+
+class UnfusedVM(vm.VM):
+    """The stack VM without superinstructions, to show what they save."""
+    superinstructions = False
+
+engines = (("unfused", UnfusedVM), ("stack", vm.VM),
+           ("register", register.RegisterVM),
+           ("unboxed", unboxed.UnboxedVM))
+
+if len(sys.argv) < 2:
+    print("Usage: benchmark.py path...", file=sys.stderr)
+    exit(64)
+
+print("%-24s %-9s %12s %9s" % ("script", "engine", "instructions", "seconds"))
+for path in sys.argv[1:]:
+    source = Path(path).read_text()
+    for name, engine in engines:
+        result, count, _ = run(engine, source, True)
+        if result != vm.INTERPRET.OK:
+            print(f"{path}: {name} engine returned {result.name}", file=sys.stderr)
+            continue
+        _, _, elapsed = run(engine, source, False)
+        print("%-24s %-9s %12d %9.3f" % (Path(path).name, name, count, elapsed))
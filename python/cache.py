@@ -0,0 +1,133 @@
+import hashlib
+import marshal
+import os
+import sys
+
+from chunk import *
+from common import *
+from compiler import *
+from object import *
+from scanner import *
+from value import *
+
+# Bumped whenever the opcodes or the layout below change, so that files
+# written by an older pylox are recompiled instead of misread.
+FORMAT_VERSION = 3
+MAGIC = b"LOXC"
+
+def cachePath(path: str):
+    """Where the compiled form of the script at path is kept: beside it,
+    with a .loxc extension."""
+    root, _ = os.path.splitext(path)
+    return root + ".loxc"
+
+def sourceDigest(source):
+    """SHA-256 of source's text, whether it is a str or a SourceFile."""
+    if isinstance(source, str): return hashlib.sha256(source.encode()).digest()
+    digest = hashlib.sha256()
+    for chunk in source.chunks():
+        digest.update(chunk.encode())
+    return digest.digest()
+
+def dumpFunction(function: ObjFunction):
+    chunk = function.chunk
+    constants = []
+    for constant in chunk.constants:
+        if constant.is_number():
+            constants.append(("n", float(constant)))
+        elif constant.is_string():
+            constants.append(("s", constant.as_str()))
+        elif constant.is_function():
+            constants.append(("f", dumpFunction(constant.as_function())))
+        elif constant.is_bool():
+            constants.append(("b", bool(constant)))
+        else:
+            constants.append(("nil",))
+    name = None if function.name is None else function.name.as_
+    return (name, function.arity, function.upvalueCount, function.maxStack,
+            bytes(chunk.code), tuple(chunk.lines), tuple(constants))
+
+def loadFunction(data: tuple, strings: dict):
+    name, arity, upvalueCount, maxStack, code, lines, constants = data
+    function = ObjFunction()
+    if name is not None: function.name = copyString(strings, name)
+    function.arity = arity
+    function.upvalueCount = upvalueCount
+    function.maxStack = maxStack
+    function.chunk.code = bytearray(code)
+    function.chunk.lines = list(lines)
+    for constant in constants:
+        match constant[0]:
+            case "n": value = Value.from_float(constant[1])
+            case "s": value = Value.from_obj(copyString(strings, constant[1]))
+            case "f": value = Value.from_obj(loadFunction(constant[1], strings))
+            case "b": value = Value.from_bool(constant[1])
+            case "nil": value = Value.nil()
+        function.chunk.constants.append(value)
+    return function
+
+class BytecodeCache:
+    """Compiled scripts kept on disk between runs.
+
+    A file holds the script function and its nested functions, with their
+    code, lines and constants, and the global variable slots the code was
+    compiled against. It is only used for the same source text, compiled
+    by the same kind of compiler, with the same format version and Python
+    (whose marshal format it is written in); anything else, and any file
+    that can't be read, means a normal compile that writes a fresh one.
+    main.py only keeps them when run with --cache.
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def key(self, compiler: Compiler, source: str):
+        return (MAGIC, FORMAT_VERSION, sys.version_info[:2], type(compiler).__name__,
+                sourceDigest(source))
+
+    def compile(self, compiler: Compiler, source: str):
+        function = self.load(compiler, source)
+        if function is not None: return function
+
+        function = compiler.compile(source)
+        if function is not None: self.store(compiler, source, function)
+        return function
+
+    def load(self, compiler: Compiler, source: str):
+        try:
+            with open(self.path, "rb") as file:
+                key, globalNames, data = marshal.load(file)
+            if key != self.key(compiler, source): return None
+            # Global instructions carry their slot, so the names have to
+            # land in the same slots they were compiled to. That is worked
+            # out on a copy, and the compiler only hands the slots out, and
+            # takes in the strings, once the whole file has been read.
+            slots = dict(compiler.globalSlots)
+            free = len(compiler.globalValues)
+            for slot, name in enumerate(globalNames):
+                if name not in slots:
+                    slots[name] = free
+                    free += 1
+                if slots[name] != slot: return None
+            strings = dict(compiler.strings)
+            function = loadFunction(data, strings)
+        except Exception:
+            return None
+
+        for name in globalNames:
+            compiler.globalSlot(name)
+        compiler.strings.update(strings)
+        return function
+
+    def store(self, compiler: Compiler, source: str, function: ObjFunction):
+        globalNames = sorted(compiler.globalSlots, key=compiler.globalSlots.get)
+        data = (self.key(compiler, source), tuple(globalNames), dumpFunction(function))
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(temporary, "wb") as file:
+                marshal.dump(data, file)
+            os.replace(temporary, self.path)
+        except OSError:
+            try:
+                os.remove(temporary)
+            except OSError:
+                pass
@@ -13,13 +13,19 @@ class OP(enum):
     DEFINE_GLOBAL = enum_auto()
     SET_GLOBAL = enum_auto()
     GET_UPVALUE = enum_auto()
-    SET_UPVALUE = enum_auto()
+    GET_CELL = enum_auto()
+    SET_CELL = enum_auto()
+    GET_LOCAL_CELL = enum_auto()
+    SET_LOCAL_CELL = enum_auto()
     GET_PROPERTY = enum_auto()
     SET_PROPERTY = enum_auto()
     GET_SUPER = enum_auto()
     EQUAL = enum_auto()
+    NOT_EQUAL = enum_auto()
     GREATER = enum_auto()
+    GREATER_EQUAL = enum_auto()
     LESS = enum_auto()
+    LESS_EQUAL = enum_auto()
     ADD = enum_auto()
     SUBTRACT = enum_auto()
     MULTIPLY = enum_auto()
@@ -29,16 +35,348 @@ class OP(enum):
     PRINT = enum_auto()
     JUMP = enum_auto()
     JUMP_IF_FALSE = enum_auto()
+    JUMP_IF_TRUE = enum_auto()
+    POP_JUMP_IF_FALSE = enum_auto()
     LOOP = enum_auto()
     CALL = enum_auto()
     INVOKE = enum_auto()
     SUPER_INVOKE = enum_auto()
+    TAIL_CALL = enum_auto()
+    TAIL_INVOKE = enum_auto()
     CLOSURE = enum_auto()
-    CLOSE_UPVALUE = enum_auto()
+    BOX = enum_auto()
     RETURN = enum_auto()
     CLASS = enum_auto()
     INHERIT = enum_auto()
     METHOD = enum_auto()
+    # Superinstructions, written by Chunk.fuse().
+    GET_LOCAL_GET_LOCAL_ADD = enum_auto()
+    GET_LOCAL_CONSTANT_LESS_POP_JUMP_IF_FALSE = enum_auto()
+    GET_LOCAL_GET_PROPERTY = enum_auto()
+    CONSTANT_ADD = enum_auto()
+
+# The instruction sequence each superinstruction stands for. Chunk.fuse()
+# only overwrites the opcode of the first instruction, so the others stay
+# in the bytecode behind it as the superinstruction's operands.
+FUSED = {
+    OP.GET_LOCAL_CONSTANT_LESS_POP_JUMP_IF_FALSE:
+        (OP.GET_LOCAL, OP.CONSTANT, OP.LESS, OP.POP_JUMP_IF_FALSE),
+    OP.GET_LOCAL_GET_LOCAL_ADD: (OP.GET_LOCAL, OP.GET_LOCAL, OP.ADD),
+    OP.GET_LOCAL_GET_PROPERTY: (OP.GET_LOCAL, OP.GET_PROPERTY),
+    OP.CONSTANT_ADD: (OP.CONSTANT, OP.ADD),
+}
+
+# Operand bytes following each opcode. The global variable instructions
+# take their name's constant index and then a 16-bit slot. OP.CLOSURE is
+# followed by two more bytes per upvalue of the function it wraps, on top
+# of the constant index.
+OPERAND_BYTES = {op: 0 for op in OP}
+OPERAND_BYTES.update({
+    OP.CONSTANT: 1, OP.GET_LOCAL: 1, OP.SET_LOCAL: 1,
+    OP.GET_GLOBAL: 3, OP.DEFINE_GLOBAL: 3, OP.SET_GLOBAL: 3,
+    OP.GET_UPVALUE: 1, OP.GET_CELL: 1, OP.SET_CELL: 1,
+    OP.GET_LOCAL_CELL: 1, OP.SET_LOCAL_CELL: 1, OP.BOX: 1,
+    OP.GET_PROPERTY: 1, OP.SET_PROPERTY: 1, OP.GET_SUPER: 1,
+    OP.JUMP: 2, OP.JUMP_IF_FALSE: 2, OP.JUMP_IF_TRUE: 2,
+    OP.POP_JUMP_IF_FALSE: 2, OP.LOOP: 2,
+    OP.CALL: 1, OP.INVOKE: 2, OP.SUPER_INVOKE: 2,
+    OP.TAIL_CALL: 1, OP.TAIL_INVOKE: 2, OP.CLOSURE: 1,
+    OP.CLASS: 1, OP.METHOD: 1,
+})
+for fused, ops in FUSED.items():
+    OPERAND_BYTES[fused] = sum(1 + OPERAND_BYTES[op] for op in ops) - 1
+
+# Net change in stack height for instructions with a fixed effect.
+# The calls depend on their argument count and OP.RETURN leaves the frame,
+# so stackEffect() handles those.
+STACK_EFFECT = {op: 0 for op in OP}
+STACK_EFFECT.update({
+    OP.CONSTANT: 1, OP.NIL: 1, OP.TRUE: 1, OP.FALSE: 1, OP.POP: -1,
+    OP.GET_LOCAL: 1, OP.GET_GLOBAL: 1, OP.DEFINE_GLOBAL: -1,
+    OP.GET_UPVALUE: 1, OP.GET_CELL: 1, OP.GET_LOCAL_CELL: 1,
+    OP.SET_PROPERTY: -1, OP.GET_SUPER: -1,
+    OP.EQUAL: -1, OP.NOT_EQUAL: -1, OP.GREATER: -1, OP.GREATER_EQUAL: -1,
+    OP.LESS: -1, OP.LESS_EQUAL: -1, OP.ADD: -1, OP.SUBTRACT: -1,
+    OP.MULTIPLY: -1, OP.DIVIDE: -1, OP.PRINT: -1, OP.POP_JUMP_IF_FALSE: -1,
+    OP.CLOSURE: 1, OP.CLASS: 1, OP.INHERIT: -1,
+    OP.METHOD: -1,
+})
+for fused, ops in FUSED.items():
+    STACK_EFFECT[fused] = sum(STACK_EFFECT[op] for op in ops)
+
+# Instructions whose operand is a jump target, and the instructions that
+# never go on to the next one.
+JUMPS = {
+    OP.JUMP, OP.JUMP_IF_FALSE, OP.JUMP_IF_TRUE, OP.POP_JUMP_IF_FALSE, OP.LOOP,
+}
+UNCONDITIONAL = {OP.JUMP, OP.LOOP, OP.RETURN}
+
+# Instructions Chunk.optimize() merges with an OP.NOT after them.
+NEGATED = {
+    OP.EQUAL: OP.NOT_EQUAL, OP.NOT_EQUAL: OP.EQUAL,
+    OP.GREATER: OP.LESS_EQUAL, OP.LESS_EQUAL: OP.GREATER,
+    OP.LESS: OP.GREATER_EQUAL, OP.GREATER_EQUAL: OP.LESS,
+}
+
+def stackEffect(instruction: tuple):
+    """Net stack change of a decoded instruction."""
+    match instruction[0]:
+        case OP.CALL | OP.TAIL_CALL: return -instruction[1]
+        case OP.INVOKE | OP.TAIL_INVOKE: return -instruction[2]
+        case OP.SUPER_INVOKE: return -instruction[2] - 1
+        case OP.RETURN: return -1
+        case op: return STACK_EFFECT[op]
+
+def stackHeights(code: list[tuple], height: int):
+    """Stack height on entry to each reachable instruction of decoded
+    code, given the height the frame starts at."""
+    heights = {0: height}
+    work = [0]
+    while len(work) > 0:
+        ip = work.pop()
+        instruction = code[ip]
+        height = heights[ip] + stackEffect(instruction)
+        successors = []
+        if instruction[0] in JUMPS:
+            successors.append(instruction[1])
+        if instruction[0] not in UNCONDITIONAL:
+            successors.append(ip + 1)
+        for successor in successors:
+            if successor not in heights and successor < len(code):
+                heights[successor] = height
+                work.append(successor)
+    return heights
+
+def maxStack(chunk, height: int):
+    """The most stack slots a frame running an unfused chunk ever uses,
+    given the height it starts at. The compiler leaves the stack at the
+    same height on every path into an instruction, so one pass over the
+    bytes in order will do: an instruction right after one that doesn't
+    go on to it starts at the height a forward jump to it left."""
+    code = chunk.code
+    arrivals = {}
+    highest = height
+    offset = 0
+    goesOn = True
+    while offset < len(code):
+        if not goesOn: height = arrivals.get(offset, height)
+        instruction = code[offset]
+        match instruction:
+            case OP.CALL | OP.TAIL_CALL: height -= code[offset + 1]
+            case OP.INVOKE | OP.TAIL_INVOKE: height -= code[offset + 2]
+            case OP.SUPER_INVOKE: height -= code[offset + 2] + 1
+            case OP.RETURN: height -= 1
+            case _: height += STACK_EFFECT[instruction]
+        if height > highest: highest = height
+        length = instructionLength(chunk, offset)
+        if instruction in JUMPS and instruction != OP.LOOP:
+            arrivals[offset + 3 + ((code[offset + 1] << 8) | code[offset + 2])] = height
+        goesOn = instruction not in UNCONDITIONAL
+        offset += length
+    return highest
+
+class DecodedChunk:
+    """A chunk's code with every operand read out ahead of time.
+
+    `code` has one tuple per instruction, starting with the opcode:
+    constants are resolved to their Value (or to the name str for
+    instructions that take an identifier), global variable instructions
+    carry their slot followed by the name, jump targets are absolute
+    indexes into `code`, and OP.CLOSURE carries its upvalues as a tuple
+    of (isLocal, index) pairs. `lines` and `offsets` give each
+    instruction's source line and offset in the original bytecode.
+
+    With `fused`, superinstructions are one instruction carrying the
+    operands of the sequence they stand for, in order. Otherwise they are
+    decoded as that sequence, as though Chunk.fuse() had never run.
+    """
+    def __init__(self, chunk, fused: bool=False):
+        self.code = []
+        self.lines = []
+        self.offsets = []
+
+        indexes = {}
+        offset = 0
+        while offset < len(chunk.code):
+            indexes[offset] = len(self.offsets)
+            self.offsets.append(offset)
+            self.lines.append(chunk.lines[offset])
+            offset += instructionLength(chunk, offset, fused)
+        indexes[offset] = len(self.offsets)
+
+        for offset in self.offsets:
+            self.code.append(decodeInstruction(chunk, offset, indexes, fused))
+
+def instructionLength(chunk, offset: int, fused: bool=False):
+    instruction = chunk.code[offset]
+    if instruction in FUSED and not fused:
+        instruction = FUSED[instruction][0]
+    length = 1 + OPERAND_BYTES[instruction]
+    if instruction == OP.CLOSURE:
+        function = chunk.constants[chunk.code[offset + 1]].as_function()
+        length += 2 * function.upvalueCount
+    return length
+
+def decodeInstruction(chunk, offset: int, indexes: dict[int, int], fused: bool=False):
+    instruction = OP(chunk.code[offset])
+    if instruction in FUSED:
+        ops = FUSED[instruction]
+        if not fused:
+            return decodeOperands(chunk, ops[0], offset, indexes)
+        operands = []
+        for op in ops:
+            operands.extend(decodeOperands(chunk, op, offset, indexes)[1:])
+            offset += 1 + OPERAND_BYTES[op]
+        return (instruction, *operands)
+    return decodeOperands(chunk, instruction, offset, indexes)
+
+def decodeOperands(chunk, instruction: OP, offset: int, indexes: dict[int, int]):
+    code = chunk.code
+    match instruction:
+        case OP.CONSTANT:
+            return (instruction, chunk.constants[code[offset + 1]])
+        case OP.GET_GLOBAL | OP.DEFINE_GLOBAL | OP.SET_GLOBAL:
+            slot = (code[offset + 2] << 8) | code[offset + 3]
+            return (instruction, slot, chunk.constants[code[offset + 1]].as_str())
+        case (OP.GET_PROPERTY | OP.SET_PROPERTY | OP.GET_SUPER |
+              OP.CLASS | OP.METHOD):
+            return (instruction, chunk.constants[code[offset + 1]].as_str())
+        case (OP.GET_LOCAL | OP.SET_LOCAL | OP.GET_UPVALUE |
+              OP.GET_CELL | OP.SET_CELL | OP.GET_LOCAL_CELL |
+              OP.SET_LOCAL_CELL | OP.BOX | OP.CALL | OP.TAIL_CALL):
+            return (instruction, code[offset + 1])
+        case OP.JUMP | OP.JUMP_IF_FALSE | OP.JUMP_IF_TRUE | OP.POP_JUMP_IF_FALSE:
+            jump = (code[offset + 1] << 8) | code[offset + 2]
+            return (instruction, indexes[offset + 3 + jump])
+        case OP.LOOP:
+            jump = (code[offset + 1] << 8) | code[offset + 2]
+            return (instruction, indexes[offset + 3 - jump])
+        case OP.INVOKE | OP.SUPER_INVOKE | OP.TAIL_INVOKE:
+            name = chunk.constants[code[offset + 1]].as_str()
+            return (instruction, name, code[offset + 2])
+        case OP.CLOSURE:
+            function = chunk.constants[code[offset + 1]].as_function()
+            upvalues = tuple((bool(code[offset + 2 + 2*i]), code[offset + 3 + 2*i])
+                             for i in range(function.upvalueCount))
+            return (instruction, function, upvalues)
+        case _:
+            return (instruction,)
+
+class Instruction:
+    """One instruction of a chunk being rewritten by Chunk.optimize().
+    `target` is the index of the instruction a jump lands on, else None;
+    a jump's own operand bytes are only written back at the end."""
+    __slots__ = ("op", "operands", "line", "target")
+
+    def __init__(self, op: OP, operands: bytes, line: int, target: int=None):
+        self.op = op
+        self.operands = operands
+        self.line = line
+        self.target = target
+
+def peephole(instructions: list[Instruction]):
+    """Run one round of rewrites over the instructions, marking the ones it
+    removes with an op of None. Returns whether anything changed.
+
+    A rewrite only removes an instruction no jump lands on, unless it is
+    a jump to the next instruction, whose arrivals carry on there anyway.
+    Merged instructions take the line of the first, the one that can fail.
+    """
+    incoming = [0] * (len(instructions) + 1)
+    for instruction in instructions:
+        if instruction.target is not None: incoming[instruction.target] += 1
+
+    def retarget(instruction: Instruction, target: int):
+        incoming[instruction.target] -= 1
+        incoming[target] += 1
+        instruction.target = target
+
+    def remove(instruction: Instruction):
+        if instruction.target is not None: incoming[instruction.target] -= 1
+        instruction.op = None
+        instruction.target = None
+
+    def thread(i: int, instruction: Instruction):
+        # Follow the jumps this one lands on while the value it tested
+        # decides them the same way. Only OP.JUMP and OP.LOOP can go both
+        # ways, so the conditional jumps stop at a backward one.
+        target = instruction.target
+        seen = {i}
+        while target not in seen:
+            seen.add(target)
+            landing = instructions[target]
+            match instruction.op, landing.op:
+                case ((OP.JUMP | OP.LOOP, OP.JUMP | OP.LOOP) |
+                      (OP.JUMP_IF_FALSE, OP.JUMP | OP.JUMP_IF_FALSE) |
+                      (OP.JUMP_IF_TRUE, OP.JUMP | OP.JUMP_IF_TRUE) |
+                      (OP.POP_JUMP_IF_FALSE, OP.JUMP)):
+                    next_ = landing.target
+                case ((OP.JUMP_IF_FALSE, OP.JUMP_IF_TRUE) |
+                      (OP.JUMP_IF_TRUE, OP.JUMP_IF_FALSE)):
+                    next_ = target + 1
+                case _:
+                    break
+            if next_ <= i and instruction.op not in (OP.JUMP, OP.LOOP): break
+            target = next_
+        return target
+
+    def rewrite(i: int, instruction: Instruction):
+        following = instructions[i + 1] if i + 1 < len(instructions) else None
+
+        if (instruction.op in NEGATED and following is not None and
+                following.op == OP.NOT and incoming[i + 1] == 0):
+            instruction.op = NEGATED[instruction.op]
+            remove(following)
+            return True
+
+        if instruction.target is None: return False
+
+        target = thread(i, instruction)
+        if target != instruction.target:
+            retarget(instruction, target)
+            return True
+
+        if target == i + 1:
+            # Whichever way it goes, it goes on to the next instruction.
+            if instruction.op == OP.POP_JUMP_IF_FALSE:
+                remove(instruction)
+                instruction.op = OP.POP
+                instruction.operands = b""
+            else:
+                remove(instruction)
+            return True
+
+        if instruction.op != OP.JUMP_IF_FALSE or incoming[i + 1] != 0:
+            return False
+
+        if following.op == OP.POP and instructions[target].op == OP.POP:
+            # Both ways start by popping the condition.
+            instruction.op = OP.POP_JUMP_IF_FALSE
+            retarget(instruction, target + 1)
+            remove(following)
+            return True
+
+        if following.op == OP.JUMP and target == i + 2 and following.target > i + 1:
+            # Jumping over a jump, as `or` does.
+            instruction.op = OP.JUMP_IF_TRUE
+            retarget(instruction, following.target)
+            remove(following)
+            return True
+
+        return False
+
+    changed = False
+    previous = None
+    for i, instruction in enumerate(instructions):
+        if instruction.op is None: continue
+        if previous is not None and previous.op in UNCONDITIONAL and incoming[i] == 0:
+            # Unreachable.
+            remove(instruction)
+            changed = True
+            continue
+        if rewrite(i, instruction): changed = True
+        if instruction.op is not None: previous = instruction
+    return changed
 
 #class Chunk(bytearray):pass
 
@@ -47,11 +385,140 @@ class Chunk:
         self.code: list[uint8_t] = bytearray() # yes bytearray isn't a list of our uint8_t,
         self.constants: list[Value] = []       # it's just an optimization (is it?)
         self.lines: list[int] = []
+        self.decoded = None
+        self.fusedDecoded = None
 
     def write(self, byte: uint8_t, line: int):
         #if byte > UINT8_MAX:
         self.code.append(byte)
         self.lines.append(line)
+        self.decoded = None
+        self.fusedDecoded = None
+
+    def truncate(self, count: int, constantCount: int):
+        """Drop everything written after the first count bytes and the
+        first constantCount constants."""
+        del self.code[count:]
+        del self.lines[count:]
+        del self.constants[constantCount:]
+        self.decoded = None
+        self.fusedDecoded = None
+
+    def remove(self, start: int, end: int):
+        """Cut out the bytes from start up to end. Jumps are relative, so
+        this is only safe when none of them crosses the cut."""
+        del self.code[start:end]
+        del self.lines[start:end]
+        self.decoded = None
+        self.fusedDecoded = None
+
+    def decode(self, fused: bool=False):
+        """Return the DecodedChunk for this chunk, building it on first use."""
+        if fused:
+            if self.fusedDecoded is None:
+                self.fusedDecoded = DecodedChunk(self, True)
+            return self.fusedDecoded
+        if self.decoded is None:
+            self.decoded = DecodedChunk(self)
+        return self.decoded
+
+    def optimize(self):
+        """Peephole pass over the finished chunk: merges comparisons with
+        the OP.NOT after them, threads jumps through the jumps they land
+        on, pops conditions in the jump that tests them, and drops jumps
+        to the next instruction and code nothing reaches. The chunk is
+        left as it was if a jump would come out longer than 16 bits."""
+        code = self.code
+        instructions = []
+        indexes = {}
+        offset = 0
+        while offset < len(code):
+            indexes[offset] = len(instructions)
+            length = instructionLength(self, offset)
+            instruction = Instruction(code[offset], bytes(code[offset + 1:offset + length]),
+                                      self.lines[offset])
+            if instruction.op in JUMPS:
+                jump = (code[offset + 1] << 8) | code[offset + 2]
+                sign = -1 if instruction.op == OP.LOOP else 1
+                instruction.target = offset + 3 + sign * jump
+            instructions.append(instruction)
+            offset += length
+        indexes[offset] = len(instructions)
+        for instruction in instructions:
+            if instruction.target is not None:
+                instruction.target = indexes[instruction.target]
+
+        while peephole(instructions):
+            kept = []
+            indexes = []
+            for instruction in instructions:
+                # A removed instruction's arrivals go on to the next one kept.
+                indexes.append(len(kept))
+                if instruction.op is not None: kept.append(instruction)
+            indexes.append(len(kept))
+            for instruction in kept:
+                if instruction.target is not None:
+                    instruction.target = indexes[instruction.target]
+            instructions = kept
+
+        offsets = [0]
+        for instruction in instructions:
+            length = 3 if instruction.target is not None else 1 + len(instruction.operands)
+            offsets.append(offsets[-1] + length)
+
+        code = bytearray()
+        lines = []
+        for i, instruction in enumerate(instructions):
+            op, operands = instruction.op, instruction.operands
+            if instruction.target is not None:
+                jump = offsets[instruction.target] - offsets[i + 1]
+                if op in (OP.JUMP, OP.LOOP):
+                    op = OP.JUMP if jump >= 0 else OP.LOOP
+                jump = abs(jump)
+                if jump > UINT16_MAX: return
+                operands = bytes(((jump >> 8) & 0xff, jump & 0xff))
+            code.append(op)
+            code.extend(operands)
+            lines.extend([instruction.line] * (1 + len(operands)))
+
+        self.code[:] = code
+        self.lines[:] = lines
+        self.decoded = None
+        self.fusedDecoded = None
+
+    def fuse(self):
+        """Turn each run of instructions matching a FUSED sequence into its
+        superinstruction. A run is left alone if a jump lands inside it or
+        it spans source lines, so jumps and runtime error lines come out
+        the same either way."""
+        code = self.code
+        offsets = []
+        targets = set()
+        offset = 0
+        while offset < len(code):
+            offsets.append(offset)
+            if code[offset] in JUMPS:
+                jump = (code[offset + 1] << 8) | code[offset + 2]
+                sign = -1 if code[offset] == OP.LOOP else 1
+                targets.add(offset + 3 + sign * jump)
+            offset += instructionLength(self, offset)
+        offsets.append(offset)
+
+        i = 0
+        while i < len(offsets) - 1:
+            for fused, ops in FUSED.items():
+                run = offsets[i:i + len(ops) + 1]
+                if (len(run) == len(ops) + 1 and
+                        all(code[at] == op for at, op in zip(run, ops)) and
+                        not targets.intersection(run[1:-1]) and
+                        len(set(self.lines[run[0]:run[-1]])) == 1):
+                    code[run[0]] = fused
+                    i += len(ops)
+                    break
+            else:
+                i += 1
+        self.decoded = None
+        self.fusedDecoded = None
 
     def addConstant(self, value: Value):
         self.constants.append(value)
@@ -1,7 +1,9 @@
 from chunk import *
 from common import *
+from debug import *
 from scanner import *
 from object import *
+from resolver import *
 from value import *
 
 if DEBUG_PRINT_CODE:
@@ -30,15 +32,25 @@ class ClassCompiler:
         self.hasSuperclass = None
 
 class Local:
-    def __init__(self, name: Token, depth: int, isCaptured: bool):
+    """A local variable. One that is assigned after a closure captures it
+    lives in a cell (isCell), shared by its frame and the closures; every
+    other captured local is copied into the closures that capture it. The
+    Resolver decides which is which before compiling."""
+    __slots__ = ("name", "depth", "isCell")
+
+    def __init__(self, name: Token, depth: int, isCell: bool=False):
         self.name = name
         self.depth = depth
-        self.isCaptured = isCaptured
+        self.isCell = isCell
 
 class Upvalue:
-    def __init__(self, index: uint8_t, isLocal: bool):
+    __slots__ = ("index", "isLocal", "local")
+
+    def __init__(self, index: uint8_t, isLocal: bool, local: Local):
         self.index = index
         self.isLocal = isLocal
+        # The Local it captures, however many functions out it was declared.
+        self.local = local
 
 class TYPE(enum):
     FUNCTION = enum_auto()
@@ -52,6 +64,8 @@ class Parser:
         self.previous = None
         self.hadError = None
         self.panicMode = None
+        # The messages of the errors found so far.
+        self.errors = []
 
         self.scanner = scanner
         if scanner is None:
@@ -90,16 +104,16 @@ class Parser:
     def errorAt(self, token: Token, message: str):
         if self.panicMode: return
         self.panicMode = True
-        print(f"[line {token.line}] Error", end="", file=stderr)
+        error = f"[line {token.line}] Error"
 
         if token.type == TOKEN.EOF:
-            print(" at end", end="", file=stderr)
+            error += " at end"
         elif token.type == TOKEN.ERROR:
             pass # Nothing.
         else:
-            print(f" at '{token.source}'", end="", file=stderr)
+            error += f" at '{token.source}'"
 
-        print(f": {message}", file=stderr)
+        self.errors.append(f"{error}: {message}")
         self.hadError = True
 
     def synchronize(self):
@@ -123,15 +137,38 @@ class Parser:
 
 class Compiler:
     def __init__(self, type: TYPE, enclosing=None, parser: Parser=None, scanner: Scanner=None):
-        self.locals = [Local(Token.synthetic(""), 0, False)]
+        self.locals = [Local(Token.synthetic(""), 0)]
         self.upvalues = []
         self.scopeDepth = 0
         self.enclosing = enclosing
         self.currentClass = None
+        self.strings = {}
+        self.globalSlots = {}
+        self.globalValues = []
+        # Every local declared so far, in order, and the positions in that
+        # order of the ones that need cells; see compile().
+        self.declared = []
+        self.cells = set()
+        # The local a function declaration is being stored in, when the
+        # function's own slot 0 stands in for it; see function_().
+        self.selfLocal = None
         if enclosing is not None:
             self.currentClass = enclosing.currentClass
+            self.strings = enclosing.strings
+            self.globalSlots = enclosing.globalSlots
+            self.globalValues = enclosing.globalValues
+            self.declared = enclosing.declared
+            self.cells = enclosing.cells
         self.function = ObjFunction()
         self.type = type
+        # (start, end, constant count before it, value) of the last constant
+        # pushed, and the offset the last forward jump landed on, so that
+        # operators can tell when their operands are constants to fold.
+        self.lastConstant = None
+        self.lastJumpTarget = None
+        # Offset of the last OP.CALL or OP.INVOKE, for returnStatement() to
+        # tell a call in tail position.
+        self.lastCall = None
         if type != TYPE.FUNCTION:
             self.locals[0].name.source = "this"
 
@@ -143,7 +180,7 @@ class Compiler:
             self.parser = Parser(self.scanner)
 
         if type != TYPE.SCRIPT:
-            self.function.name = ObjString(self.parser.previous.source)
+            self.function.name = copyString(self.strings, self.parser.previous.source)
 
         self.rules = {
             TOKEN.LEFT_PAREN    : ParseRule(self.grouping, self.call,   PREC.CALL),
@@ -229,6 +266,7 @@ class Compiler:
 
         self.currentChunk().code[offset] = (jump >> 8) & 0xff
         self.currentChunk().code[offset + 1] = jump & 0xff
+        self.lastJumpTarget = len(self.currentChunk().code)
 
     def makeConstant(self, value: Value):
         constant = self.currentChunk().addConstant(value)
@@ -239,10 +277,80 @@ class Compiler:
         return constant
 
     def emitConstant(self, value: Value):
+        chunk = self.currentChunk()
+        start, constantCount = len(chunk.code), len(chunk.constants)
         self.emitBytes(OP.CONSTANT, self.makeConstant(value))
+        self.lastConstant = (start, len(chunk.code), constantCount, value)
+
+    def emitLiteral(self, value: Value):
+        """Push a compile-time value, using the dedicated instruction for
+        nil, true and false."""
+        if value.is_nil():
+            op = OP.NIL
+        elif value.is_bool():
+            op = OP.TRUE if bool(value) else OP.FALSE
+        else:
+            self.emitConstant(value)
+            return
+
+        chunk = self.currentChunk()
+        start = len(chunk.code)
+        self.emitByte(op)
+        self.lastConstant = (start, len(chunk.code), len(chunk.constants), value)
+
+    def constantOperand(self, start: int=None):
+        """The lastConstant entry if the operand just compiled is nothing but
+        that constant, else None. Without a start, the operand only has to
+        end with it: every expression ending in a constant push either is
+        that constant or has a jump landing after it."""
+        end = len(self.currentChunk().code)
+        constant = self.lastConstant
+        if constant is None or constant[1] != end or self.lastJumpTarget == end:
+            return None
+        if start is not None and constant[0] != start:
+            return None
+        return constant
+
+    def foldConstant(self, start: int, constantCount: int, value: Value):
+        """Replace the code from start on by a push of value."""
+        self.currentChunk().truncate(start, constantCount)
+        self.emitLiteral(value)
+
+    def skipOperand(self, precedence: PREC):
+        """Compile an operand the constant on its left short-circuits past,
+        reporting its errors, then throw its code away."""
+        chunk = self.currentChunk()
+        count, constantCount = len(chunk.code), len(chunk.constants)
+        last = self.lastConstant, self.lastJumpTarget, self.lastCall
+        self.parsePrecedence(precedence)
+        chunk.truncate(count, constantCount)
+        self.lastConstant, self.lastJumpTarget, self.lastCall = last
 
     def identifierConstant(self, name: Token):
-        return self.makeConstant(Value.from_obj(ObjString(name.source)))
+        return self.makeConstant(Value.from_obj(copyString(self.strings, name.source)))
+
+    def globalSlot(self, name: str):
+        """Index of a global variable's value in globalValues, giving it a
+        new slot holding UNDEFINED the first time the name is seen."""
+        slot = self.globalSlots.get(name)
+        if slot is None:
+            if len(self.globalValues) > UINT16_MAX:
+                self.parser.error("Too many global variables.")
+                return 0
+            slot = len(self.globalValues)
+            self.globalSlots[name] = slot
+            self.globalValues.append(UNDEFINED)
+        return slot
+
+    def emitGlobal(self, op: OP, constant: uint8_t):
+        # Code with errors never runs. After "Too many constants" the
+        # constant may be the placeholder 0 rather than the name, so no
+        # slot is looked up then.
+        slot = 0
+        if not self.parser.hadError:
+            slot = self.globalSlot(self.currentChunk().constants[constant].as_str())
+        self.emitBytes(op, constant)
+        self.emitBytes((slot >> 8) & 0xff, slot & 0xff)
 
     def parseVariable(self, errorMessage: str):
         self.parser.consume(TOKEN.IDENTIFIER, errorMessage)
@@ -270,7 +378,8 @@ class Compiler:
             self.parser.error("Too many local variables in function.")
             return
 
-        local = Local(name, -1, False)
+        local = Local(name, -1, len(self.declared) in self.cells)
+        self.declared.append(local)
         self.locals.append(local)
 
     def markInitialized(self):
@@ -280,9 +389,11 @@ class Compiler:
     def defineVariable(self, global_: uint8_t):
         if self.scopeDepth > 0:
             self.markInitialized()
+            if self.locals[-1].isCell:
+                self.emitBytes(OP.BOX, len(self.locals) - 1)
             return
 
-        self.emitBytes(OP.DEFINE_GLOBAL, global_)
+        self.emitGlobal(OP.DEFINE_GLOBAL, global_)
 
     def resolveLocal(self, name: Token):
         for i,local in reversed(tuple(enumerate(self.locals))):
@@ -293,7 +404,14 @@ class Compiler:
 
         return -1
 
-    def addUpvalue(self, index: uint8_t, isLocal: bool):
+    def localAt(self, slot: int):
+        """The variable a local slot holds. Slot 0 of a function standing
+        in for the local it is stored in is that local."""
+        if slot == 0 and self.selfLocal is not None:
+            return self.selfLocal
+        return self.locals[slot]
+
+    def addUpvalue(self, index: uint8_t, isLocal: bool, local: Local):
         for i,upvalue in enumerate(self.upvalues):
             if upvalue.index == index and upvalue.isLocal == isLocal:
                 return i
@@ -302,7 +420,7 @@ class Compiler:
             self.parser.error("Too many closure variables in function.")
             return 0
 
-        self.upvalues.append(Upvalue(index, isLocal))
+        self.upvalues.append(Upvalue(index, isLocal, local))
         self.function.upvalueCount += 1
         return self.function.upvalueCount - 1
 
@@ -311,33 +429,37 @@ class Compiler:
 
         local = self.enclosing.resolveLocal(name)
         if local != -1:
-            self.enclosing.locals[local].isCaptured = True
-            return self.addUpvalue(local, True)
+            return self.addUpvalue(local, True, self.enclosing.localAt(local))
 
         upvalue = self.enclosing.resolveUpvalue(name)
         if upvalue != -1:
-            return self.addUpvalue(upvalue, False)
+            return self.addUpvalue(upvalue, False, self.enclosing.upvalues[upvalue].local)
 
         return -1
 
     def namedVariable(self, name: Token, canAssign: bool):
         arg = self.resolveLocal(name)
         if arg != -1:
-            getOp = OP.GET_LOCAL
-            setOp = OP.SET_LOCAL
+            local = self.localAt(arg)
+            getOp = OP.GET_LOCAL_CELL if local.isCell else OP.GET_LOCAL
+            setOp = OP.SET_LOCAL_CELL if local.isCell else OP.SET_LOCAL
         elif (arg := self.resolveUpvalue(name)) != -1:
-            getOp = OP.GET_UPVALUE
-            setOp = OP.SET_UPVALUE
+            local = self.upvalues[arg].local
+            getOp = OP.GET_CELL if local.isCell else OP.GET_UPVALUE
+            # Only a cell can be assigned through a closure; the Resolver
+            # sees to it that anything assigned here is one.
+            setOp = OP.SET_CELL
         else:
             arg = self.identifierConstant(name)
             getOp = OP.GET_GLOBAL
             setOp = OP.SET_GLOBAL
 
+        emit = self.emitGlobal if getOp == OP.GET_GLOBAL else self.emitBytes
         if canAssign and self.parser.match(TOKEN.EQUAL):
             self.expression()
-            self.emitBytes(setOp, arg)
+            emit(setOp, arg)
         else:
-            self.emitBytes(getOp, arg)
+            emit(getOp, arg)
 
     def variable(self, canAssign: bool):
         self.namedVariable(self.parser.previous, canAssign)
@@ -371,6 +493,12 @@ class Compiler:
 
     def end(self):
         self.emitReturn()
+        # Code with errors never runs, and may point at constants that
+        # aren't what its instructions expect.
+        if not self.parser.hadError:
+            self.currentChunk().optimize()
+            self.function.maxStack = maxStack(self.currentChunk(), self.function.arity + 1)
+            self.currentChunk().fuse()
 
         if DEBUG_PRINT_CODE:
             if not self.parser.hadError:
@@ -387,10 +515,7 @@ class Compiler:
         for i in range(len(self.locals),0,-1):
             if self.locals[i - 1].depth <= self.scopeDepth:
                 break
-            if self.locals[-1].isCaptured:
-                self.emitByte(OP.CLOSE_UPVALUE)
-            else:
-                self.emitByte(OP.POP)
+            self.emitByte(OP.POP)
             self.locals.pop()
 
     def getRule(self, type: TOKEN):
@@ -415,6 +540,7 @@ class Compiler:
 
     def call(self, canAssign: bool):
         argCount = self.argumentList()&0xff
+        self.lastCall = len(self.currentChunk().code)
         self.emitBytes(OP.CALL, argCount)
 
     def dot(self, canAssign: bool):
@@ -426,6 +552,7 @@ class Compiler:
             self.emitBytes(OP.SET_PROPERTY, name)
         elif self.parser.match(TOKEN.LEFT_PAREN):
             argCount = self.argumentList()&0xff
+            self.lastCall = len(self.currentChunk().code)
             self.emitBytes(OP.INVOKE, name)
             self.emitByte(argCount)
         else:
@@ -436,14 +563,25 @@ class Compiler:
         self.emitConstant(Value.from_float(value))
 
     def string(self, canAssign: bool):
-        self.emitConstant(Value.from_obj(ObjString(self.parser.previous.source[1:-1])))
+        self.emitConstant(Value.from_obj(copyString(self.strings, self.parser.previous.source[1:-1])))
 
     def unary(self, canAssign: bool):
         operatorType = self.parser.previous.type
 
         # Compile the operand.
+        start = len(self.currentChunk().code)
         self.parsePrecedence(PREC.UNARY)
 
+        constant = self.constantOperand(start)
+        if constant is not None:
+            _, _, constantCount, value = constant
+            if operatorType == TOKEN.BANG:
+                self.foldConstant(start, constantCount, Value.from_bool(isFalsey(value)))
+                return
+            if operatorType == TOKEN.MINUS and value.is_number():
+                self.foldConstant(start, constantCount, Value.from_float(-float(value)))
+                return
+
         # Emit the operator instruction.
         match operatorType:
             case TOKEN.BANG: self.emitByte(OP.NOT)
@@ -453,8 +591,16 @@ class Compiler:
     def binary(self, canAssign: bool):
         operatorType = self.parser.previous.type
         rule = self.getRule(operatorType)
+        left = self.constantOperand()
+        rightStart = len(self.currentChunk().code)
         self.parsePrecedence(PREC(rule.precedence + 1))
 
+        if left is not None and self.constantOperand(rightStart) is not None:
+            value = self.binaryConstant(operatorType, left[3], self.lastConstant[3])
+            if value is not None:
+                self.foldConstant(left[0], left[2], value)
+                return
+
         match operatorType:
             case TOKEN.BANG_EQUAL:    self.emitBytes(OP.EQUAL, OP.NOT)
             case TOKEN.EQUAL_EQUAL:   self.emitByte(OP.EQUAL)
@@ -468,7 +614,40 @@ class Compiler:
             case TOKEN.SLASH:         self.emitByte(OP.DIVIDE)
             case _: return # Unreachable
 
+    def binaryConstant(self, operatorType: TOKEN, a: Value, b: Value):
+        """What the VM computes for a binary operator on two constants, or
+        None where it would be a runtime error, which is left to happen at
+        runtime."""
+        match operatorType:
+            case TOKEN.BANG_EQUAL:  return Value.from_bool(not a == b)
+            case TOKEN.EQUAL_EQUAL: return Value.from_bool(a == b)
+
+        if operatorType == TOKEN.PLUS and a.is_string() and b.is_string():
+            return Value.from_obj(copyString(self.strings, a.as_str() + b.as_str()))
+        if not (a.is_number() and b.is_number()): return None
+
+        a, b = float(a), float(b)
+        match operatorType:
+            case TOKEN.GREATER:       return Value.from_bool(a > b)
+            case TOKEN.GREATER_EQUAL: return Value.from_bool(ge(a, b))
+            case TOKEN.LESS:          return Value.from_bool(a < b)
+            case TOKEN.LESS_EQUAL:    return Value.from_bool(le(a, b))
+            case TOKEN.PLUS:          return Value.from_float(a + b)
+            case TOKEN.MINUS:         return Value.from_float(a - b)
+            case TOKEN.STAR:          return Value.from_float(a * b)
+            case TOKEN.SLASH:         return Value.from_float(div(a, b))
+            case _: return None # Unreachable
+
     def and_(self, canAssign: bool):
+        left = self.constantOperand()
+        if left is not None:
+            if isFalsey(left[3]):
+                self.skipOperand(PREC.AND)
+            else:
+                self.currentChunk().truncate(left[0], left[2])
+                self.parsePrecedence(PREC.AND)
+            return
+
         endJump = self.emitJump(OP.JUMP_IF_FALSE)
 
         self.emitByte(OP.POP)
@@ -477,6 +656,15 @@ class Compiler:
         self.patchJump(endJump)
 
     def or_(self, canAssign: bool):
+        left = self.constantOperand()
+        if left is not None:
+            if isFalsey(left[3]):
+                self.currentChunk().truncate(left[0], left[2])
+                self.parsePrecedence(PREC.OR)
+            else:
+                self.skipOperand(PREC.OR)
+            return
+
         elseJump = self.emitJump(OP.JUMP_IF_FALSE)
         endJump = self.emitJump(OP.JUMP)
 
@@ -488,9 +676,9 @@ class Compiler:
 
     def literal(self, canAssign: bool):
         match self.parser.previous.type:
-            case TOKEN.FALSE: self.emitByte(OP.FALSE)
-            case TOKEN.NIL: self.emitByte(OP.NIL)
-            case TOKEN.TRUE: self.emitByte(OP.TRUE)
+            case TOKEN.FALSE: self.emitLiteral(Value.from_bool(False))
+            case TOKEN.NIL: self.emitLiteral(Value.nil())
+            case TOKEN.TRUE: self.emitLiteral(Value.from_bool(True))
             case _: return # Unreachable
 
     def parsePrecedence(self, precedence: PREC):
@@ -588,8 +776,18 @@ class Compiler:
 
             self.expression()
             self.parser.consume(TOKEN.SEMICOLON, "Expect ';' after return value.")
+            self.tailCall()
             self.emitByte(OP.RETURN)
 
+    def tailCall(self):
+        """Turn the call the return value comes straight out of, if any,
+        into its tail form. The OP.RETURN after it stays: a tail call to a
+        native leaves its result for it, as do jumps that land on it."""
+        code = self.currentChunk().code
+        call = self.lastCall
+        if call is None or call + 1 + OPERAND_BYTES[code[call]] != len(code): return
+        code[call] = OP.TAIL_CALL if code[call] == OP.CALL else OP.TAIL_INVOKE
+
     def whileStatement(self):
         loopStart = len(self.currentChunk().code)
         self.parser.consume(TOKEN.LEFT_PAREN, "Expect '(' after 'while'.")
@@ -687,9 +885,14 @@ class Compiler:
 
         self.currentClass = self.currentClass.enclosing
 
-    def function_(self, type: TYPE):
+    def function_(self, type: TYPE, selfLocal: Local=None):
         compiler = Compiler(type, self, self.parser, self.scanner)
         compiler.function.chunk.__init__()
+        if selfLocal is not None:
+            # Slot 0 holds the closure being called, so the body can read
+            # the local it is stored in from there instead of capturing it.
+            compiler.locals[0].name = selfLocal.name
+            compiler.selfLocal = selfLocal
         compiler.beginScope()
 
         compiler.parser.consume(TOKEN.LEFT_PAREN, "Expect '(' after function name.")
@@ -715,8 +918,24 @@ class Compiler:
     def funDeclaration(self):
         global_ = self.parseVariable("Expect function name.")
         self.markInitialized()
+        if self.scopeDepth == 0:
+            self.function_(TYPE.FUNCTION)
+            self.defineVariable(global_)
+            return
+
+        local = self.locals[-1]
+        if not local.isCell:
+            self.function_(TYPE.FUNCTION, local)
+            return
+
+        # The closure may capture the cell it is stored in, so the cell has
+        # to exist before it does.
+        slot = len(self.locals) - 1
+        self.emitByte(OP.NIL)
+        self.emitBytes(OP.BOX, slot)
         self.function_(TYPE.FUNCTION)
-        self.defineVariable(global_)
+        self.emitBytes(OP.SET_LOCAL_CELL, slot)
+        self.emitByte(OP.POP)
 
     def varDeclaration(self):
         global_ = self.parseVariable("Expect variable name.")
@@ -743,9 +962,34 @@ class Compiler:
         if self.parser.panicMode: self.parser.synchronize()
 
     def compile(self, source: str):
-        self.scanner.__init__(source)
+        """Compile a script, printing its errors to stderr; None if it has
+        any."""
+        function = self.tryCompile(source)
+        for error in self.parser.errors:
+            print(error, file=stderr)
+        return function
+
+    def tryCompile(self, source: str):
+        """Compile a script: a str, a SourceFile or a list of tokens. Its
+        errors are left in parser.errors, and a script that has any gives
+        back the global slots and strings it added.
+
+        The Resolver reads the tokens first to decide which locals need
+        cells, so a str is only tokenized once, for both."""
+        # Both tables only grow, in insertion order.
+        globalCount = len(self.globalSlots)
+        stringCount = len(self.strings)
+
+        if isinstance(source, str): source = tokenize(source)
+        self.cells = Resolver(scannerFor(source)).resolve()
+
+        self.declared = []
+        self.scanner = scannerFor(source)
         self.parser.__init__(self.scanner)
         self.function.chunk.__init__()
+        self.lastConstant = None
+        self.lastJumpTarget = None
+        self.lastCall = None
 
         self.parser.hadError = False
         self.parser.panicMode = False
@@ -756,4 +1000,11 @@ class Compiler:
             self.declaration()
 
         function = self.end()
-        return None if self.parser.hadError else function
+        if not self.parser.hadError: return function
+
+        for name in list(self.globalSlots)[globalCount:]:
+            del self.globalSlots[name]
+        del self.globalValues[globalCount:]
+        for chars in list(self.strings)[stringCount:]:
+            del self.strings[chars]
+        return None
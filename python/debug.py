@@ -33,15 +33,21 @@ def disassembleInstruction(chunk: Chunk, offset: int):
         case OP.SET_LOCAL:
             return byteInstruction("OP_SET_LOCAL", chunk, offset)
         case OP.GET_GLOBAL:
-            return constantInstruction("OP_GET_GLOBAL", chunk, offset)
+            return globalInstruction("OP_GET_GLOBAL", chunk, offset)
         case OP.DEFINE_GLOBAL:
-            return constantInstruction("OP_DEFINE_GLOBAL", chunk, offset)
+            return globalInstruction("OP_DEFINE_GLOBAL", chunk, offset)
         case OP.SET_GLOBAL:
-            return constantInstruction("OP_SET_GLOBAL", chunk, offset)
+            return globalInstruction("OP_SET_GLOBAL", chunk, offset)
         case OP.GET_UPVALUE:
             return byteInstruction("OP_GET_UPVALUE", chunk, offset)
-        case OP.SET_UPVALUE:
-            return byteInstruction("OP_SET_UPVALUE", chunk, offset)
+        case OP.GET_CELL:
+            return byteInstruction("OP_GET_CELL", chunk, offset)
+        case OP.SET_CELL:
+            return byteInstruction("OP_SET_CELL", chunk, offset)
+        case OP.GET_LOCAL_CELL:
+            return byteInstruction("OP_GET_LOCAL_CELL", chunk, offset)
+        case OP.SET_LOCAL_CELL:
+            return byteInstruction("OP_SET_LOCAL_CELL", chunk, offset)
         case OP.GET_PROPERTY:
             return constantInstruction("OP_GET_PROPERTY", chunk, offset)
         case OP.SET_PROPERTY:
@@ -50,10 +56,16 @@ def disassembleInstruction(chunk: Chunk, offset: int):
             return constantInstruction("OP_GET_SUPER", chunk, offset)
         case OP.EQUAL:
             return simpleInstruction("OP_EQUAL", offset)
+        case OP.NOT_EQUAL:
+            return simpleInstruction("OP_NOT_EQUAL", offset)
         case OP.GREATER:
             return simpleInstruction("OP_GREATER", offset)
+        case OP.GREATER_EQUAL:
+            return simpleInstruction("OP_GREATER_EQUAL", offset)
         case OP.LESS:
             return simpleInstruction("OP_LESS", offset)
+        case OP.LESS_EQUAL:
+            return simpleInstruction("OP_LESS_EQUAL", offset)
         case OP.ADD:
             return simpleInstruction("OP_ADD", offset)
         case OP.SUBTRACT:
@@ -72,6 +84,10 @@ def disassembleInstruction(chunk: Chunk, offset: int):
             return jumpInstruction("OP_JUMP", 1, chunk, offset)
         case OP.JUMP_IF_FALSE:
             return jumpInstruction("OP_JUMP_IF_FALSE", 1, chunk, offset)
+        case OP.JUMP_IF_TRUE:
+            return jumpInstruction("OP_JUMP_IF_TRUE", 1, chunk, offset)
+        case OP.POP_JUMP_IF_FALSE:
+            return jumpInstruction("OP_POP_JUMP_IF_FALSE", 1, chunk, offset)
         case OP.LOOP:
             return jumpInstruction("OP_LOOP", -1, chunk, offset)
         case OP.CALL:
@@ -80,6 +96,10 @@ def disassembleInstruction(chunk: Chunk, offset: int):
             return invokeInstruction("OP_INVOKE", chunk, offset)
         case OP.SUPER_INVOKE:
             return invokeInstruction("OP_SUPER_INVOKE", chunk, offset)
+        case OP.TAIL_CALL:
+            return byteInstruction("OP_TAIL_CALL", chunk, offset)
+        case OP.TAIL_INVOKE:
+            return invokeInstruction("OP_TAIL_INVOKE", chunk, offset)
         case OP.CLOSURE:
             offset += 1
             constant = chunk.code[offset]
@@ -97,8 +117,8 @@ def disassembleInstruction(chunk: Chunk, offset: int):
                       file=stdout)
                 offset += 2
             return offset
-        case OP.CLOSE_UPVALUE:
-            return simpleInstruction("OP_CLOSE_UPVALUE", offset)
+        case OP.BOX:
+            return byteInstruction("OP_BOX", chunk, offset)
         case OP.RETURN:
             return simpleInstruction("OP_RETURN", offset)
         case OP.CLASS:
@@ -107,6 +127,8 @@ def disassembleInstruction(chunk: Chunk, offset: int):
             return simpleInstruction("OP_INHERIT", offset)
         case OP.METHOD:
             return constantInstruction("OP_METHOD", chunk, offset)
+        case fused if fused in FUSED:
+            return fusedInstruction(chunk, offset)
         case _:
             print(f"Unknown opcode {instruction}", file=stdout)
             return offset + 1
@@ -122,12 +144,39 @@ def constantInstruction(name: str, chunk: Chunk, offset: int):
           file=stdout)
     return offset + 2
 
+def fusedInstruction(chunk: Chunk, offset: int):
+    """List a superinstruction with the operands of the instructions it
+    stands for, in order, each the way its own instruction lists it."""
+    fused = OP(chunk.code[offset])
+    operands = []
+    for op in FUSED[fused]:
+        match op:
+            case OP.GET_LOCAL:
+                operands.append("%4d"%chunk.code[offset + 1])
+            case OP.CONSTANT | OP.GET_PROPERTY:
+                constant = chunk.code[offset + 1]
+                operands.append("%4d '%s'"%(constant,chunk.constants[constant]))
+            case OP.POP_JUMP_IF_FALSE:
+                jump = (chunk.code[offset + 1] << 8) | chunk.code[offset + 2]
+                operands.append("%4d -> %d"%(offset,offset + 3 + jump))
+        offset += 1 + OPERAND_BYTES[op]
+    print("%-16s %s"%(f"OP_{fused.name}"," ".join(operands)), file=stdout)
+    return offset
+
+def globalInstruction(name: str, chunk: Chunk, offset: int):
+    constant = chunk.code[offset + 1]
+    slot = (chunk.code[offset + 2] << 8) | chunk.code[offset + 3]
+    print("%-16s %4d '%s' [%d]"%
+          (name,constant,chunk.constants[constant],slot),
+          file=stdout)
+    return offset + 4
+
 def byteInstruction(name: str, chunk: Chunk, offset: int):
     print("%-16s %4d"%(name,chunk.code[offset + 1]), file=stdout)
     return offset + 2
 
 def jumpInstruction(name: str, sign: int, chunk: Chunk, offset: int):
-    jump = uint16_t(chunk.code[offset + 1] << 8)
+    jump = chunk.code[offset + 1] << 8
     jump |= chunk.code[offset + 2]
     print("%-16s %4d -> %d"%
           (name,offset,offset+3+sign*jump),
@@ -141,3 +190,22 @@ def invokeInstruction(name: str, chunk: Chunk, offset: int):
           (name,argCount,constant,chunk.constants[constant]),
           file=stdout)
     return offset + 3
+
+def disassembleRegisterCode(code, name: str):
+    print(f"== {name} ==", file=stdout)
+
+    for index, instruction in enumerate(code.code):
+        print("%04d" % index, end=" ", file=stdout)
+        if index > 0 and code.lines[index] == code.lines[index - 1]:
+            print("   | ", end="", file=stdout)
+        else:
+            print("%4d " % code.lines[index], end="", file=stdout)
+
+        operands = []
+        for operand in instruction[1:]:
+            if isinstance(operand, int) and operand < 0:
+                operands.append(f"'{code.constants[~operand]}'")
+            else:
+                operands.append(str(operand))
+        print("%-16s %s" % (f"R_{instruction[0].name}", " ".join(operands)),
+              file=stdout)
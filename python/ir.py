@@ -0,0 +1,529 @@
+from common import *
+from compiler import *
+from scanner import *
+
+# The opt-in optimizing front end. The source is parsed a second time into a
+# tree that keeps every token it was parsed from, a list of passes rewrites
+# the tree, and the tokens of the result go through the single-pass compiler,
+# which stays the code generator. Tokens keep their lines, so runtime errors
+# and stack traces point where they did; the tokens a pass makes up take the
+# line of the code they were made for.
+
+class Node:
+    """A declaration, statement or expression. The items are the tokens it
+    was parsed from, with its sub-statements and sub-expressions nested in
+    place as Nodes; the keywords name the parts the passes look at."""
+    def __init__(self, kind: str, items: list, **parts):
+        self.kind = kind
+        self.items = items
+        self.__dict__.update(parts)
+
+    def nodes(self):
+        return [item for item in self.items if isinstance(item, Node)]
+
+    def replace(self, old, new):
+        self.items[self.items.index(old)] = new
+        for name, value in vars(self).items():
+            if value is old: setattr(self, name, new)
+
+    def tokens(self, out: list):
+        for item in self.items:
+            if isinstance(item, Node):
+                item.tokens(out)
+            else:
+                out.append(item)
+        return out
+
+    def walk(self):
+        yield self
+        for node in self.nodes():
+            yield from node.walk()
+
+def makeToken(type: TOKEN, source: str, line: int):
+    token = Token.synthetic(source)
+    token.type = type
+    token.line = line
+    return token
+
+class Unparsable(Exception):
+    """Raised when the Builder runs into source the compiler would reject."""
+
+class Builder:
+    """Parses source into a Node tree, raising Unparsable where the
+    compiler would report a syntax error. The errors the compiler finds
+    past the grammar, like a return at top level, it leaves to the
+    compiler."""
+    def __init__(self, source: str):
+        scanner = scannerFor(source)
+        self.tokens = [scanner.scanToken()]
+        while self.tokens[-1].type != TOKEN.EOF:
+            self.tokens.append(scanner.scanToken())
+        self.current = 0
+
+    def check(self, *types: TOKEN):
+        return self.tokens[self.current].type in types
+
+    def advance(self):
+        self.current += 1
+        return self.tokens[self.current - 1]
+
+    def consume(self, type: TOKEN):
+        if not self.check(type): raise Unparsable(f"unexpected {self.tokens[self.current].type.name}")
+        return self.advance()
+
+    def build(self):
+        items = []
+        while not self.check(TOKEN.EOF):
+            items.append(self.declaration())
+        items.append(self.tokens[self.current])
+        return Node("block", items)
+
+    def declaration(self):
+        if self.check(TOKEN.CLASS): return self.classDeclaration()
+        if self.check(TOKEN.FUN):
+            keyword = self.advance()
+            function = self.function()
+            return Node("fun", [keyword, function], name=function.name, function=function)
+        if self.check(TOKEN.VAR): return self.varDeclaration()
+        return self.statement()
+
+    def classDeclaration(self):
+        items = [self.advance()]
+        name = self.consume(TOKEN.IDENTIFIER)
+        items.append(name)
+        superclass = None
+        if self.check(TOKEN.LESS):
+            items.append(self.advance())
+            superclass = Node("variable", [self.consume(TOKEN.IDENTIFIER)])
+            superclass.name = superclass.items[0]
+            items.append(superclass)
+        items.append(self.consume(TOKEN.LEFT_BRACE))
+        methods = []
+        while not self.check(TOKEN.RIGHT_BRACE):
+            methods.append(self.function())
+        items.extend(methods)
+        items.append(self.advance())
+        return Node("class", items, name=name, superclass=superclass, methods=methods)
+
+    def function(self):
+        name = self.consume(TOKEN.IDENTIFIER)
+        items = [name, self.consume(TOKEN.LEFT_PAREN)]
+        params = []
+        while not self.check(TOKEN.RIGHT_PAREN):
+            if params: items.append(self.consume(TOKEN.COMMA))
+            params.append(self.consume(TOKEN.IDENTIFIER))
+            items.append(params[-1])
+        items.append(self.advance())
+        body = self.block()
+        items.append(body)
+        return Node("function", items, name=name, params=params, body=body)
+
+    def varDeclaration(self):
+        items = [self.advance()]
+        name = self.consume(TOKEN.IDENTIFIER)
+        items.append(name)
+        initializer = None
+        if self.check(TOKEN.EQUAL):
+            items.append(self.advance())
+            initializer = self.expression()
+            items.append(initializer)
+        items.append(self.consume(TOKEN.SEMICOLON))
+        return Node("var", items, name=name, initializer=initializer)
+
+    def block(self):
+        items = [self.consume(TOKEN.LEFT_BRACE)]
+        while not self.check(TOKEN.RIGHT_BRACE):
+            items.append(self.declaration())
+        items.append(self.advance())
+        return Node("block", items)
+
+    def statement(self):
+        if self.check(TOKEN.PRINT):
+            items = [self.advance(), self.expression(), self.consume(TOKEN.SEMICOLON)]
+            return Node("print", items, value=items[1])
+        if self.check(TOKEN.FOR): return self.forStatement()
+        if self.check(TOKEN.IF):
+            items = [self.advance(), self.consume(TOKEN.LEFT_PAREN), self.expression(),
+                     self.consume(TOKEN.RIGHT_PAREN), self.statement()]
+            elseBranch = None
+            if self.check(TOKEN.ELSE):
+                items.append(self.advance())
+                elseBranch = self.statement()
+                items.append(elseBranch)
+            return Node("if", items, condition=items[2], thenBranch=items[4], elseBranch=elseBranch)
+        if self.check(TOKEN.RETURN):
+            items = [self.advance()]
+            value = None
+            if not self.check(TOKEN.SEMICOLON):
+                value = self.expression()
+                items.append(value)
+            items.append(self.consume(TOKEN.SEMICOLON))
+            return Node("return", items, value=value)
+        if self.check(TOKEN.WHILE):
+            items = [self.advance(), self.consume(TOKEN.LEFT_PAREN), self.expression(),
+                     self.consume(TOKEN.RIGHT_PAREN), self.statement()]
+            return Node("while", items, condition=items[2], body=items[4])
+        if self.check(TOKEN.LEFT_BRACE): return self.block()
+        return self.expressionStatement()
+
+    def expressionStatement(self):
+        items = [self.expression(), self.consume(TOKEN.SEMICOLON)]
+        return Node("expression", items, value=items[0])
+
+    def forStatement(self):
+        items = [self.advance(), self.consume(TOKEN.LEFT_PAREN)]
+        initializer = condition = increment = None
+        if self.check(TOKEN.SEMICOLON):
+            items.append(self.advance())
+        elif self.check(TOKEN.VAR):
+            initializer = self.varDeclaration()
+            items.append(initializer)
+        else:
+            initializer = self.expressionStatement()
+            items.append(initializer)
+        if not self.check(TOKEN.SEMICOLON):
+            condition = self.expression()
+            items.append(condition)
+        items.append(self.consume(TOKEN.SEMICOLON))
+        if not self.check(TOKEN.RIGHT_PAREN):
+            increment = self.expression()
+            items.append(increment)
+        items.append(self.consume(TOKEN.RIGHT_PAREN))
+        body = self.statement()
+        items.append(body)
+        return Node("for", items, initializer=initializer, condition=condition,
+                    increment=increment, body=body)
+
+    def expression(self):
+        target = self.binary("logical", self.and_, TOKEN.OR)
+        if not self.check(TOKEN.EQUAL): return target
+        equals = self.advance()
+        value = self.expression()
+        if target.kind == "variable":
+            return Node("assign", [target.name, equals, value], name=target.name, value=value)
+        if target.kind != "get": raise Unparsable("invalid assignment target")
+        return Node("set", target.items + [equals, value],
+                    object=target.object, name=target.name, value=value)
+
+    def and_(self):
+        return self.binary("logical", self.equality, TOKEN.AND)
+
+    def equality(self):
+        return self.binary("binary", self.comparison, TOKEN.BANG_EQUAL, TOKEN.EQUAL_EQUAL)
+
+    def comparison(self):
+        return self.binary("binary", self.term,
+                           TOKEN.GREATER, TOKEN.GREATER_EQUAL, TOKEN.LESS, TOKEN.LESS_EQUAL)
+
+    def term(self):
+        return self.binary("binary", self.factor, TOKEN.MINUS, TOKEN.PLUS)
+
+    def factor(self):
+        return self.binary("binary", self.unary, TOKEN.SLASH, TOKEN.STAR)
+
+    def binary(self, kind: str, operand, *operators: TOKEN):
+        left = operand()
+        while self.check(*operators):
+            operator = self.advance()
+            right = operand()
+            left = Node(kind, [left, operator, right], left=left, operator=operator, right=right)
+        return left
+
+    def unary(self):
+        if not self.check(TOKEN.BANG, TOKEN.MINUS): return self.call()
+        operator = self.advance()
+        right = self.unary()
+        return Node("unary", [operator, right], operator=operator, right=right)
+
+    def call(self):
+        expression = self.primary()
+        while True:
+            if self.check(TOKEN.LEFT_PAREN):
+                items = [expression, self.advance()]
+                arguments = []
+                while not self.check(TOKEN.RIGHT_PAREN):
+                    if arguments: items.append(self.consume(TOKEN.COMMA))
+                    arguments.append(self.expression())
+                    items.append(arguments[-1])
+                items.append(self.advance())
+                expression = Node("call", items, callee=expression, arguments=arguments)
+            elif self.check(TOKEN.DOT):
+                items = [expression, self.advance(), self.consume(TOKEN.IDENTIFIER)]
+                expression = Node("get", items, object=expression, name=items[2])
+            else:
+                return expression
+
+    def primary(self):
+        token = self.advance()
+        match token.type:
+            case TOKEN.IDENTIFIER:
+                return Node("variable", [token], name=token)
+            case TOKEN.LEFT_PAREN:
+                items = [token, self.expression(), self.consume(TOKEN.RIGHT_PAREN)]
+                return Node("grouping", items, expression=items[1])
+            case TOKEN.SUPER:
+                items = [token, self.consume(TOKEN.DOT), self.consume(TOKEN.IDENTIFIER)]
+                return Node("super", items, name=items[2])
+            case TOKEN.THIS:
+                return Node("this", [token])
+            case TOKEN.NUMBER | TOKEN.STRING | TOKEN.TRUE | TOKEN.FALSE | TOKEN.NIL:
+                return Node("literal", [token], value=token)
+        raise Unparsable(f"unexpected {token.type.name}")
+
+class Binding:
+    """A local variable: the function it lives in, how many times it is
+    named after its declaration, and whether a nested function names it."""
+    def __init__(self, function: Node):
+        self.function = function
+        self.uses = 0
+        self.captured = False
+
+def resolve(tree: Node):
+    """Bind every variable, assign, var, fun and class node to the local it
+    names, or to None for a global, the way the compiler resolves them."""
+    scopes = []
+
+    def declare(node: Node, function: Node):
+        node.binding = None
+        if scopes:
+            node.binding = Binding(function)
+            scopes[-1][node.name.source] = node.binding
+
+    def lookup(node: Node, function: Node):
+        node.binding = None
+        for scope in reversed(scopes):
+            binding = scope.get(node.name.source)
+            if binding is not None:
+                node.binding = binding
+                binding.uses += 1
+                if binding.function is not function: binding.captured = True
+                return
+
+    def visit(node: Node, function: Node):
+        match node.kind:
+            case "block" if node is not tree:
+                scopes.append({})
+                for child in node.nodes(): visit(child, function)
+                scopes.pop()
+            case "var":
+                if node.initializer is not None: visit(node.initializer, function)
+                declare(node, function)
+            case "fun":
+                declare(node, function)
+                visit(node.function, function)
+            case "class":
+                declare(node, function)
+                if node.superclass is not None: visit(node.superclass, function)
+                for method in node.methods: visit(method, function)
+            case "function":
+                scopes.append({param.source: Binding(node) for param in node.params})
+                for child in node.body.nodes(): visit(child, node)
+                scopes.pop()
+            case "for":
+                scopes.append({})
+                for child in node.nodes(): visit(child, function)
+                scopes.pop()
+            case "variable" | "assign":
+                for child in node.nodes(): visit(child, function)
+                lookup(node, function)
+            case _:
+                for child in node.nodes(): visit(child, function)
+
+    visit(tree, tree)
+
+def returns(statement: Node):
+    """Whether every path through the statement ends in a return."""
+    match statement.kind:
+        case "return":
+            return True
+        case "block":
+            return any(returns(child) for child in statement.nodes())
+        case "if":
+            return (statement.elseBranch is not None
+                    and returns(statement.thenBranch) and returns(statement.elseBranch))
+    return False
+
+def removeDeadCode(tree: Node):
+    """Drop the statements of a block that follow one that always returns."""
+    for node in tree.walk():
+        if node.kind != "block": continue
+        for i, item in enumerate(node.items):
+            if isinstance(item, Node) and returns(item):
+                node.items[i + 1:-1] = []
+                break
+
+def pure(expression: Node):
+    """Whether evaluating the expression can neither fail nor be seen."""
+    match expression.kind:
+        case "literal" | "this":
+            return True
+        case "variable":
+            return expression.binding is not None
+        case "grouping":
+            return pure(expression.expression)
+        case "unary":
+            return expression.operator.type == TOKEN.BANG and pure(expression.right)
+        case "logical":
+            return pure(expression.left) and pure(expression.right)
+        case "binary":
+            return (expression.operator.type in (TOKEN.EQUAL_EQUAL, TOKEN.BANG_EQUAL)
+                    and pure(expression.left) and pure(expression.right))
+    return False
+
+def removeUnusedLocals(tree: Node):
+    """Drop the local vars and funs nothing names. An initializer that might
+    fail or be seen stays behind as an expression statement."""
+    resolve(tree)
+    for node in list(tree.walk()):
+        for child in node.nodes():
+            if child.kind not in ("var", "fun") or child.binding is None: continue
+            if child.binding.uses > 0: continue
+
+            semicolon = child.items[-1]
+            if child.kind == "var" and not (child.initializer is None or pure(child.initializer)):
+                replacement = Node("expression", [child.initializer, semicolon], value=child.initializer)
+            elif node.kind == "for":
+                replacement = semicolon
+            else:
+                node.items.remove(child)
+                continue
+            node.replace(child, replacement)
+            if node.kind == "for" and replacement is semicolon: node.initializer = None
+
+def hoistLoopInvariants(tree: Node):
+    """Evaluate invariant parts of a loop condition once, before the loop.
+
+    Only a part the condition evaluates first is hoisted, after nothing but
+    reads of locals and literals, so any error it raises is raised with
+    the same output at the same point. Loop bodies are left alone: a part
+    of one hoisted out would fail before iterations that used to run."""
+    resolve(tree)
+    count = 0
+
+    def invariant(expression: Node, assigned: set, calls: bool):
+        match expression.kind:
+            case "literal" | "this":
+                return True
+            case "variable":
+                if expression.binding is None:
+                    return not calls and expression.name.source not in assigned
+                return not expression.binding.captured and expression.binding not in assigned
+            case "grouping":
+                return invariant(expression.expression, assigned, calls)
+            case "unary":
+                return invariant(expression.right, assigned, calls)
+            case "binary" | "logical":
+                return (invariant(expression.left, assigned, calls)
+                        and invariant(expression.right, assigned, calls))
+        return False
+
+    def hoist(loop: Node, parent: Node):
+        assigned = set()
+        calls = False
+        for node in loop.walk():
+            if node.kind == "assign":
+                assigned.add(node.name.source if node.binding is None else node.binding)
+            calls = calls or node.kind == "call"
+
+        line = loop.items[0].line
+        hoisted = []
+
+        def scan(parent: Node, expression: Node):
+            # Returns whether nothing that might fail has run yet.
+            nonlocal count
+            match expression.kind:
+                case "literal" | "this":
+                    return True
+                case "variable" if expression.binding is not None:
+                    return True
+                case "grouping":
+                    return scan(expression, expression.expression)
+            if expression.kind in ("unary", "binary") and invariant(expression, assigned, calls):
+                # The operator reading the variable reports its errors at
+                # the line the expression ended on, as the expression did.
+                expressionLine = expression.tokens([])[-1].line
+                name = makeToken(TOKEN.IDENTIFIER, f"invariant {count}", expressionLine)
+                count += 1
+                hoisted.append(Node("var", [makeToken(TOKEN.VAR, "var", expressionLine), name,
+                                            makeToken(TOKEN.EQUAL, "=", expressionLine), expression,
+                                            makeToken(TOKEN.SEMICOLON, ";", expressionLine)],
+                                    name=name, initializer=expression))
+                parent.replace(expression, Node("variable", [name], name=name, binding=None))
+                return True
+            match expression.kind:
+                case "unary":
+                    return scan(expression, expression.right) and expression.operator.type == TOKEN.BANG
+                case "binary":
+                    return (scan(expression, expression.left) and scan(expression, expression.right)
+                            and expression.operator.type in (TOKEN.EQUAL_EQUAL, TOKEN.BANG_EQUAL))
+                case "logical":
+                    scan(expression, expression.left)
+            return False
+
+        scan(loop, loop.condition)
+        if not hoisted: return
+
+        items = [makeToken(TOKEN.LEFT_BRACE, "{", line)]
+        if loop.kind == "for" and loop.initializer is not None:
+            items.append(loop.initializer)
+            loop.replace(loop.initializer, makeToken(TOKEN.SEMICOLON, ";", line))
+            loop.initializer = None
+        items.extend(hoisted)
+        items.append(loop)
+        items.append(makeToken(TOKEN.RIGHT_BRACE, "}", line))
+        parent.replace(loop, Node("block", items))
+
+    def visit(node: Node):
+        for child in node.nodes():
+            visit(child)
+            if child.kind in ("while", "for") and child.condition is not None:
+                hoist(child, node)
+
+    visit(tree)
+
+PASSES = [removeDeadCode, removeUnusedLocals, hoistLoopInvariants]
+
+class IRCompiler(Compiler):
+    """Compiler that runs the passes over a tree of the source first.
+
+    A script is compiled once: the source when the passes change nothing,
+    and otherwise the rewrite, which keeps every token of the source and
+    so any error in it. Should the rewrite fail to compile, as when
+    hoisting runs a function out of local slots or the source has errors,
+    it is rolled back and the source compiled instead, so the errors
+    reported are the single-pass compiler's and nothing else. Only when a
+    pass drops tokens, which might be the ones in error, is the source
+    compiled before its rewrite."""
+    def __init__(self, type: TYPE=TYPE.SCRIPT, passes: list=PASSES):
+        super().__init__(type)
+        self.passes = passes
+
+    def compile(self, source: str):
+        # The tree is built from the same tokens the source compiles from.
+        if isinstance(source, str): source = tokenize(source)
+        if not self.passes: return super().compile(source)
+
+        builder = Builder(source)
+        try:
+            tree = builder.build()
+        except Unparsable:
+            return super().compile(source)
+        for optimize in self.passes:
+            optimize(tree)
+        tokens = tree.tokens([])
+        if tokens == builder.tokens: return super().compile(source)
+
+        kept = set(map(id, tokens))
+        if all(id(token) in kept for token in builder.tokens):
+            optimized = self.tryCompile(tokens)
+            if optimized is not None: return optimized
+            self.function = ObjFunction()
+            return super().compile(source)
+
+        function = super().compile(source)
+        if function is None: return None
+        self.function = ObjFunction()
+        optimized = self.tryCompile(tokens)
+        if optimized is not None: return optimized
+        self.function = function
+        return function
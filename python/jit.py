@@ -0,0 +1,348 @@
+from chunk import *
+from common import *
+from object import *
+from threaded import *
+from value import *
+from vm import *
+
+# Back-edges taken to a loop header before its next iteration is recorded.
+HOT_LOOP = 50
+# Longest trace worth compiling, in instructions.
+MAX_TRACE = 1000
+
+NIL = Value.nil()
+TRUE = Value.from_bool(True)
+FALSE = Value.from_bool(False)
+
+# Instructions a trace can contain. Anything else ends recording and the
+# loop stays interpreted.
+TRACEABLE = {
+    OP.CONSTANT, OP.NIL, OP.TRUE, OP.FALSE, OP.POP,
+    OP.GET_LOCAL, OP.SET_LOCAL, OP.GET_GLOBAL, OP.SET_GLOBAL,
+    OP.DEFINE_GLOBAL, OP.GET_UPVALUE, OP.GET_CELL, OP.SET_CELL,
+    OP.GET_LOCAL_CELL, OP.SET_LOCAL_CELL,
+    OP.GET_PROPERTY, OP.SET_PROPERTY,
+    OP.EQUAL, OP.NOT_EQUAL, OP.GREATER, OP.GREATER_EQUAL, OP.LESS,
+    OP.LESS_EQUAL, OP.ADD, OP.SUBTRACT, OP.MULTIPLY, OP.DIVIDE, OP.NOT,
+    OP.NEGATE, OP.PRINT, OP.JUMP, OP.JUMP_IF_FALSE, OP.JUMP_IF_TRUE,
+    OP.POP_JUMP_IF_FALSE, OP.LOOP, OP.CALL, OP.INVOKE,
+}
+
+# Instructions that are only traced when observe() recognized their
+# operands.
+NEEDS_TYPES = {
+    OP.GET_PROPERTY, OP.SET_PROPERTY, OP.GREATER, OP.GREATER_EQUAL,
+    OP.LESS, OP.LESS_EQUAL, OP.ADD, OP.SUBTRACT, OP.MULTIPLY, OP.DIVIDE,
+    OP.NEGATE,
+}
+
+class HotLoop:
+    def __init__(self, header: int):
+        self.header = header
+        self.count = 0
+        self.trace = None
+        self.blacklisted = False
+
+def _falsey(name: str):
+    return f"({name}.type is BOOL_T and not {name}.as_ or {name}.type is NIL_T)"
+
+def observe(vm, instruction: tuple):
+    """What a trace needs to know about an instruction's operands right
+    before it runs: the kind of values an operator saw, the shape of the
+    instance a property read found a field in, or which way a branch
+    went."""
+    stack = vm.stack
+    match instruction[0]:
+        case (OP.ADD | OP.SUBTRACT | OP.MULTIPLY | OP.DIVIDE |
+              OP.GREATER | OP.GREATER_EQUAL | OP.LESS | OP.LESS_EQUAL |
+              OP.EQUAL | OP.NOT_EQUAL):
+            a, b = stack[-2], stack[-1]
+            if a.is_number() and b.is_number(): return "number"
+            if instruction[0] in (OP.EQUAL, OP.NOT_EQUAL): return "any"
+            if instruction[0] == OP.ADD and a.is_string() and b.is_string():
+                return "string"
+            return None
+        case OP.NEGATE:
+            return "number" if stack[-1].is_number() else None
+        case OP.GET_PROPERTY:
+            reciever = stack[-1]
+            if reciever.is_instance() and instruction[1] in reciever.as_.shape.slots:
+                return reciever.as_.shape
+            return None
+        case OP.SET_PROPERTY:
+            return "field" if stack[-2].is_instance() else None
+        case OP.JUMP_IF_FALSE | OP.JUMP_IF_TRUE | OP.POP_JUMP_IF_FALSE:
+            return isFalsey(stack[-1])
+    return None
+
+class TraceCompiler:
+    """Turns one recorded loop iteration into a Python function.
+
+    The trace is a straight line: every branch becomes a guard on the
+    direction it took while recording, and every operator a guard on the
+    operand types it saw. The function keeps running iterations until a
+    guard fails, then writes its state back onto the VM stack, points the
+    frame at the instruction to resume from and returns to the
+    interpreter. Frame slots below the loop's stack height live in Python
+    locals for the duration, like the temporaries above it.
+    """
+    def __init__(self, trace: list, height: int):
+        self.trace = trace
+        self.height = height
+        self.lines = []
+        self.constants = []
+
+        self.read = set()
+        self.written = set()
+        for ip, instruction, seen in trace:
+            if instruction[0] == OP.GET_LOCAL and instruction[1] < height:
+                self.read.add(instruction[1])
+            if instruction[0] == OP.SET_LOCAL and instruction[1] < height:
+                self.written.add(instruction[1])
+            # A cell slot is only ever read: writes go into the cell.
+            if (instruction[0] in (OP.GET_LOCAL_CELL, OP.SET_LOCAL_CELL) and
+                    instruction[1] < height):
+                self.read.add(instruction[1])
+        self.read |= self.written
+
+    def constant(self, value):
+        for i, constant in enumerate(self.constants):
+            if constant is value: return f"k{i}"
+        self.constants.append(value)
+        return f"k{len(self.constants) - 1}"
+
+    def emit(self, indent: int, line: str):
+        self.lines.append("    " * indent + line)
+
+    def flush(self, indent: int):
+        for slot in sorted(self.written):
+            self.emit(indent, f"stack[base + {slot}] = s{slot}")
+
+    def reload(self, indent: int):
+        for slot in sorted(self.read):
+            self.emit(indent, f"s{slot} = stack[base + {slot}]")
+
+    def exit(self, indent: int, ip: int, depth: int):
+        self.flush(indent)
+        if depth > self.height:
+            temporaries = ", ".join(f"s{i}" for i in range(self.height, depth))
+            self.emit(indent, f"stack.extend(({temporaries},))")
+        self.emit(indent, f"frame.ip = {ip}")
+        self.emit(indent, "return None")
+
+    def guard(self, indent: int, condition: str, ip: int, depth: int):
+        self.emit(indent, f"if not ({condition}):")
+        self.exit(indent + 1, ip, depth)
+
+    def compile(self):
+        self.emit(1, "stack = vm.stack")
+        self.emit(1, "globals_ = vm.globals")
+        self.emit(1, "upvalues = frame.closure.upvalues")
+        self.emit(1, "base = frame.slots")
+        self.reload(1)
+        self.emit(1, "while True:")
+
+        depth = self.height
+        boolean = None
+        for ip, instruction, seen in self.trace:
+            boolean = self.emitInstruction(ip, instruction, seen, depth, 2, boolean)
+            depth += stackEffect(instruction)
+
+        params = ", ".join(f"k{i}" for i in range(len(self.constants)))
+        source = [f"def make({params}):", "  def trace(vm, frame):"]
+        source += ["  " + line for line in self.lines]
+        source.append("  return trace")
+        return "\n".join(source) + "\n", self.constants
+
+    def emitInstruction(self, ip: int, instruction: tuple, seen, depth: int,
+                        indent: int, boolean: str):
+        """Emit one instruction, returning the slot it left a known
+        TRUE/FALSE in, if any."""
+        emit = lambda line: self.emit(indent, line)
+        top = f"s{depth}"
+        a = f"s{depth - 2}"
+        b = f"s{depth - 1}"
+        match instruction[0]:
+            case OP.CONSTANT: emit(f"{top} = {self.constant(instruction[1])}")
+            case OP.NIL: emit(f"{top} = NIL")
+            case OP.TRUE: emit(f"{top} = TRUE")
+            case OP.FALSE: emit(f"{top} = FALSE")
+            case OP.POP: pass
+            case OP.GET_LOCAL: emit(f"{top} = s{instruction[1]}")
+            case OP.SET_LOCAL: emit(f"s{instruction[1]} = {b}")
+            case OP.GET_GLOBAL:
+                emit(f"{top} = globals_[{instruction[1]}]")
+                self.guard(indent, f"{top} is not UNDEFINED", ip, depth)
+            case OP.SET_GLOBAL:
+                self.guard(indent, f"globals_[{instruction[1]}] is not UNDEFINED", ip, depth)
+                emit(f"globals_[{instruction[1]}] = {b}")
+            case OP.DEFINE_GLOBAL: emit(f"globals_[{instruction[1]}] = {b}")
+            case OP.GET_UPVALUE: emit(f"{top} = upvalues[{instruction[1]}]")
+            case OP.GET_CELL: emit(f"{top} = upvalues[{instruction[1]}].value")
+            case OP.SET_CELL: emit(f"upvalues[{instruction[1]}].value = {b}")
+            case OP.GET_LOCAL_CELL: emit(f"{top} = s{instruction[1]}.value")
+            case OP.SET_LOCAL_CELL: emit(f"s{instruction[1]}.value = {b}")
+            case OP.GET_PROPERTY:
+                self.guard(indent, f"{b}.is_instance() and {b}.as_.shape is {self.constant(seen)}",
+                           ip, depth)
+                emit(f"{b} = {b}.as_.values[{seen.slots[instruction[1]]}]")
+            case OP.SET_PROPERTY:
+                self.guard(indent, f"{a}.is_instance()", ip, depth)
+                emit(f"{a}.as_.setField({instruction[1]!r}, {b})")
+                emit(f"{a} = {b}")
+            case OP.EQUAL | OP.NOT_EQUAL:
+                equal, unequal = "TRUE", "FALSE"
+                if instruction[0] == OP.NOT_EQUAL: equal, unequal = unequal, equal
+                if seen == "number":
+                    self.guard(indent, f"{a}.type is NUMBER_T and {b}.type is NUMBER_T", ip, depth)
+                    emit(f"{a} = {equal} if {a}.as_ == {b}.as_ else {unequal}")
+                else:
+                    emit(f"{a} = {equal} if {a} == {b} else {unequal}")
+                return a
+            case (OP.GREATER | OP.GREATER_EQUAL | OP.LESS | OP.LESS_EQUAL |
+                  OP.SUBTRACT | OP.MULTIPLY | OP.DIVIDE):
+                self.guard(indent, f"{a}.type is NUMBER_T and {b}.type is NUMBER_T", ip, depth)
+                match instruction[0]:
+                    case OP.GREATER:
+                        emit(f"{a} = TRUE if {a}.as_ > {b}.as_ else FALSE")
+                        return a
+                    case OP.GREATER_EQUAL:
+                        emit(f"{a} = FALSE if {a}.as_ < {b}.as_ else TRUE")
+                        return a
+                    case OP.LESS:
+                        emit(f"{a} = TRUE if {a}.as_ < {b}.as_ else FALSE")
+                        return a
+                    case OP.LESS_EQUAL:
+                        emit(f"{a} = FALSE if {a}.as_ > {b}.as_ else TRUE")
+                        return a
+                    case OP.SUBTRACT: emit(f"{a} = Value(NUMBER_T, {a}.as_ - {b}.as_)")
+                    case OP.MULTIPLY: emit(f"{a} = Value(NUMBER_T, {a}.as_ * {b}.as_)")
+                    case OP.DIVIDE: emit(f"{a} = Value(NUMBER_T, div({a}.as_, {b}.as_))")
+            case OP.ADD:
+                if seen == "number":
+                    self.guard(indent, f"{a}.type is NUMBER_T and {b}.type is NUMBER_T", ip, depth)
+                    emit(f"{a} = Value(NUMBER_T, {a}.as_ + {b}.as_)")
+                else:
+                    self.guard(indent, f"{a}.is_string() and {b}.is_string()", ip, depth)
+                    emit(f"{a} = Value.from_obj(copyString(vm.strings, {a}.as_str() + {b}.as_str()))")
+            case OP.NOT:
+                emit(f"{b} = TRUE if {_falsey(b)} else FALSE")
+                return b
+            case OP.NEGATE:
+                self.guard(indent, f"{b}.type is NUMBER_T", ip, depth)
+                emit(f"{b} = Value(NUMBER_T, -{b}.as_)")
+            case OP.PRINT: emit(f"print({b}, file=stdout)")
+            case OP.JUMP_IF_FALSE | OP.JUMP_IF_TRUE | OP.POP_JUMP_IF_FALSE:
+                falsey = f"{b} is FALSE" if boolean == b else _falsey(b)
+                # Where the branch goes when the guard fails, and the stack
+                # it leaves there.
+                jumps = seen == (instruction[0] != OP.JUMP_IF_TRUE)
+                other = ip + 1 if jumps else instruction[1]
+                if instruction[0] == OP.POP_JUMP_IF_FALSE: depth -= 1
+                self.guard(indent, falsey if seen else f"not {falsey}", other, depth)
+            case OP.JUMP | OP.LOOP: pass
+            case OP.CALL | OP.INVOKE:
+                argCount = instruction[-1]
+                callee = depth - argCount - 1
+                window = ", ".join(f"s{i}" for i in range(callee, depth))
+                self.flush(indent)
+                emit(f"stack.extend(({window},))")
+                emit(f"frame.ip = {ip + 1}")
+                if instruction[0] == OP.CALL:
+                    emit(f"if not vm.callOut(frame, vm.callValue(stack[-{argCount + 1}], {argCount})):")
+                else:
+                    emit(f"if not vm.callOut(frame, vm.invoke({instruction[1]!r}, {argCount})):")
+                emit("    return INTERPRET.RUNTIME_ERROR")
+                emit(f"s{callee} = stack.pop()")
+                self.reload(indent)
+
+_namespace = {
+    "NIL": NIL, "TRUE": TRUE, "FALSE": FALSE,
+    "BOOL_T": VAL.BOOL, "NIL_T": VAL.NIL, "NUMBER_T": VAL.NUMBER,
+    "Value": Value, "ObjString": ObjString, "copyString": copyString, "UNDEFINED": UNDEFINED, "div": div, "stdout": stdout,
+    "INTERPRET": INTERPRET,
+}
+
+def compileTrace(trace: list, height: int):
+    source, constants = TraceCompiler(trace, height).compile()
+    if DEBUG_PRINT_CODE:
+        print("== trace ==", file=stdout)
+        print(source, file=stdout)
+
+    namespace = dict(_namespace)
+    exec(compile(source, "<lox trace>", "exec"), namespace)
+    return namespace["make"](*constants)
+
+class TracingVM(ThreadedVM):
+    """ThreadedVM with a tracing JIT for hot loops.
+
+    Each OP.LOOP counts how often its target is reached. Past HOT_LOOP,
+    the next iteration is recorded as it runs, together with the operand
+    types and branch directions it sees, and compiled by TraceCompiler
+    into a specialized loop. Later back-edges run that instead, until one
+    of its guards fails and the interpreter takes over again. Loops whose
+    iteration leaves the loop, returns, or hits an instruction outside
+    TRACEABLE are left interpreted for good.
+    """
+    def op_LOOP(self, instruction, next_):
+        loop = HotLoop(instruction[1])
+        def handler(frame):
+            frame.ip = loop.header
+            if loop.trace is not None:
+                return loop.trace(self, frame)
+            if loop.blacklisted: return
+            loop.count += 1
+            if loop.count >= HOT_LOOP:
+                return self.recordTrace(frame, loop)
+        return handler
+
+    def callOut(self, frame: CallFrame, called: bool):
+        # Finish a call made from a trace: a Lox function has only had its
+        # frame pushed, so run it to completion before carrying on.
+        if not called: return False
+        if self.frames[-1] is not frame:
+            return self.run(len(self.frames) - 1) == INTERPRET.OK
+        return True
+
+    def recordTrace(self, frame: CallFrame, loop: HotLoop):
+        chunk = frame.closure.function.chunk
+        decoded = chunk.decode()
+        code = self.threadedCode(chunk)
+        height = len(self.stack) - frame.slots
+        depth = len(self.frames)
+        trace = []
+
+        while True:
+            ip = frame.ip
+            instruction = decoded.code[ip]
+            op = instruction[0]
+            if op not in TRACEABLE or len(trace) == MAX_TRACE:
+                loop.blacklisted = True
+                return None
+
+            seen = observe(self, instruction)
+            if seen is None and op in NEEDS_TYPES:
+                # About to fail at runtime, or to bind a method: nothing
+                # worth specializing.
+                loop.blacklisted = True
+                return None
+            trace.append((ip, instruction, seen))
+            match op:
+                case OP.JUMP | OP.LOOP:
+                    frame.ip = instruction[1]
+                case OP.JUMP_IF_FALSE:
+                    frame.ip = instruction[1] if seen else ip + 1
+                case _:
+                    result = code[ip](frame)
+                    if result is FRAME_CHANGED and len(self.frames) > depth:
+                        result = self.run(depth)
+                    if result not in (None, FRAME_CHANGED, INTERPRET.OK):
+                        return result
+
+            if len(self.stack) - frame.slots < height:
+                loop.blacklisted = True
+                return None
+            if frame.ip == loop.header: break
+
+        loop.trace = compileTrace(trace, height)
+        return loop.trace(self, frame)
@@ -0,0 +1,264 @@
+import marshal
+from pathlib import Path
+import re
+import sys
+
+from cache import *
+from chunk import *
+from common import *
+from compiler import *
+from object import *
+from value import *
+
+# Links a Lox program split across files with //include lines into one
+# bundle that main.py runs without scanning or compiling anything.
+# tool/bin/impfix.py pastes the files together into one source instead;
+# here each file is compiled on its own, through the .loxc cache beside
+# it, so a rebuild only recompiles the files that changed. Top-level funs
+# and classes that nothing refers to are left out of the bundle.
+#
+#     python3 link.py main.lox out.loxb
+
+# 0xff never occurs in UTF-8, so no Lox source starts like a bundle.
+BUNDLE_MAGIC = b"\xffLOXB"
+INCLUDE = re.compile(r"//include (.+)")
+
+GLOBAL_OPS = (OP.GET_GLOBAL, OP.DEFINE_GLOBAL, OP.SET_GLOBAL)
+
+def includeOrder(path: Path, seen: set=None):
+    """(path, source) for the files path includes, directly or not, then
+    path itself: each file once, after everything it includes, in the
+    order impfix.py pastes them in."""
+    if seen is None: seen = set()
+    seen.add(path.resolve())
+    source = path.read_text()
+    order = []
+    for line in source.splitlines():
+        match = INCLUDE.search(line)
+        if match is None: continue
+        included = path.parent / match[1].strip()
+        if included.resolve() not in seen:
+            order += includeOrder(included, seen)
+    order.append((path, source))
+    return order
+
+class Definition:
+    """A top-level fun or class declaration: instructions start up to end
+    of a script chunk, which do nothing but create the global `name`."""
+    __slots__ = ("name", "start", "end", "superclass", "uses")
+
+    def __init__(self, name: str, start: int, end: int, superclass: str=None):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.superclass = superclass
+        # Globals the declaration's code, and the functions in it, refer to.
+        self.uses = set()
+
+def findDefinitions(code: list[tuple]):
+    """The declarations in decoded script code, by the exact instructions
+    the compiler emits for them. Anything else is left alone."""
+    definitions = []
+    ip = 0
+    while ip < len(code) - 1:
+        instruction, following = code[ip], code[ip + 1]
+        if (instruction[0] == OP.CLOSURE and following[0] == OP.DEFINE_GLOBAL and
+                instruction[1].name is not None and instruction[1].name.as_ == following[2]):
+            definitions.append(Definition(following[2], ip, ip + 2))
+            ip += 2
+        elif (instruction[0] == OP.CLASS and following[0] == OP.DEFINE_GLOBAL and
+                instruction[1] == following[2]):
+            definition = classDefinition(code, ip)
+            if definition is None:
+                ip += 1
+                continue
+            definitions.append(definition)
+            ip = definition.end
+        else:
+            ip += 1
+    return definitions
+
+def classDefinition(code: list[tuple], start: int):
+    name = code[start][1]
+    ip = start + 2
+    superclass = None
+    if (ip + 2 < len(code) and code[ip][0] == OP.GET_GLOBAL and
+            code[ip + 1][0] == OP.GET_GLOBAL and code[ip + 1][2] == name and
+            code[ip + 2][0] == OP.INHERIT):
+        superclass = code[ip][2]
+        ip += 3
+    if ip >= len(code) or code[ip][0] != OP.GET_GLOBAL or code[ip][2] != name:
+        return None
+    ip += 1
+    while ip + 1 < len(code) and code[ip][0] == OP.CLOSURE and code[ip + 1][0] == OP.METHOD:
+        ip += 2
+    # The class, and the scope holding "super".
+    for _ in range(1 if superclass is None else 2):
+        if ip >= len(code) or code[ip][0] != OP.POP: return None
+        ip += 1
+    return Definition(name, start, ip, superclass)
+
+def globalsUsed(code: list[tuple], uses: set):
+    """Add the globals code refers to, and the functions it creates do, to uses."""
+    for instruction in code:
+        if instruction[0] in (OP.GET_GLOBAL, OP.SET_GLOBAL):
+            uses.add(instruction[2])
+        elif instruction[0] == OP.CLOSURE:
+            globalsUsed(DecodedChunk(instruction[1].chunk).code, uses)
+
+def globalsAssigned(code: list[tuple], counts: dict):
+    """Count the instructions in code, and in the functions it creates,
+    that give each global a value."""
+    for instruction in code:
+        if instruction[0] in (OP.DEFINE_GLOBAL, OP.SET_GLOBAL):
+            counts[instruction[2]] = counts.get(instruction[2], 0) + 1
+        elif instruction[0] == OP.CLOSURE:
+            globalsAssigned(DecodedChunk(instruction[1].chunk).code, counts)
+
+def crosses(code: list[tuple], start: int, end: int):
+    """Whether some jump in code would land somewhere else once
+    instructions start up to end are taken out."""
+    for ip, instruction in enumerate(code):
+        if instruction[0] not in JUMPS: continue
+        target = instruction[-1]
+        if not (ip < start and target <= start or ip >= end and target >= end):
+            return True
+    return False
+
+def removeUnused(scripts: list[ObjFunction]):
+    """Take the declarations of globals nothing refers to out of the
+    script functions, returning their names.
+
+    A global is used if code outside the declarations refers to it, or
+    the declaration of a used global does. Inheriting could be a runtime
+    error the program relies on, so a subclass is only dropped when its
+    superclass is declared as a class before it and nothing else gives
+    that global a value: then it still holds the class when the subclass
+    is declared.
+    """
+    decodedChunks = [DecodedChunk(script.chunk) for script in scripts]
+    assigned = {}
+    for decoded in decodedChunks:
+        globalsAssigned(decoded.code, assigned)
+
+    used = set()
+    classes = set()
+    chunks = []
+    for script, decoded in zip(scripts, decodedChunks):
+        code = decoded.code
+        found = []
+        for definition in findDefinitions(code):
+            if definition.superclass is not None and (definition.superclass not in classes or
+                                                      assigned[definition.superclass] > 1):
+                continue
+            if crosses(code, definition.start, definition.end):
+                continue
+            globalsUsed(code[definition.start:definition.end], definition.uses)
+            if code[definition.start][0] == OP.CLASS:
+                classes.add(definition.name)
+            found.append(definition)
+        chunks.append((script.chunk, decoded, found))
+
+        ip = 0
+        for definition in found:
+            globalsUsed(code[ip:definition.start], used)
+            ip = definition.end
+        globalsUsed(code[ip:], used)
+
+    work = list(used)
+    while work:
+        name = work.pop()
+        for _, _, found in chunks:
+            for definition in found:
+                if definition.name != name: continue
+                for use in definition.uses - used:
+                    used.add(use)
+                    work.append(use)
+
+    removed = []
+    for chunk, decoded, found in chunks:
+        offsets = decoded.offsets + [len(chunk.code)]
+        for definition in reversed(found):
+            if definition.name in used: continue
+            # The functions made here are only ever made here.
+            for ip in range(definition.start, definition.end):
+                if decoded.code[ip][0] == OP.CLOSURE:
+                    chunk.constants[chunk.code[offsets[ip] + 1]] = Value.nil()
+            chunk.remove(offsets[definition.start], offsets[definition.end])
+            removed.append(definition.name)
+    return removed
+
+def relink(function: ObjFunction, compiler: Compiler):
+    """Point the global variable instructions in function, and the
+    functions nested in it, at compiler's slots for their names."""
+    chunk = function.chunk
+    decoded = DecodedChunk(chunk)
+    for offset, instruction in zip(decoded.offsets, decoded.code):
+        if instruction[0] in GLOBAL_OPS:
+            slot = compiler.globalSlot(instruction[2])
+            chunk.code[offset + 2] = slot >> 8
+            chunk.code[offset + 3] = slot & 0xff
+    chunk.decoded = None
+    chunk.fusedDecoded = None
+    for constant in chunk.constants:
+        if constant.is_function():
+            relink(constant.as_function(), compiler)
+
+def link(path: Path):
+    """The script function of each file in path's program, in the order
+    they run, with unused declarations taken out; None if one of them
+    doesn't compile."""
+    scripts = []
+    for file, source in includeOrder(path):
+        # Each file gets a compiler of its own, so the cache beside it
+        # doesn't depend on what was compiled before it.
+        function = BytecodeCache(cachePath(str(file))).compile(Compiler(TYPE.SCRIPT), source)
+        if function is None: return None
+        scripts.append(function)
+    removeUnused(scripts)
+    return scripts
+
+def isBundle(path: str):
+    try:
+        with open(path, "rb") as file:
+            return file.read(len(BUNDLE_MAGIC)) == BUNDLE_MAGIC
+    except OSError:
+        return False
+
+def writeBundle(path: str, scripts: list[ObjFunction]):
+    data = (FORMAT_VERSION, sys.version_info[:2],
+            tuple(dumpFunction(script) for script in scripts))
+    with open(path, "wb") as file:
+        file.write(BUNDLE_MAGIC)
+        marshal.dump(data, file)
+
+def loadBundle(path: str, compiler: Compiler):
+    """The script functions in the bundle at path, with their strings
+    interned in and their globals given slots by compiler; None if the
+    file isn't a bundle this pylox can read."""
+    try:
+        with open(path, "rb") as file:
+            if file.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC: return None
+            version, pythonVersion, data = marshal.load(file)
+        if (version, pythonVersion) != (FORMAT_VERSION, sys.version_info[:2]): return None
+        scripts = [loadFunction(script, compiler.strings) for script in data]
+    except Exception:
+        return None
+
+    for script in scripts:
+        relink(script, compiler)
+    return scripts
+
+def main(argv: list[str]):
+    if len(argv) != 3:
+        print("Usage: link.py path bundle", file=sys.stderr)
+        exit(64)
+
+    scripts = link(Path(argv[1]))
+    if scripts is None:
+        print(stderr.getvalue(), end="", file=sys.stderr)
+        exit(65)
+    writeBundle(argv[2], scripts)
+
+if __name__=="__main__":
+    main(sys.argv)
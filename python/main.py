@@ -1,8 +1,29 @@
+import os
 from sys import argv
 
+from cache import *
 from common import *
+from ir import *
+from jit import *
+from link import *
+from register import *
+from threaded import *
+from transpiler import *
+from unboxed import *
 from vm import *
 
+ENGINES = {
+    "--threaded": ThreadedVM,
+    "--transpile": TranspilingVM,
+    "--jit": TracingVM,
+    "--register": RegisterVM,
+    "--unboxed": UnboxedVM,
+}
+
+# Files bigger than this, in bytes, are compiled as they are read instead
+# of being read into memory first.
+STREAM_THRESHOLD = 1 << 20
+
 def repl(vm: VM):
     while True:
         line = input("> ")
@@ -20,22 +41,57 @@ def readFile(path: str):
 
     return buffer
 
-def runFile(vm: VM, path: str):
-    source = readFile(path)
-    result = vm.interpret(source)
+def runBundle(vm: VM, path: str):
+    scripts = loadBundle(path, vm.compiler)
+    if scripts is None:
+        print(f"Could not read bundle \"{path}\".", file=stderr)
+        exit(74)
+
+    result = INTERPRET.OK
+    for script in scripts:
+        result = vm.execute(script)
+        if result != INTERPRET.OK: break
+    return result
+
+def runFile(vm: VM, path: str, cache: bool=False):
+    if isBundle(path):
+        result = runBundle(vm, path)
+    else:
+        if os.path.getsize(path) > STREAM_THRESHOLD:
+            source = SourceFile(path)
+        else:
+            source = readFile(path)
+        if cache: vm.cache = BytecodeCache(cachePath(path))
+        result = vm.interpret(source)
 
     if result == INTERPRET.COMPILE_ERROR: exit(65)
     if result == INTERPRET.RUNTIME_ERROR: exit(70)
 
 def main(argc: int, argv: list[str]):
-    vm = VM()
+    engine = VM
+    compiler = None
+    cache = False
+    while argc > 1 and argv[1].startswith("--"):
+        if argv[1] == "--ir":
+            compiler = IRCompiler()
+        elif argv[1] == "--cache":
+            cache = True
+        elif argv[1] in ENGINES:
+            engine = ENGINES[argv[1]]
+        else:
+            print(f"Unknown option '{argv[1]}'.", file=stderr)
+            exit(64)
+        argv.pop(1)
+        argc -= 1
+
+    vm = engine(compiler)
 
     if argc == 1:
         repl(vm)
     elif argc == 2:
-        runFile(vm, argv[1])
+        runFile(vm, argv[1], cache)
     else:
-        print("Usage: pylox [path]", file=stderr)
+        print("Usage: pylox [--threaded | --transpile | --jit | --register | --unboxed] [--ir] [--cache] [path]", file=stderr)
 
 if __name__=="__main__":
     try:
@@ -0,0 +1,98 @@
+from pathlib import Path
+import resource
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+# Reports the memory each script given on the command line needs: the
+# process's peak RSS, and the peak bytes tracemalloc sees allocated while
+# the script runs. Each measurement gets a fresh interpreter, since peak
+# RSS never goes down and tracemalloc's own bookkeeping would inflate it.
+# A leading engine option from main.py picks the VM, as for pylox; the
+# stack VM runs without one.
+#
+# With --against REV the scripts are also run by the pylox in git
+# revision REV, for a before and after: against the commit before
+# __slots__, say, whose objects each carry a __dict__.
+#
+#     python3 memory.py [--against REV] [engine option] path...
+
+ROOT = Path(__file__).resolve().parent
+
+def measure(kind: str, flag: str, path: str, root: str):
+    # Import pylox from root instead of from beside this file.
+    sys.path[0] = root
+    import main
+    import vm
+
+    engines = getattr(main, "ENGINES", {})
+    if flag != "" and flag not in engines:
+        print(f"Unknown engine option '{flag}'.", file=sys.stderr)
+        exit(64)
+    engine = engines.get(flag, vm.VM)
+    source = Path(path).read_text()
+    machine = engine()
+    if kind == "traced":
+        tracemalloc.start()
+        machine.interpret(source)
+        print(tracemalloc.get_traced_memory()[1])
+    else:
+        machine.interpret(source)
+        # ru_maxrss is in kilobytes on Linux.
+        print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+def child(kind: str, flag: str, path: str, root: Path):
+    result = subprocess.run(
+        [sys.executable, __file__, "--measure", kind, flag, str(Path(path).resolve()), str(root)],
+        capture_output=True, text=True, cwd=root)
+    if result.returncode != 0:
+        print(result.stderr, file=sys.stderr, end="")
+        return None
+    return int(result.stdout)
+
+def checkout(revision: str, directory: str):
+    """The python directory of git revision `revision`, extracted into
+    directory; None if git can't find it."""
+    archive = subprocess.run(["git", "archive", revision, "python"],
+                             capture_output=True, cwd=ROOT.parent)
+    if archive.returncode != 0:
+        print(archive.stderr.decode(), file=sys.stderr, end="")
+        return None
+    subprocess.run(["tar", "-x", "-C", directory], input=archive.stdout, check=True)
+    return Path(directory) / "python"
+
+if len(sys.argv) > 1 and sys.argv[1] == "--measure":
+    measure(*sys.argv[2:])
+    exit()
+
+paths = sys.argv[1:]
+revision = None
+if len(paths) > 1 and paths[0] == "--against":
+    revision = paths[1]
+    del paths[:2]
+flag = ""
+if len(paths) > 0 and paths[0].startswith("--"):
+    flag = paths.pop(0)
+if len(paths) == 0:
+    print("Usage: memory.py [--against REV] [engine option] path...", file=sys.stderr)
+    exit(64)
+from main import ENGINES
+if flag != "" and flag not in ENGINES:
+    print(f"Unknown engine option '{flag}'.", file=sys.stderr)
+    exit(64)
+
+trees = [("current", ROOT)]
+with tempfile.TemporaryDirectory() as directory:
+    if revision is not None:
+        before = checkout(revision, directory)
+        if before is None: exit(74)
+        trees.insert(0, ("before", before))
+
+    print("%-24s %-8s %14s %16s" % ("script", "tree", "peak RSS (KiB)", "traced (KiB)"))
+    for path in paths:
+        for name, root in trees:
+            rss = child("rss", flag, path, root)
+            traced = child("traced", flag, path, root)
+            if rss is None or traced is None: continue
+            print("%-24s %-8s %14d %16d" % (Path(path).name, name, rss // 1024, traced // 1024))
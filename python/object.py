@@ -12,17 +12,29 @@ class OBJ(enum):
     FUNCTION = enum_auto()
     NATIVE = enum_auto()
     STRING = enum_auto()
-    UPVALUE = enum_auto()
+    CELL = enum_auto()
 
 class Obj:
+    __slots__ = ("type", "as_")
+
     def __init__(self, value=None):
-        if isinstance(value, Obj): # TODO: move this check to __new__
-            self.type = value.type # would have to learn __new__ though
-            self.as_ = value.as_
+        if isinstance(value, Obj):
+            self.copyFrom(value)
             return
         self.type = None
         self.as_ = value
 
+    def copyFrom(self, other):
+        """Copy another Obj's type and payload, and the rest of its slots if
+        it is the same kind of Obj. Returns whether it was."""
+        self.type = other.type
+        self.as_ = other.as_
+        if not isinstance(other, type(self)): return False
+        for slot in type(self).__slots__:
+            if slot not in Obj.__slots__:
+                setattr(self, slot, getattr(other, slot))
+        return True
+
     def __str__(self):
         return f"{self.as_}"
 
@@ -31,57 +43,86 @@ class Obj:
         if self.type != other.type: return False
         return self.as_ == other.as_
 
+class Shape:
+    """Field layout shared by the instances that were given the same fields
+    in the same order. `slots` maps each field name to its index in an
+    instance's `values`; `transitions` remembers the shape adding one more
+    field leads to, so instances built the same way end up sharing it."""
+    __slots__ = ("slots", "transitions")
+
+    def __init__(self, slots: dict=None):
+        self.slots = {} if slots is None else slots
+        self.transitions = {}
+
+    def adding(self, name: str):
+        shape = self.transitions.get(name)
+        if shape is None:
+            slots = dict(self.slots)
+            slots[name] = len(slots)
+            shape = self.transitions[name] = Shape(slots)
+        return shape
+
 class ObjClass(Obj):
+    __slots__ = ("name", "methods", "shape")
+
     def __init__(self, value=None):
-        if isinstance(value, Obj): # TODO: move this check to __new__
-            self.type = value.type # would have to learn __new__ though
-            self.as_ = value.as_
-            if isinstance(value, ObjClass):
-                self.name = value.name
-                self.methods = value.methods
-                return
+        if isinstance(value, Obj):
+            if self.copyFrom(value): return
         else:
             self.type = OBJ.CLASS
             self.as_ = value
         self.name = value
         self.methods = {}
+        # Each class has its own shape tree, so an instance's shape also
+        # pins down its class.
+        self.shape = Shape()
 
     def __str__(self):
         return f"{self.name}"
 
 class ObjInstance(Obj):
+    __slots__ = ("klass", "shape", "values")
+
     def __init__(self, value=None):
-        if isinstance(value, Obj):          # TODO: move this check to __new__
-            if isinstance(value, ObjClass): # would have to learn __new__ though
-                self.type = OBJ.INSTANCE
-                self.as_ = value
-                self.klass = value
-                self.fields = {}
-                return
-            self.type = value.type
-            self.as_ = value.as_
-            if isinstance(value, ObjInstance):
-                self.klass = value.klass
-                self.fields = value.fields
-                return
+        if isinstance(value, ObjClass):
+            self.type = OBJ.INSTANCE
+            self.as_ = value
+            self.klass = value
+            self.shape = value.shape
+            self.values = []
+            return
+        if isinstance(value, Obj):
+            if self.copyFrom(value): return
         else:
             self.type = OBJ.INSTANCE
             self.as_ = value
         self.klass = value
-        self.fields = {}
+        self.shape = Shape()
+        self.values = []
 
     def __str__(self):
         return f"{self.klass.name} instance"
 
+    def field(self, name: str):
+        """The value of a field, or None if the instance has no such field."""
+        index = self.shape.slots.get(name)
+        if index is None: return None
+        return self.values[index]
+
+    def setField(self, name: str, value):
+        index = self.shape.slots.get(name)
+        if index is None:
+            self.shape = self.shape.adding(name)
+            self.values.append(value)
+        else:
+            self.values[index] = value
+
 class ObjBoundMethod(Obj):
+    __slots__ = ("reciever", "method")
+
     def __init__(self, value=None, method=None):
-        if isinstance(value, Obj): # TODO: move this check to __new__
-            self.type = value.type # would have to learn __new__ though
-            self.as_ = value.as_
-            if isinstance(value, ObjBoundMethod):
-                self.reciever = value.reciever
-                self.method = value.method
-                return
+        if isinstance(value, Obj):
+            if self.copyFrom(value): return
         else:
             self.type = OBJ.BOUND_METHOD
             self.as_ = method
@@ -91,27 +132,25 @@ class ObjBoundMethod(Obj):
     def __str__(self):
         return str(self.method)
 
+    # Every binding shares the method's closure, so two bound methods are
+    # only equal when they are the same binding.
     def __eq__(self, other):
-        if not isinstance(other, Obj): return False
-        if self.type != other.type: return False
-        return self.as_ is other.as_
+        return self is other
 
 class ObjFunction(Obj):
+    __slots__ = ("arity", "upvalueCount", "maxStack", "chunk", "name")
+
     def __init__(self, value=None):
-        if isinstance(value, Obj): # TODO: move this check to __new__
-            self.type = value.type # would have to learn __new__ though
-            self.as_ = value.as_
-            if isinstance(value, ObjFunction):
-                self.arity = value.arity
-                self.upvalueCount = value.upvalueCount
-                self.chunk = value.chunk
-                self.name = value.name
-                return
+        if isinstance(value, Obj):
+            if self.copyFrom(value): return
         else:
             self.type = OBJ.FUNCTION
             self.as_ = value
         self.arity = 0
         self.upvalueCount = 0
+        # Stack slots a frame running it can fill, from its own slot 0 up;
+        # set by the compiler once the chunk is final.
+        self.maxStack = 1
         self.chunk = chunk.Chunk()
         self.name = None
 
@@ -121,22 +160,17 @@ class ObjFunction(Obj):
         return f"<fn {self.name}>"
 
 class ObjClosure(Obj):
+    __slots__ = ("function", "upvalues")
+
     def __init__(self, value: ObjFunction):
-        if isinstance(value, Obj):             # TODO: move this check to __new__
-            if isinstance(value, ObjFunction): # would have to learn __new__ though
-                self.type = OBJ.CLOSURE
-                self.as_ = value
-                self.function = value
-                self.upvalues = []
-                for i in range(value.upvalueCount):
-                    self.upvalues.append(None)
-                return
-            self.type = value.type
-            self.as_ = value.as_
-            if isinstance(value, ObjClosure):
-                self.function = value.function
-                self.upvalues = value.upvalues
-                return
+        if isinstance(value, ObjFunction):
+            self.type = OBJ.CLOSURE
+            self.as_ = value
+            self.function = value
+            self.upvalues = [None] * value.upvalueCount
+            return
+        if isinstance(value, Obj):
+            if self.copyFrom(value): return
         else:
             self.type = OBJ.CLOSURE
             self.as_ = value
@@ -146,34 +180,26 @@ class ObjClosure(Obj):
     def __str__(self):
         return str(self.function)
 
-class ObjUpvalue(Obj):
-    def __init__(self, value: int):
-        if isinstance(value, Obj): # TODO: move this check to __new__
-            self.type = value.type # would have to learn __new__ though
-            self.as_ = value.as_
-            if isinstance(value, ObjUpvalue):
-                self.location = value.location
-                self.closed = value.closed
-                self.next = value.next
-                return
-        else:
-            self.type = OBJ.UPVALUE
-            self.as_ = value
-        self.location = value
-        self.closed = v.Value.nil()
-        self.next = None
+class ObjCell(Obj):
+    """A local that closures capture and that is assigned after they do,
+    boxed from its declaration on so the frame declaring it and every
+    closure capturing it share one value. Never a Lox value itself."""
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.type = OBJ.CELL
+        self.as_ = None
+        self.value = value
 
     def __str__(self):
-        return "upvalue"
+        return "cell"
 
 class ObjNative(Obj):
+    __slots__ = ("function",)
+
     def __init__(self, value: FunctionType):
-        if isinstance(value, Obj): # TODO: move this check to __new__
-            self.type = value.type # would have to learn __new__ though
-            self.as_ = value.as_
-            if isinstance(value, ObjNative):
-                self.function = value.function
-            else: self.function = None
+        if isinstance(value, Obj):
+            if not self.copyFrom(value): self.function = None
         else:
             self.type = OBJ.NATIVE
             self.as_ = value
@@ -185,13 +211,11 @@ class ObjNative(Obj):
         return f"<native fn>"
 
 class ObjString(Obj):
+    __slots__ = ("hash_",)
+
     def __init__(self, value: str):
-        if isinstance(value, Obj): # TODO: move this check to __new__
-            self.type = value.type # would have to learn __new__ though
-            self.as_ = value.as_
-            if isinstance(value, ObjString):
-                self.hash_ = value.hash_
-                return
+        if isinstance(value, Obj):
+            if self.copyFrom(value): return
         else:
             self.type = OBJ.STRING
             self.as_ = value
@@ -200,9 +224,26 @@ class ObjString(Obj):
     def __str__(self):
         return self.as_
 
+    # Every ObjString a VM makes comes from copyString(), so two strings
+    # with the same characters are the same object.
+    def __eq__(self, other):
+        return self is other
+
+    def __hash__(self):
+        return self.hash_
+
     #def __hash__(self):
     #    hash = uint32_t(2166136261)
     #    for i in self.as_:
     #        hash ^= uint8_t(ord(i))
     #        hash *= 16777619
     #    return hash
+
+def copyString(strings: dict, chars: str):
+    """The canonical ObjString for `chars` in a strings table, making it
+    the first time those characters are seen."""
+    string = strings.get(chars)
+    if string is None:
+        string = ObjString(chars)
+        strings[chars] = string
+    return string
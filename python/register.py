@@ -0,0 +1,580 @@
+from chunk import *
+from common import *
+from debug import *
+from object import *
+from value import *
+from vm import *
+
+class ROP(enum):
+    MOVE = enum_auto()
+    GET_GLOBAL = enum_auto()
+    DEFINE_GLOBAL = enum_auto()
+    SET_GLOBAL = enum_auto()
+    GET_UPVALUE = enum_auto()
+    GET_CELL = enum_auto()
+    SET_CELL = enum_auto()
+    GET_LOCAL_CELL = enum_auto()
+    SET_LOCAL_CELL = enum_auto()
+    GET_PROPERTY = enum_auto()
+    SET_PROPERTY = enum_auto()
+    GET_SUPER = enum_auto()
+    EQUAL = enum_auto()
+    NOT_EQUAL = enum_auto()
+    GREATER = enum_auto()
+    GREATER_EQUAL = enum_auto()
+    LESS = enum_auto()
+    LESS_EQUAL = enum_auto()
+    ADD = enum_auto()
+    SUBTRACT = enum_auto()
+    MULTIPLY = enum_auto()
+    DIVIDE = enum_auto()
+    NOT = enum_auto()
+    NEGATE = enum_auto()
+    PRINT = enum_auto()
+    JUMP = enum_auto()
+    JUMP_IF_FALSE = enum_auto()
+    JUMP_IF_TRUE = enum_auto()
+    CALL = enum_auto()
+    INVOKE = enum_auto()
+    SUPER_INVOKE = enum_auto()
+    TAIL_CALL = enum_auto()
+    TAIL_INVOKE = enum_auto()
+    CLOSURE = enum_auto()
+    BOX = enum_auto()
+    RETURN = enum_auto()
+    CLASS = enum_auto()
+    INHERIT = enum_auto()
+    METHOD = enum_auto()
+
+BINARY = {
+    OP.EQUAL: ROP.EQUAL, OP.NOT_EQUAL: ROP.NOT_EQUAL,
+    OP.GREATER: ROP.GREATER, OP.GREATER_EQUAL: ROP.GREATER_EQUAL,
+    OP.LESS: ROP.LESS, OP.LESS_EQUAL: ROP.LESS_EQUAL, OP.ADD: ROP.ADD, OP.SUBTRACT: ROP.SUBTRACT,
+    OP.MULTIPLY: ROP.MULTIPLY, OP.DIVIDE: ROP.DIVIDE,
+}
+
+NIL = Value.nil()
+TRUE = Value.from_bool(True)
+FALSE = Value.from_bool(False)
+
+class RegisterCode:
+    """A function's three-address code for RegisterVM.
+
+    `code` has one tuple per instruction, starting with its ROP. Register
+    operands are frame slots: register n is `stack[frame.slots + n]`, the
+    same slot the stack machine would use at height n, so locals keep
+    their slot numbers. Source operands are "RK" ints: a register when
+    non-negative, otherwise `constants[~operand]`. `registers` is how many
+    slots a frame of this function needs.
+    """
+    def __init__(self):
+        self.code = []
+        self.lines = []
+        self.constants = []
+        self.registers = 1
+
+class RegisterTranslator:
+    """Turns one ObjFunction's decoded stack bytecode into RegisterCode.
+
+    The operand stack is simulated at translation time. Each entry holds
+    the RK operand its value can be read from: pushing a constant or a
+    local costs no instruction, and an operation reads its operands where
+    they already are and writes one register. An entry is "materialized"
+    when it lives in its own register, which every entry must at jump
+    targets, jumps and calls, and before a local it reads is reassigned.
+    """
+    def __init__(self, function: ObjFunction):
+        self.function = function
+        self.decoded = function.chunk.decode()
+        self.result = RegisterCode()
+        # Never fewer slots than the stack machine would use; the running
+        # maximum below only adds the slack of writing above the top.
+        self.result.registers = function.maxStack
+        # The callee (or receiver) and the arguments arrive in registers.
+        self.entries = list(range(function.arity + 1))
+        self.line = 0
+        self.fresh = None
+        self.starts = {}
+        self.jumps = []
+        self.constantIndexes = {}
+
+    def translate(self):
+        code = self.decoded.code
+        labels = set()
+        for instruction in code:
+            if instruction[0] in JUMPS:
+                labels.add(instruction[1])
+
+        heights = stackHeights(code, len(self.entries))
+
+        for ip, instruction in enumerate(code):
+            self.line = self.decoded.lines[ip]
+            if ip in labels:
+                if ip > 0 and code[ip - 1][0] in UNCONDITIONAL:
+                    # Only reachable by a jump, so take the stack height the
+                    # jumps to it leave.
+                    self.entries[:] = range(heights.get(ip, len(self.entries)))
+                self.flush()
+                self.fresh = None
+            self.starts[ip] = len(self.result.code)
+            self.translateInstruction(instruction)
+            self.result.registers = max(self.result.registers, len(self.entries))
+        self.starts[len(code)] = len(self.result.code)
+
+        for index in self.jumps:
+            instruction = self.result.code[index]
+            self.result.code[index] = instruction[:-1] + (self.starts[instruction[-1]],)
+        return self.result
+
+    def constant(self, value: Value):
+        index = self.constantIndexes.get(id(value))
+        if index is None:
+            index = len(self.result.constants)
+            self.result.constants.append(value)
+            self.constantIndexes[id(value)] = index
+        return ~index
+
+    def emit(self, *instruction):
+        self.result.code.append(instruction)
+        self.result.lines.append(self.line)
+        self.fresh = None
+        self.result.registers = max(self.result.registers, len(self.entries) + 1)
+
+    def emitTop(self, *instruction):
+        """Emit an instruction writing the register for a new top entry."""
+        self.emit(*instruction)
+        self.entries.append(instruction[1])
+        self.fresh = len(self.result.code)
+
+    def push(self, operand: int):
+        height = len(self.entries)
+        if operand >= height:
+            # Only lower registers are stable: a temporary above the new
+            # top is overwritten by the next push.
+            self.emit(ROP.MOVE, height, operand)
+            operand = height
+        self.entries.append(operand)
+
+    def materialize(self, slot: int):
+        if self.entries[slot] != slot:
+            self.emit(ROP.MOVE, slot, self.entries[slot])
+            self.entries[slot] = slot
+
+    def readers(self, register: int):
+        """Slots of the entries other than its own that read a register."""
+        return [slot for slot, operand in enumerate(self.entries)
+                if operand == register and slot != register]
+
+    def flush(self):
+        for slot in range(len(self.entries)):
+            self.materialize(slot)
+
+    def jump(self, *instruction):
+        self.jumps.append(len(self.result.code))
+        self.emit(*instruction)
+
+    def call(self, base: int, *instruction):
+        self.flush()
+        self.emit(*instruction)
+        del self.entries[base:]
+        self.entries.append(base)
+
+    def translateInstruction(self, instruction: tuple):
+        entries = self.entries
+        height = len(entries)
+        match instruction[0]:
+            case OP.CONSTANT: self.push(self.constant(instruction[1]))
+            case OP.NIL: self.push(self.constant(NIL))
+            case OP.TRUE: self.push(self.constant(TRUE))
+            case OP.FALSE: self.push(self.constant(FALSE))
+            case OP.POP: entries.pop()
+            case OP.GET_LOCAL: self.push(entries[instruction[1]])
+            case OP.SET_LOCAL:
+                slot = instruction[1]
+                value = entries[-1]
+                readers = self.readers(slot)
+                if (self.fresh == len(self.result.code) and value == height - 1
+                        and readers in ([], [height - 1])):
+                    # The value was just computed into a temporary: write it
+                    # into the local instead.
+                    last = self.result.code[-1]
+                    self.result.code[-1] = (last[0], slot) + last[2:]
+                else:
+                    for reader in readers:
+                        self.materialize(reader)
+                    self.emit(ROP.MOVE, slot, entries[-1])
+                entries[slot] = slot
+                entries[-1] = slot
+            case OP.GET_GLOBAL:
+                self.emitTop(ROP.GET_GLOBAL, height, instruction[1], instruction[2])
+            case OP.DEFINE_GLOBAL:
+                self.emit(ROP.DEFINE_GLOBAL, instruction[1], entries.pop())
+            case OP.SET_GLOBAL:
+                self.emit(ROP.SET_GLOBAL, instruction[1], entries[-1], instruction[2])
+            case OP.GET_UPVALUE | OP.GET_CELL | OP.GET_LOCAL_CELL:
+                self.emitTop(ROP[instruction[0].name], height, instruction[1])
+            case OP.SET_CELL | OP.SET_LOCAL_CELL:
+                self.emit(ROP[instruction[0].name], instruction[1], entries[-1])
+            case OP.GET_PROPERTY:
+                instance = entries.pop()
+                self.emitTop(ROP.GET_PROPERTY, height - 1, instance, instruction[1])
+            case OP.SET_PROPERTY:
+                value = entries.pop()
+                instance = entries.pop()
+                self.emit(ROP.SET_PROPERTY, instance, instruction[1], value)
+                self.push(value)
+            case OP.GET_SUPER:
+                superclass = entries.pop()
+                receiver = entries.pop()
+                self.emitTop(ROP.GET_SUPER, height - 2, receiver, superclass, instruction[1])
+            case OP.NOT | OP.NEGATE:
+                operand = entries.pop()
+                self.emitTop(ROP[instruction[0].name], height - 1, operand)
+            case OP.PRINT:
+                self.emit(ROP.PRINT, entries.pop())
+            case OP.JUMP | OP.LOOP:
+                self.flush()
+                self.jump(ROP.JUMP, instruction[1])
+            case OP.JUMP_IF_FALSE | OP.JUMP_IF_TRUE:
+                self.flush()
+                self.jump(ROP[instruction[0].name], height - 1, instruction[1])
+            case OP.POP_JUMP_IF_FALSE:
+                self.flush()
+                entries.pop()
+                self.jump(ROP.JUMP_IF_FALSE, height - 1, instruction[1])
+            case OP.CALL | OP.TAIL_CALL:
+                base = height - instruction[1] - 1
+                self.call(base, ROP[instruction[0].name], base, instruction[1])
+            case OP.INVOKE | OP.TAIL_INVOKE:
+                base = height - instruction[2] - 1
+                self.call(base, ROP[instruction[0].name], base, instruction[1], instruction[2])
+            case OP.SUPER_INVOKE:
+                base = height - instruction[2] - 2
+                self.call(base, ROP.SUPER_INVOKE, base, instruction[1], instruction[2])
+            case OP.CLOSURE:
+                for isLocal, index in instruction[2]:
+                    if isLocal: self.materialize(index)
+                self.emitTop(ROP.CLOSURE, height, instruction[1], instruction[2])
+            case OP.BOX:
+                # A local is boxed as soon as it is declared, before anything
+                # else can read its register.
+                self.materialize(instruction[1])
+                self.emit(ROP.BOX, instruction[1])
+            case OP.RETURN:
+                self.emit(ROP.RETURN, entries.pop())
+            case OP.CLASS:
+                self.emitTop(ROP.CLASS, height, instruction[1])
+            case OP.INHERIT:
+                subclass = entries.pop()
+                self.emit(ROP.INHERIT, entries[-1], subclass)
+            case OP.METHOD:
+                method = entries.pop()
+                self.emit(ROP.METHOD, entries[-1], method, instruction[1])
+            case op:
+                b = entries.pop()
+                a = entries.pop()
+                self.emitTop(BINARY[op], height - 2, a, b)
+
+def translate(function: ObjFunction):
+    result = RegisterTranslator(function).translate()
+    if DEBUG_PRINT_CODE:
+        disassembleRegisterCode(result, str(function))
+    return result
+
+class RegisterVM(VM):
+    """VM that runs three-address register code instead of the stack code.
+
+    Each function is translated from its decoded chunk the first time it
+    is called. A frame's registers are the stack slots from `frame.slots`
+    up, so calls, upvalues and runtime errors see the same slot layout as
+    in VM.run. The stack reaches at least `registers` past the running
+    frame's base. A call to a closure starts the callee's frame on the
+    registers the caller put it and its arguments in, and a return leaves
+    the result in the first of them; neither shrinks the stack. Other
+    calls find their arguments on top of the stack, so it is cut back to
+    them first.
+
+    The cases in run() come roughly in order of how often they run, since
+    each one costs a comparison for everything below it.
+    """
+    superinstructions = False
+
+    def __init__(self, compiler: Compiler=None, framesMax: int=FRAMES_MAX):
+        super().__init__(compiler, framesMax)
+        self.registerCodes = {}
+
+    def registerCode(self, function: ObjFunction):
+        decoded = function.chunk.decode()
+        cached = self.registerCodes.get(function.chunk)
+        if cached is None or cached[0] is not decoded:
+            cached = (decoded, translate(function))
+            self.registerCodes[function.chunk] = cached
+        return cached[1]
+
+    def instructionLine(self, frame: CallFrame):
+        return self.registerCode(frame.closure.function).lines[frame.ip - 1]
+
+    def reserve(self, top: int):
+        """Resize the stack to end at `top`, padding with nil."""
+        if len(self.stack) < top:
+            self.stack.extend([NIL] * (top - len(self.stack)))
+        else:
+            del self.stack[top:]
+
+    def run(self):
+        stack = self.stack
+        frame = self.frames[-1]
+        rcode = self.registerCode(frame.closure.function)
+        code = rcode.code
+        constants = rcode.constants
+        slots = frame.slots
+        ip = frame.ip
+        self.reserve(slots + rcode.registers)
+
+        while True:
+            instruction = code[ip]
+            ip += 1
+            match instruction[0]:
+                case ROP.MOVE:
+                    src = instruction[2]
+                    stack[slots + instruction[1]] = stack[slots + src] if src >= 0 else constants[~src]
+                case ROP.GET_GLOBAL:
+                    value = self.globals[instruction[2]]
+                    if value is UNDEFINED:
+                        frame.ip = ip
+                        self.runtimeError(f"Undefined variable '{instruction[3]}'.")
+                        return INTERPRET.RUNTIME_ERROR
+                    stack[slots + instruction[1]] = value
+                case (ROP.GREATER | ROP.GREATER_EQUAL | ROP.LESS | ROP.LESS_EQUAL |
+                      ROP.SUBTRACT | ROP.MULTIPLY | ROP.DIVIDE):
+                    src = instruction[2]
+                    a = stack[slots + src] if src >= 0 else constants[~src]
+                    src = instruction[3]
+                    b = stack[slots + src] if src >= 0 else constants[~src]
+                    if not (a.is_number() and b.is_number()):
+                        frame.ip = ip
+                        self.runtimeError("Operands must be numbers.")
+                        return INTERPRET.RUNTIME_ERROR
+                    match instruction[0]:
+                        case ROP.GREATER: result = TRUE if a.as_ > b.as_ else FALSE
+                        case ROP.GREATER_EQUAL: result = FALSE if a.as_ < b.as_ else TRUE
+                        case ROP.LESS: result = TRUE if a.as_ < b.as_ else FALSE
+                        case ROP.LESS_EQUAL: result = FALSE if a.as_ > b.as_ else TRUE
+                        case ROP.SUBTRACT: result = Value.from_float(a.as_ - b.as_)
+                        case ROP.MULTIPLY: result = Value.from_float(a.as_ * b.as_)
+                        case ROP.DIVIDE: result = Value.from_float(div(float(a), float(b)))
+                    stack[slots + instruction[1]] = result
+                case ROP.ADD:
+                    src = instruction[2]
+                    a = stack[slots + src] if src >= 0 else constants[~src]
+                    src = instruction[3]
+                    b = stack[slots + src] if src >= 0 else constants[~src]
+                    if a.is_number() and b.is_number():
+                        stack[slots + instruction[1]] = Value.from_float(a.as_ + b.as_)
+                    elif a.is_string() and b.is_string():
+                        stack[slots + instruction[1]] = Value.from_obj(copyString(self.strings, a.as_str() + b.as_str()))
+                    else:
+                        frame.ip = ip
+                        self.runtimeError(
+                            "Operands must be two numbers or two strings.")
+                        return INTERPRET.RUNTIME_ERROR
+                case ROP.JUMP_IF_FALSE:
+                    if isFalsey(stack[slots + instruction[1]]): ip = instruction[2]
+                case ROP.CALL | ROP.INVOKE | ROP.SUPER_INVOKE | ROP.TAIL_CALL | ROP.TAIL_INVOKE:
+                    frame.ip = ip
+                    base = slots + instruction[1]
+                    argCount = instruction[-1]
+
+                    closure = None
+                    if instruction[0] == ROP.CALL:
+                        callee = stack[base]
+                        if callee.is_closure(): closure = callee.as_
+                    elif instruction[0] == ROP.INVOKE:
+                        receiver = stack[base]
+                        if receiver.is_instance() and instruction[2] not in receiver.as_.shape.slots:
+                            method = receiver.as_.klass.methods.get(instruction[2])
+                            if method is not None: closure = method.as_
+                    if closure is not None and closure.function.arity == argCount:
+                        # The callee and its arguments already sit in the
+                        # registers its frame starts with; the stack only
+                        # grows if the new frame reaches past its end.
+                        if not self.pushFrame(closure, argCount, base):
+                            return INTERPRET.RUNTIME_ERROR
+                        frame = self.frames[-1]
+                        ip = 0
+                        slots = base
+                        rcode = self.registerCode(closure.function)
+                        code = rcode.code
+                        constants = rcode.constants
+                        top = slots + rcode.registers
+                        if len(stack) < top: stack.extend([NIL] * (top - len(stack)))
+                        continue
+
+                    # Anything else finds its arguments on top of the stack.
+                    depth = len(self.frames)
+                    match instruction[0]:
+                        case ROP.CALL:
+                            del stack[base + argCount + 1:]
+                            called = self.callValue(stack[base], argCount)
+                        case ROP.INVOKE:
+                            del stack[base + argCount + 1:]
+                            called = self.invoke(instruction[2], argCount)
+                        case ROP.TAIL_CALL:
+                            del stack[base + argCount + 1:]
+                            called = self.callValue(stack[base], argCount, True)
+                        case ROP.TAIL_INVOKE:
+                            del stack[base + argCount + 1:]
+                            called = self.invoke(instruction[2], argCount, True)
+                        case ROP.SUPER_INVOKE:
+                            del stack[base + argCount + 2:]
+                            superclass = stack.pop().as_class()
+                            called = self.invokeFromClass(superclass, instruction[2], argCount)
+                    if not called:
+                        return INTERPRET.RUNTIME_ERROR
+                    # A tail call to a function restarts the frame at ip 0.
+                    if len(self.frames) > depth or frame.ip == 0:
+                        frame = self.frames[-1]
+                        ip = frame.ip
+                        slots = frame.slots
+                        rcode = self.registerCode(frame.closure.function)
+                        code = rcode.code
+                        constants = rcode.constants
+                    self.reserve(slots + rcode.registers)
+                case ROP.RETURN:
+                    src = instruction[1]
+                    result = stack[slots + src] if src >= 0 else constants[~src]
+                    self.frames.pop()
+                    if len(self.frames) == 0:
+                        del stack[slots:]
+                        return INTERPRET.OK
+
+                    # The caller reads the result from the register the
+                    # callee's frame started at. Whatever the callee left
+                    # above it is dead, and is overwritten before it is read.
+                    stack[slots] = result
+                    frame = self.frames[-1]
+                    ip = frame.ip
+                    slots = frame.slots
+                    rcode = self.registerCode(frame.closure.function)
+                    code = rcode.code
+                    constants = rcode.constants
+                    top = slots + rcode.registers
+                    if len(stack) < top: stack.extend([NIL] * (top - len(stack)))
+                case ROP.JUMP:
+                    ip = instruction[1]
+                case ROP.GET_PROPERTY:
+                    src = instruction[2]
+                    receiver = stack[slots + src] if src >= 0 else constants[~src]
+                    if not receiver.is_instance():
+                        frame.ip = ip
+                        self.runtimeError("Only instances have properties.")
+                        return INTERPRET.RUNTIME_ERROR
+
+                    instance = receiver.as_instance()
+                    name = instruction[3]
+                    index = instance.shape.slots.get(name)
+                    if index is not None:
+                        stack[slots + instruction[1]] = instance.values[index]
+                        continue
+
+                    frame.ip = ip
+                    stack.append(receiver)
+                    if not self.bindMethod(instance.klass, name):
+                        return INTERPRET.RUNTIME_ERROR
+                    stack[slots + instruction[1]] = stack.pop()
+                case ROP.SET_PROPERTY:
+                    src = instruction[1]
+                    receiver = stack[slots + src] if src >= 0 else constants[~src]
+                    if not receiver.is_instance():
+                        frame.ip = ip
+                        self.runtimeError("Only instances have fields.")
+                        return INTERPRET.RUNTIME_ERROR
+
+                    src = instruction[3]
+                    value = stack[slots + src] if src >= 0 else constants[~src]
+                    receiver.as_instance().setField(instruction[2], value)
+                case ROP.EQUAL | ROP.NOT_EQUAL:
+                    src = instruction[2]
+                    a = stack[slots + src] if src >= 0 else constants[~src]
+                    src = instruction[3]
+                    b = stack[slots + src] if src >= 0 else constants[~src]
+                    if instruction[0] == ROP.EQUAL:
+                        stack[slots + instruction[1]] = TRUE if a == b else FALSE
+                    else:
+                        stack[slots + instruction[1]] = FALSE if a == b else TRUE
+                case ROP.GET_UPVALUE:
+                    stack[slots + instruction[1]] = frame.closure.upvalues[instruction[2]]
+                case ROP.GET_CELL:
+                    stack[slots + instruction[1]] = frame.closure.upvalues[instruction[2]].value
+                case ROP.GET_LOCAL_CELL:
+                    stack[slots + instruction[1]] = stack[slots + instruction[2]].value
+                case ROP.SET_LOCAL_CELL:
+                    src = instruction[2]
+                    value = stack[slots + src] if src >= 0 else constants[~src]
+                    stack[slots + instruction[1]].value = value
+                case ROP.SET_CELL:
+                    src = instruction[2]
+                    value = stack[slots + src] if src >= 0 else constants[~src]
+                    frame.closure.upvalues[instruction[1]].value = value
+                case ROP.JUMP_IF_TRUE:
+                    if not isFalsey(stack[slots + instruction[1]]): ip = instruction[2]
+                case ROP.NOT:
+                    src = instruction[2]
+                    value = stack[slots + src] if src >= 0 else constants[~src]
+                    stack[slots + instruction[1]] = TRUE if isFalsey(value) else FALSE
+                case ROP.NEGATE:
+                    src = instruction[2]
+                    value = stack[slots + src] if src >= 0 else constants[~src]
+                    if not value.is_number():
+                        frame.ip = ip
+                        self.runtimeError("Operand must be a number.")
+                        return INTERPRET.RUNTIME_ERROR
+                    stack[slots + instruction[1]] = Value.from_float(-float(value))
+                case ROP.SET_GLOBAL:
+                    if self.globals[instruction[1]] is UNDEFINED:
+                        frame.ip = ip
+                        self.runtimeError(f"Undefined variable '{instruction[3]}'.")
+                        return INTERPRET.RUNTIME_ERROR
+                    src = instruction[2]
+                    self.globals[instruction[1]] = stack[slots + src] if src >= 0 else constants[~src]
+                case ROP.DEFINE_GLOBAL:
+                    src = instruction[2]
+                    self.globals[instruction[1]] = stack[slots + src] if src >= 0 else constants[~src]
+                case ROP.GET_SUPER:
+                    src = instruction[2]
+                    receiver = stack[slots + src] if src >= 0 else constants[~src]
+                    src = instruction[3]
+                    superclass = stack[slots + src] if src >= 0 else constants[~src]
+                    frame.ip = ip
+                    stack.append(receiver)
+                    if not self.bindMethod(superclass.as_class(), instruction[4]):
+                        return INTERPRET.RUNTIME_ERROR
+                    stack[slots + instruction[1]] = stack.pop()
+                case ROP.PRINT:
+                    src = instruction[1]
+                    print(stack[slots + src] if src >= 0 else constants[~src], file=stdout)
+                case ROP.CLOSURE:
+                    closure = ObjClosure(instruction[2])
+                    stack[slots + instruction[1]] = Value.from_obj(closure)
+                    for i, (isLocal, index) in enumerate(instruction[3]):
+                        if isLocal:
+                            closure.upvalues[i] = stack[slots + index]
+                        else:
+                            closure.upvalues[i] = frame.closure.upvalues[index]
+                case ROP.BOX:
+                    stack[slots + instruction[1]] = ObjCell(stack[slots + instruction[1]])
+                case ROP.CLASS:
+                    stack[slots + instruction[1]] = Value.from_obj(ObjClass(instruction[2]))
+                case ROP.INHERIT:
+                    src = instruction[1]
+                    superclass = stack[slots + src] if src >= 0 else constants[~src]
+                    if not superclass.is_class():
+                        frame.ip = ip
+                        self.runtimeError("Superclass must be a class.")
+                        return INTERPRET.RUNTIME_ERROR
+
+                    subclass = stack[slots + instruction[2]].as_class()
+                    subclass.methods.update(superclass.as_class().methods)
+                case ROP.METHOD:
+                    klass = stack[slots + instruction[1]].as_class()
+                    klass.methods[instruction[3]] = stack[slots + instruction[2]]
@@ -0,0 +1,295 @@
+from scanner import *
+
+# Decides, before a script is compiled, which of its local variables live
+# in cells. A closure gets a copy of each local it captures, made when the
+# closure is created. That copy is only right if the local is never
+# assigned once a closure may hold it; the locals that are assigned later
+# than that are boxed in a cell shared by the frame and the closures.
+#
+# The resolver reads the tokens the compiler will read, following only
+# declarations, scopes, loops and variable names. It doesn't report
+# errors: the compiler does, and then the cells don't matter.
+
+# Where an expression ends, outside any parentheses.
+EXPRESSION_END = (TOKEN.SEMICOLON, TOKEN.RIGHT_PAREN, TOKEN.LEFT_BRACE, TOKEN.RIGHT_BRACE)
+
+class ResolvedLocal:
+    """A local variable, numbered in the order the compiler declares
+    locals in (Compiler.declared)."""
+    __slots__ = ("index", "position", "function", "captured", "assigned", "isCell")
+
+    def __init__(self, index: int, position: int, function):
+        self.index = index
+        self.position = position
+        self.function = function
+        # The earliest position in the declaring function at which a
+        # closure may already hold a copy, and the last position the
+        # declaring function assigns it at.
+        self.captured = None
+        self.assigned = -1
+        self.isCell = False
+
+class ResolvedFunction:
+    __slots__ = ("enclosing", "locals", "scopeDepth", "loops", "captures", "selfName", "selfLocal")
+
+    def __init__(self, enclosing, selfName: str=None, selfLocal: ResolvedLocal=None):
+        self.enclosing = enclosing
+        # (name, depth, ResolvedLocal), innermost last.
+        self.locals = []
+        self.scopeDepth = 0
+        # Positions the loops being resolved start at, outermost first.
+        self.loops = []
+        # The locals of enclosing functions this one, or a function in it,
+        # refers to, by index.
+        self.captures = {}
+        # A local function's own local, which its body reads from the
+        # closure in slot 0 instead; see Compiler.function_().
+        self.selfName = selfName
+        self.selfLocal = selfLocal
+
+class Resolver:
+    def __init__(self, scanner):
+        self.scanner = scanner
+        self.previous = None
+        self.current = scanner.scanToken()
+        # Tokens read so far, which orders declarations, assignments,
+        # closures and loops within a function.
+        self.position = 0
+        self.count = 0
+        self.function = ResolvedFunction(None)
+        self.cells = set()
+
+    def resolve(self):
+        """The indexes of the locals that need cells."""
+        while not self.check(TOKEN.EOF):
+            self.declaration()
+        return self.cells
+
+    def advance(self):
+        self.previous = self.current
+        if self.current.type != TOKEN.EOF:
+            self.current = self.scanner.scanToken()
+            self.position += 1
+
+    def check(self, type: TOKEN):
+        return self.current.type == type
+
+    def match(self, type: TOKEN):
+        if not self.check(type): return False
+        self.advance()
+        return True
+
+    def beginScope(self):
+        self.function.scopeDepth += 1
+
+    def endScope(self):
+        function = self.function
+        function.scopeDepth -= 1
+        while len(function.locals) > 0 and function.locals[-1][1] > function.scopeDepth:
+            function.locals.pop()
+
+    def declare(self, name: str):
+        """The local declared here, or None for a global."""
+        function = self.function
+        if function.enclosing is None and function.scopeDepth == 0: return None
+        local = ResolvedLocal(self.count, self.position, function)
+        self.count += 1
+        function.locals.append((name, function.scopeDepth, local))
+        return local
+
+    def box(self, local: ResolvedLocal):
+        if not local.isCell:
+            local.isCell = True
+            self.cells.add(local.index)
+
+    def capture(self, local: ResolvedLocal, position: int):
+        """A closure holding a copy of local is made at position in the
+        declaring function."""
+        if local.captured is None or position < local.captured:
+            local.captured = position
+        if local.assigned > local.captured:
+            self.box(local)
+
+    def lookup(self, name: str):
+        """The local name refers to, and whether it is a local function's
+        own, read from its closure; None for a global."""
+        function = self.function
+        while function is not None:
+            for localName, _, local in reversed(function.locals):
+                if localName == name: return local, False
+            if function.selfName == name: return function.selfLocal, True
+            function = function.enclosing
+        return None, False
+
+    def variable(self, name: str, assign: bool):
+        local, isSelf = self.lookup(name)
+        if local is None: return
+
+        if isSelf:
+            # The closure exists from the declaration on.
+            self.capture(local, local.position)
+            if assign: self.box(local)
+        elif local.function is self.function:
+            if assign:
+                local.assigned = self.position
+                if local.captured is not None: self.box(local)
+        else:
+            # Only a cell can be assigned through a closure.
+            if assign: self.box(local)
+            self.function.captures[local.index] = local
+
+    def expression(self):
+        """Skip an expression, resolving the variables in it. Reads at least
+        one token, so that a statement can't stall on a stray one."""
+        start = self.position
+        depth = 0
+        while not self.check(TOKEN.EOF):
+            type = self.current.type
+            if type == TOKEN.IDENTIFIER:
+                isProperty = self.previous is not None and self.previous.type == TOKEN.DOT
+                self.advance()
+                if not isProperty:
+                    self.variable(self.previous.source, self.check(TOKEN.EQUAL))
+                continue
+            if depth == 0 and type in EXPRESSION_END and self.position > start: return
+            if type == TOKEN.LEFT_PAREN:
+                depth += 1
+            elif type == TOKEN.RIGHT_PAREN:
+                depth -= 1
+            self.advance()
+
+    def function_(self, selfName: str=None, selfLocal: ResolvedLocal=None):
+        function = ResolvedFunction(self.function, selfName, selfLocal)
+        self.function = function
+        self.beginScope()
+
+        if self.match(TOKEN.LEFT_PAREN) and not self.check(TOKEN.RIGHT_PAREN):
+            while self.match(TOKEN.IDENTIFIER):
+                self.declare(self.previous.source)
+                if not self.match(TOKEN.COMMA): break
+        self.match(TOKEN.RIGHT_PAREN)
+        if self.match(TOKEN.LEFT_BRACE): self.block()
+
+        # The closure is made here, copying what it captures.
+        self.function = function.enclosing
+        for local in function.captures.values():
+            if local.function is not self.function:
+                self.function.captures[local.index] = local
+                continue
+            position = self.position
+            for start in self.function.loops:
+                # A loop it is made in may come round to the code before
+                # it again, without declaring the local anew.
+                if start > local.position:
+                    position = start
+                    break
+            self.capture(local, position)
+
+    def classDeclaration(self):
+        if not self.match(TOKEN.IDENTIFIER): return
+        self.declare(self.previous.source)
+
+        hasSuperclass = False
+        if self.match(TOKEN.LESS):
+            if self.match(TOKEN.IDENTIFIER):
+                self.variable(self.previous.source, False)
+            self.beginScope()
+            self.declare("super")
+            hasSuperclass = True
+
+        if self.match(TOKEN.LEFT_BRACE):
+            while not self.check(TOKEN.RIGHT_BRACE) and not self.check(TOKEN.EOF):
+                if self.match(TOKEN.IDENTIFIER):
+                    self.function_()
+                else:
+                    self.advance()
+            self.match(TOKEN.RIGHT_BRACE)
+
+        if hasSuperclass: self.endScope()
+
+    def funDeclaration(self):
+        if not self.match(TOKEN.IDENTIFIER): return
+        name = self.previous.source
+        local = self.declare(name)
+        if local is None:
+            self.function_()
+        else:
+            self.function_(name, local)
+
+    def varDeclaration(self):
+        if self.match(TOKEN.IDENTIFIER):
+            self.declare(self.previous.source)
+        if self.match(TOKEN.EQUAL): self.expression()
+        self.match(TOKEN.SEMICOLON)
+
+    def declaration(self):
+        if self.match(TOKEN.CLASS):
+            self.classDeclaration()
+        elif self.match(TOKEN.FUN):
+            self.funDeclaration()
+        elif self.match(TOKEN.VAR):
+            self.varDeclaration()
+        else:
+            self.statement()
+
+    def block(self):
+        while not self.check(TOKEN.RIGHT_BRACE) and not self.check(TOKEN.EOF):
+            self.declaration()
+        self.match(TOKEN.RIGHT_BRACE)
+
+    def forStatement(self):
+        self.beginScope()
+        self.match(TOKEN.LEFT_PAREN)
+        if self.match(TOKEN.SEMICOLON):
+            pass # No initializer.
+        elif self.match(TOKEN.VAR):
+            self.varDeclaration()
+        else:
+            self.expression()
+            self.match(TOKEN.SEMICOLON)
+
+        # The increment runs after the body, so the loop starts here.
+        self.function.loops.append(self.position)
+        if not self.match(TOKEN.SEMICOLON):
+            self.expression()
+            self.match(TOKEN.SEMICOLON)
+        if not self.match(TOKEN.RIGHT_PAREN):
+            self.expression()
+            self.match(TOKEN.RIGHT_PAREN)
+        self.statement()
+        self.function.loops.pop()
+        self.endScope()
+
+    def whileStatement(self):
+        self.function.loops.append(self.position)
+        self.match(TOKEN.LEFT_PAREN)
+        self.expression()
+        self.match(TOKEN.RIGHT_PAREN)
+        self.statement()
+        self.function.loops.pop()
+
+    def statement(self):
+        if self.match(TOKEN.PRINT):
+            self.expression()
+            self.match(TOKEN.SEMICOLON)
+        elif self.match(TOKEN.FOR):
+            self.forStatement()
+        elif self.match(TOKEN.IF):
+            self.match(TOKEN.LEFT_PAREN)
+            self.expression()
+            self.match(TOKEN.RIGHT_PAREN)
+            self.statement()
+            if self.match(TOKEN.ELSE): self.statement()
+        elif self.match(TOKEN.RETURN):
+            if not self.match(TOKEN.SEMICOLON):
+                self.expression()
+                self.match(TOKEN.SEMICOLON)
+        elif self.match(TOKEN.WHILE):
+            self.whileStatement()
+        elif self.match(TOKEN.LEFT_BRACE):
+            self.beginScope()
+            self.block()
+            self.endScope()
+        else:
+            self.expression()
+            self.match(TOKEN.SEMICOLON)
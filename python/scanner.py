@@ -1,3 +1,9 @@
+import codecs
+import io
+import locale
+import mmap
+import re
+
 from common import *
 from scanner import *
 
@@ -54,15 +60,18 @@ class TOKEN(enum):
 
 class _tsynth:
     source = ""
+    base = 0
     start = 0
     current = 0
     line = None
 
 class Token:
+    __slots__ = ("type", "source", "start", "line")
+
     def __init__(self, scanner, type: TOKEN):
         self.type = type
         self.source = scanner.source[scanner.start:scanner.current]
-        self.start = scanner.start
+        self.start = scanner.base + scanner.start
         self.line = scanner.line
 
     @staticmethod
@@ -91,6 +100,8 @@ def isAlpha(c: str):
 class Scanner:
     def __init__(self, source: str):
         self.source = source
+        # Where source starts in the whole text; see StreamScanner.
+        self.base = 0
         self.start = 0
         self.current = 0
         self.line = 1
@@ -231,3 +242,171 @@ class Scanner:
             case '"': return self.string()
 
         return Token.error(self, "Unexpected character.")
+
+# Characters a StreamScanner reads at a time.
+SOURCE_CHUNK = 1 << 16
+
+class StreamScanner(Scanner):
+    """Scanner over text that arrives in chunks, for sources too big to
+    hold as one str.
+
+    `source` is a window on the text that is topped up with the next
+    chunk whenever scanning runs off its end. The text before the current
+    token is dropped from it then, so a token split between two chunks
+    is scanned whole and the window never holds much more than a chunk
+    and the longest token, comment or run of whitespace. Everything else
+    is Scanner's, so tokens, lines and errors come out the same.
+    """
+    def __init__(self, chunks):
+        super().__init__("")
+        self.chunks = iter(chunks)
+
+    def isAtEnd(self, offset: int=0):
+        if self.current + offset < len(self.source): return False
+        return not self.fill(self.current + offset)
+
+    def fill(self, index: int):
+        """Read chunks until the window reaches index, returning whether it did."""
+        if self.start > 0:
+            self.source = self.source[self.start:]
+            self.base += self.start
+            self.current -= self.start
+            index -= self.start
+            self.start = 0
+        while index >= len(self.source):
+            chunk = next(self.chunks, "")
+            if not chunk: return False
+            self.source += chunk
+        return True
+
+class SourceFile:
+    """A script file to be scanned a chunk at a time instead of read into
+    one str first. chunks() can be called again for another pass over it.
+
+    The chunks join up to exactly the text readFile() would return: a
+    file that can be mapped is decoded with the same encoding and the
+    same newline translation as reading it in text mode does, and one
+    that can't be is read in text mode.
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def chunks(self):
+        with open(self.path, "rb") as file:
+            try:
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                mapped = None
+            if mapped is not None:
+                with mapped:
+                    yield from self.decode(mapped)
+                return
+
+        with open(self.path, "r") as file:
+            while chunk := file.read(SOURCE_CHUNK):
+                yield chunk
+
+    def decode(self, mapped: mmap.mmap):
+        decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))()
+        decoder = io.IncrementalNewlineDecoder(decoder, translate=True)
+        for offset in range(0, len(mapped), SOURCE_CHUNK):
+            chunk = decoder.decode(mapped[offset:offset + SOURCE_CHUNK])
+            if chunk: yield chunk
+        chunk = decoder.decode(b"", final=True)
+        if chunk: yield chunk
+
+KEYWORDS = {
+    "and": TOKEN.AND, "class": TOKEN.CLASS, "else": TOKEN.ELSE,
+    "false": TOKEN.FALSE, "for": TOKEN.FOR, "fun": TOKEN.FUN, "if": TOKEN.IF,
+    "nil": TOKEN.NIL, "or": TOKEN.OR, "print": TOKEN.PRINT,
+    "return": TOKEN.RETURN, "super": TOKEN.SUPER, "this": TOKEN.THIS,
+    "true": TOKEN.TRUE, "var": TOKEN.VAR, "while": TOKEN.WHILE,
+}
+
+PUNCTUATION = {
+    "(": TOKEN.LEFT_PAREN, ")": TOKEN.RIGHT_PAREN,
+    "{": TOKEN.LEFT_BRACE, "}": TOKEN.RIGHT_BRACE,
+    ";": TOKEN.SEMICOLON, ",": TOKEN.COMMA, ".": TOKEN.DOT,
+    "-": TOKEN.MINUS, "+": TOKEN.PLUS, "/": TOKEN.SLASH, "*": TOKEN.STAR,
+    "!": TOKEN.BANG, "!=": TOKEN.BANG_EQUAL,
+    "=": TOKEN.EQUAL, "==": TOKEN.EQUAL_EQUAL,
+    "<": TOKEN.LESS, "<=": TOKEN.LESS_EQUAL,
+    ">": TOKEN.GREATER, ">=": TOKEN.GREATER_EQUAL,
+}
+
+# Each thing scanToken() reads in one go, as one group. A string may be
+# missing its closing quote, and the last group is any other character.
+# The character classes are spelled out because isAlpha() and isDigit()
+# only take ASCII.
+LEXEME = re.compile(r"""
+    (?P<space>(?:[ \t\r\n]+|//[^\n]*)+)
+  | (?P<identifier>[A-Za-z_][A-Za-z_0-9]*)
+  | (?P<number>[0-9]+(?:\.[0-9]+)?)
+  | (?P<string>"[^"]*"?)
+  | (?P<punctuation>[!=<>]=?|[-(){};,.+/*])
+  | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
+def tokenize(source: str):
+    """Every token Scanner(source).scanToken() returns, up to and
+    including EOF, in one pass over source with LEXEME."""
+    tokens = []
+    append = tokens.append
+    new = Token.__new__
+    line = 1
+    for match in LEXEME.finditer(source):
+        group = match.lastgroup
+        text = match.group()
+        if group == "space":
+            line += text.count("\n")
+            continue
+
+        token = new(Token)
+        token.source = text
+        token.start = match.start()
+        if group == "identifier":
+            token.type = KEYWORDS.get(text, TOKEN.IDENTIFIER)
+        elif group == "punctuation":
+            token.type = PUNCTUATION[text]
+        elif group == "number":
+            token.type = TOKEN.NUMBER
+        elif group == "string":
+            line += text.count("\n")
+            if len(text) > 1 and text[-1] == '"':
+                token.type = TOKEN.STRING
+            else:
+                token.type = TOKEN.ERROR
+                token.source = "Unterminated string."
+                token.start = 0
+        else:
+            token.type = TOKEN.ERROR
+            token.source = "Unexpected character."
+            token.start = 0
+        token.line = line
+        append(token)
+
+    token = new(Token)
+    token.type = TOKEN.EOF
+    token.source = ""
+    token.start = len(source)
+    token.line = line
+    append(token)
+    return tokens
+
+class TokenStream:
+    """Stands in for the Scanner, handing out a list of tokens."""
+    def __init__(self, tokens: list):
+        self.tokens = tokens
+        self.current = 0
+
+    def scanToken(self):
+        token = self.tokens[self.current]
+        if token.type != TOKEN.EOF: self.current += 1
+        return token
+
+def scannerFor(source):
+    """A scanner over source: a str, tokenized all at once, a SourceFile
+    to scan as it is read, or a list of tokens already scanned."""
+    if isinstance(source, SourceFile): return StreamScanner(source.chunks())
+    if isinstance(source, list): return TokenStream(source)
+    return TokenStream(tokenize(source))
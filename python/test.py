@@ -2,12 +2,40 @@ from pathlib import Path
 import sys
 import re
 
-def runFile(path):
+def engine():
+    if "--threaded" in sys.argv:
+        import threaded
+        vmClass = threaded.ThreadedVM
+    elif "--jit" in sys.argv:
+        import jit
+        vmClass = jit.TracingVM
+    elif "--register" in sys.argv:
+        import register
+        vmClass = register.RegisterVM
+    elif "--unboxed" in sys.argv:
+        import unboxed
+        vmClass = unboxed.UnboxedVM
+    elif "--transpile" in sys.argv:
+        import transpiler
+        vmClass = transpiler.TranspilingVM
+    else:
+        import vm
+        vmClass = vm.VM
+    if "--ir" in sys.argv:
+        import ir
+        return lambda: vmClass(ir.IRCompiler())
+    return vmClass
+
+def runFile(path, engine=engine):
     with path.open() as p:
         b=p.read()
+    return captureOutput(lambda: engine()().interpret(b))
+
+def captureOutput(run):
+    """What run() prints to stdout and stderr, clearing both after."""
     import common
     import vm
-    vm.VM().interpret(b)
+    run()
     common.stdout.seek(0)
     common.stderr.seek(0)
     _to,_te=common.stdout.read(),common.stderr.read()
@@ -189,12 +217,242 @@ failed = 0
 skipped = 0
 expectations = 0
 
+def diffTest(path):
+    # Differential check: the selected engine must print exactly what the
+    # stack VM prints, errors included.
+    if "test/benchmark" in str(path): return
+
+    import vm
+    expected = runFile(path, lambda: vm.VM)
+    actual = runFile(path)
+
+    global passed, failed
+
+    if actual == expected:
+        passed += 1
+    else:
+        failed += 1
+        print(f"DIFF {path}")
+        for name, e, a in zip(("stdout", "stderr"), expected, actual):
+            if e != a:
+                print(f"     expected {name} {e!r}")
+                print(f"     got      {name} {a!r}")
+        print()
+
 for path in (Path("../test").rglob("*.lox")):
     #print(path)
-    runTest(path)
+    if "--diff" in sys.argv:
+        diffTest(path)
+    else:
+        runTest(path)
+
+# Checks of what the .lox tests can't reach, each returning its failures.
+
+def checkBytecodeCache():
+    # A .loxc file is only used for the source it was compiled from, and
+    # a stale or unreadable one is recompiled over.
+    import tempfile
+    import cache
+    import compiler
+    source = 'var a = "cached"; fun f(n) { return n + 1; } print a; print f(2);'
+    failures = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = str(Path(directory) / "script.loxc")
+        bytecodeCache = cache.BytecodeCache(path)
+        expected = captureOutput(lambda: engine()().interpret(source))
+
+        vm = engine()()
+        if bytecodeCache.compile(vm.compiler, source) is None:
+            return ["Could not compile the script."]
+        vm = engine()()
+        function = bytecodeCache.load(vm.compiler, source)
+        if function is None:
+            failures.append("A fresh .loxc file was not used.")
+        elif captureOutput(lambda: vm.execute(function)) != expected:
+            failures.append("A script loaded from its .loxc file printed something else.")
+
+        if bytecodeCache.load(engine()().compiler, source + " print 3;") is not None:
+            failures.append("A .loxc file was used for source it wasn't compiled from.")
+
+        # The cached slots don't fit a compiler that gave "a" another one.
+        vm = engine()()
+        vm.compiler.globalSlot("other")
+        slots = dict(vm.compiler.globalSlots)
+        if bytecodeCache.load(vm.compiler, source) is not None:
+            failures.append("A .loxc file was used with globals in other slots.")
+        if vm.compiler.globalSlots != slots:
+            failures.append("A rejected .loxc file gave out global slots.")
+
+        with open(path, "r+b") as file:
+            data = file.read()
+            file.seek(0)
+            file.truncate()
+            file.write(data[:len(data) // 2])
+        if bytecodeCache.load(engine()().compiler, source) is not None:
+            failures.append("A truncated .loxc file was used.")
+        vm = engine()()
+        vm.cache = bytecodeCache
+        if captureOutput(lambda: vm.interpret(source)) != expected:
+            failures.append("A script with a corrupt .loxc file printed something else.")
+        if bytecodeCache.load(engine()().compiler, source) is None:
+            failures.append("A corrupt .loxc file was not written over.")
+    return failures
+
+# //include programs for checkBundle, as {file name: source}, each
+# starting from main.lox.
+BUNDLED_PROGRAMS = [
+    {
+        "util.lox": 'fun twice(x) { return x + x; }\n'
+                    'fun unused() { print "unused"; }\n',
+        "shapes.lox": '//include util.lox\n'
+                      'class Shape { init(n) { this.n = n; } size() { return twice(this.n); } }\n'
+                      'class Square < Shape { size() { return super.size() * 2; } }\n'
+                      'class Unused < Shape {}\n'
+                      'var made = 0;\n',
+        "main.lox": '//include shapes.lox\n'
+                    'print Square(3).size();\n'
+                    'made = made + 1;\n'
+                    'print made;\n'
+                    'print twice("ab");\n',
+    },
+    # The unused subclass has to stay, for its runtime error.
+    {
+        "base.lox": 'class Base {}\n'
+                    'Base = "not a class";\n',
+        "main.lox": '//include base.lox\n'
+                    'print "before";\n'
+                    'class Unused < Base {}\n'
+                    'print "after";\n',
+    },
+]
+
+def checkBundle():
+    # A program linked into a .loxb bundle prints what the one source
+    # tool/bin/impfix.py pastes its files into does. The files are
+    # compiled apart, so only the lines of runtime errors may differ.
+    import tempfile
+    import link
+    sys.path.append(str(Path(__file__).resolve().parent.parent / "tool" / "bin"))
+    import impfix
+    import vm as stackVM
+
+    def withoutLines(output):
+        stdout, stderr = output
+        return stdout, [line for line in stderr.splitlines()
+                        if stackTracePattern.search(line) is None]
+
+    failures = []
+    for files in BUNDLED_PROGRAMS:
+        with tempfile.TemporaryDirectory() as directory:
+            directory = Path(directory)
+            for name, source in files.items():
+                (directory / name).write_text(source)
+            main = str(directory / "main.lox")
+            pasted = directory / "pasted.lox"
+            impfix.main(main, str(pasted))
+            expected = captureOutput(lambda: engine()().interpret(pasted.read_text()))
+
+            scripts = link.link(Path(main))
+            if scripts is None: return ["Could not link the program."]
+            bundle = str(directory / "main.loxb")
+            link.writeBundle(bundle, scripts)
+            if not link.isBundle(bundle): return ["The bundle isn't recognized as one."]
+
+            def runBundle():
+                vm = engine()()
+                for script in link.loadBundle(bundle, vm.compiler):
+                    if vm.execute(script) != stackVM.INTERPRET.OK: break
+            actual = captureOutput(runBundle)
+        if withoutLines(actual) != withoutLines(expected):
+            failures.append(f"Bundle printed {actual!r}, impfix.py output {expected!r}.")
+
+    # Source that starts like the bundle magic is still run as source.
+    with tempfile.TemporaryDirectory() as directory:
+        script = Path(directory) / "script.lox"
+        script.write_text("LOXB = 1;\n")
+        if link.isBundle(str(script)): return ["A script starting LOXB is taken for a bundle."]
+        import main as pylox
+        status = None
+        def runScript():
+            nonlocal status
+            try:
+                pylox.runFile(engine()(), str(script))
+            except SystemExit as exit:
+                status = exit.code
+        _, error = captureOutput(runScript)
+    if status != 70 or not error.startswith("Undefined variable 'LOXB'."):
+        failures.append(f"A script starting LOXB exited {status} with {error!r}.")
+    return failures
+
+def scanTokens(scanner):
+    """(type, source, start, line) of each token up to and including EOF."""
+    import scanner as scanning
+    tokens = []
+    while True:
+        token = scanner.scanToken()
+        tokens.append((token.type, token.source, token.start, token.line))
+        if token.type == scanning.TOKEN.EOF: return tokens
+
+LEXEMES = ('var answer = 42.5; // comment\n'
+           'print "two\nlines" >= != == <= ! 1.a .5 123abc;\n'
+           '  \t\r\n'
+           'fun f_1() { return this.x / y * -z; } @ "unterminated\n')
+
+def checkStreamScanner():
+    # However the text is split into chunks, StreamScanner returns the
+    # tokens Scanner does, including those that straddle a chunk boundary.
+    import scanner
+    expected = scanTokens(scanner.Scanner(LEXEMES))
+    splits = [[LEXEMES[:i], LEXEMES[i:]] for i in range(len(LEXEMES) + 1)]
+    for size in range(1, 8):
+        splits.append([LEXEMES[i:i + size] for i in range(0, len(LEXEMES), size)])
+    failures = []
+    for chunks in splits:
+        if scanTokens(scanner.StreamScanner(chunks)) != expected:
+            failures.append(f"Tokens differ for chunks {chunks!r}.")
+    return failures[:10]
+
+EDGE_LEXEMES = ["", " ", "1.", "1.a", ".5", "1..2", "12.34.5", "123abc", "a_1 _b",
+                '"', '"abc', '"a\nb" c', '""', "//", "// x", "//c\n1", "/ /", "!===",
+                "<==>", "=!", "\u00e9", "\0", "\u0661", "andy and orchid or",
+                "class classy nil_ true1 this_", "\r\n\t", "a\rb", LEXEMES]
+
+def checkTokenize():
+    # tokenize() returns the tokens Scanner does, one by one.
+    import scanner
+    failures = []
+    for source in EDGE_LEXEMES:
+        expected = scanTokens(scanner.Scanner(source))
+        actual = [(token.type, token.source, token.start, token.line)
+                  for token in scanner.tokenize(source)]
+        if actual != expected:
+            failures.append(f"Tokens differ for {source!r}: {actual!r}, "
+                            f"Scanner {expected!r}.")
+    return failures
+
+checks = [checkBytecodeCache, checkBundle, checkStreamScanner, checkTokenize]
+
+def runCheck(check):
+    global passed, failed
+
+    failures = check()
+    if len(failures) == 0:
+        passed += 1
+    else:
+        failed += 1
+        print(f"FAIL {check.__name__}")
+        for failure in failures:
+            print(f"     {failure}")
+        print()
+
+if "--diff" not in sys.argv:
+    for check in checks:
+        runCheck(check)
 
 print(f"Passed: {passed} Failed: {failed} Skipped: {skipped}")
-if failed == 0:
+if failed == 0 and "--diff" in sys.argv:
+    print(f"All {passed} tests match the stack VM.")
+elif failed == 0:
     print(f"All {passed} tests passed ({expectations} expectations).")
 else:
     print(f"{passed} tests passed. {failed} tests failed.")
@@ -0,0 +1,671 @@
+from chunk import *
+from common import *
+from object import *
+from value import *
+from vm import *
+
+# Returned by handlers that push or pop a CallFrame, so the dispatch loop
+# knows to reload the current frame and its handler list.
+FRAME_CHANGED = object()
+
+# Runs of a generic handler before it specializes itself, and how many more
+# it waits after a failed attempt or a deoptimization.
+QUICKEN_WARMUP = 8
+QUICKEN_BACKOFF = 64
+
+class ThreadedVM(VM):
+    """VM that runs each chunk as a list of pre-bound handler callables.
+
+    A chunk is threaded once from its DecodedChunk, the first time a frame
+    runs it. Every instruction becomes a closure over its operands and the
+    index of the next instruction, so dispatch is a list index and a call
+    instead of a match on OP.
+
+    OP.ADD, OP.SUBTRACT, the ordering comparisons, OP.CALL and OP.INVOKE
+    quicken: once warm, the handler replaces itself in the chunk's
+    handler list with a form specialized for the operands it saw, such as
+    ADD_NUM or CALL_CLOSURE_EXACT_ARITY. A specialized handler only guards
+    on what it assumed and, when that fails, puts the generic handler back
+    and runs it.
+    """
+    superinstructions = False
+
+    def __init__(self, compiler: Compiler=None, framesMax: int=FRAMES_MAX):
+        super().__init__(compiler, framesMax)
+        self.threadedChunks = {}
+
+    def threadedCode(self, chunk: Chunk):
+        decoded = chunk.decode()
+        cached = self.threadedChunks.get(chunk)
+        if cached is None or cached[0] is not decoded:
+            # The REPL recompiles into the same script chunk, so the handlers
+            # are only reused while the chunk's decoded form is.
+            cached = (decoded, self.threadChunk(decoded))
+            self.threadedChunks[chunk] = cached
+        return cached[1]
+
+    def threadChunk(self, decoded: DecodedChunk):
+        code = []
+        for ip, instruction in enumerate(decoded.code):
+            maker = getattr(self, f"op_{instruction[0].name}")
+            code.append(maker(instruction, ip + 1))
+        return code
+
+    def run(self, exitDepth: int=0):
+        frame = self.frames[-1]
+        code = self.threadedCode(frame.closure.function.chunk)
+
+        while True:
+            if DEBUG_TRACE_EXECUTION:
+                print("          ", end="", file=stdout)
+                for slot in self.stack:
+                    print("[ %s ]"%slot, end="", file=stdout)
+                print(file=stdout)
+                chunk = frame.closure.function.chunk
+                disassembleInstruction(chunk, chunk.decode().offsets[frame.ip])
+            result = code[frame.ip](frame)
+            if result is None: continue
+            if result is not FRAME_CHANGED: return result
+            if len(self.frames) == exitDepth: return INTERPRET.OK
+            frame = self.frames[-1]
+            code = self.threadedCode(frame.closure.function.chunk)
+
+    def _binary(self, next_, valueType, op):
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            if not (stack[-1].is_number() and stack[-2].is_number()):
+                self.runtimeError("Operands must be numbers.")
+                return INTERPRET.RUNTIME_ERROR
+            b = float(stack.pop())
+            a = float(stack.pop())
+            stack.append(valueType(op(a, b)))
+        return handler
+
+    def op_CONSTANT(self, instruction, next_):
+        constant = instruction[1]
+        push = self.stack.append
+        def handler(frame):
+            frame.ip = next_
+            push(constant)
+        return handler
+
+    def op_NIL(self, instruction, next_):
+        push = self.stack.append
+        def handler(frame):
+            frame.ip = next_
+            push(Value.nil())
+        return handler
+
+    def op_TRUE(self, instruction, next_):
+        push = self.stack.append
+        def handler(frame):
+            frame.ip = next_
+            push(Value.from_bool(True))
+        return handler
+
+    def op_FALSE(self, instruction, next_):
+        push = self.stack.append
+        def handler(frame):
+            frame.ip = next_
+            push(Value.from_bool(False))
+        return handler
+
+    def op_POP(self, instruction, next_):
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            stack.pop()
+        return handler
+
+    def op_GET_LOCAL(self, instruction, next_):
+        slot = instruction[1]
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            stack.append(stack[frame.slots + slot])
+        return handler
+
+    def op_SET_LOCAL(self, instruction, next_):
+        slot = instruction[1]
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            stack[frame.slots + slot] = stack[-1]
+        return handler
+
+    def op_GET_GLOBAL(self, instruction, next_):
+        _, slot, name = instruction
+        stack = self.stack
+        globals_ = self.globals
+        def handler(frame):
+            frame.ip = next_
+            value = globals_[slot]
+            if value is UNDEFINED:
+                self.runtimeError(f"Undefined variable '{name}'.")
+                return INTERPRET.RUNTIME_ERROR
+            stack.append(value)
+        return handler
+
+    def op_DEFINE_GLOBAL(self, instruction, next_):
+        slot = instruction[1]
+        stack = self.stack
+        globals_ = self.globals
+        def handler(frame):
+            frame.ip = next_
+            globals_[slot] = stack.pop()
+        return handler
+
+    def op_SET_GLOBAL(self, instruction, next_):
+        _, slot, name = instruction
+        stack = self.stack
+        globals_ = self.globals
+        def handler(frame):
+            frame.ip = next_
+            if globals_[slot] is UNDEFINED:
+                self.runtimeError(f"Undefined variable '{name}'.")
+                return INTERPRET.RUNTIME_ERROR
+            globals_[slot] = stack[-1]
+        return handler
+
+    def op_GET_UPVALUE(self, instruction, next_):
+        slot = instruction[1]
+        push = self.stack.append
+        def handler(frame):
+            frame.ip = next_
+            push(frame.closure.upvalues[slot])
+        return handler
+
+    def op_GET_CELL(self, instruction, next_):
+        slot = instruction[1]
+        push = self.stack.append
+        def handler(frame):
+            frame.ip = next_
+            push(frame.closure.upvalues[slot].value)
+        return handler
+
+    def op_SET_CELL(self, instruction, next_):
+        slot = instruction[1]
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            frame.closure.upvalues[slot].value = stack[-1]
+        return handler
+
+    def op_GET_LOCAL_CELL(self, instruction, next_):
+        slot = instruction[1]
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            stack.append(stack[frame.slots + slot].value)
+        return handler
+
+    def op_SET_LOCAL_CELL(self, instruction, next_):
+        slot = instruction[1]
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            stack[frame.slots + slot].value = stack[-1]
+        return handler
+
+    def op_GET_PROPERTY(self, instruction, next_):
+        name = instruction[1]
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            if not stack[-1].is_instance():
+                self.runtimeError("Only instances have properties.")
+                return INTERPRET.RUNTIME_ERROR
+
+            instance = stack[-1].as_instance()
+            index = instance.shape.slots.get(name)
+            if index is not None:
+                stack[-1] = instance.values[index]
+                return
+
+            if not self.bindMethod(instance.klass, name):
+                return INTERPRET.RUNTIME_ERROR
+        return handler
+
+    def op_SET_PROPERTY(self, instruction, next_):
+        name = instruction[1]
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            if not stack[-2].is_instance():
+                self.runtimeError("Only instances have fields.")
+                return INTERPRET.RUNTIME_ERROR
+
+            value = stack.pop()
+            stack[-1].as_instance().setField(name, value)
+            stack[-1] = value
+        return handler
+
+    def op_GET_SUPER(self, instruction, next_):
+        name = instruction[1]
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            superclass = stack.pop().as_class()
+            if not self.bindMethod(superclass, name):
+                return INTERPRET.RUNTIME_ERROR
+        return handler
+
+    def op_EQUAL(self, instruction, next_):
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            b = stack.pop()
+            stack[-1] = Value.from_bool(stack[-1] == b)
+        return handler
+
+    def op_NOT_EQUAL(self, instruction, next_):
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            b = stack.pop()
+            stack[-1] = Value.from_bool(not stack[-1] == b)
+        return handler
+
+    def op_GREATER(self, instruction, next_):
+        return self._quickening(instruction, next_,
+                                self._binary(next_, Value.from_bool, gt))
+
+    def op_GREATER_EQUAL(self, instruction, next_):
+        return self._quickening(instruction, next_,
+                                self._binary(next_, Value.from_bool, ge))
+
+    def op_LESS(self, instruction, next_):
+        return self._quickening(instruction, next_,
+                                self._binary(next_, Value.from_bool, lt))
+
+    def op_LESS_EQUAL(self, instruction, next_):
+        return self._quickening(instruction, next_,
+                                self._binary(next_, Value.from_bool, le))
+
+    def op_ADD(self, instruction, next_):
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            if stack[-1].is_string() and stack[-2].is_string():
+                b = stack.pop().as_str()
+                a = stack.pop().as_str()
+                stack.append(Value.from_obj(copyString(self.strings, a + b)))
+            elif stack[-1].is_number() and stack[-2].is_number():
+                b = float(stack.pop())
+                a = float(stack.pop())
+                stack.append(Value.from_float(a + b))
+            else:
+                self.runtimeError(
+                    "Operands must be two numbers or two strings.")
+                return INTERPRET.RUNTIME_ERROR
+        return self._quickening(instruction, next_, handler)
+
+    def op_SUBTRACT(self, instruction, next_):
+        return self._quickening(instruction, next_,
+                                self._binary(next_, Value.from_float, sub))
+
+    def op_MULTIPLY(self, instruction, next_):
+        return self._binary(next_, Value.from_float, mul)
+
+    def op_DIVIDE(self, instruction, next_):
+        return self._binary(next_, Value.from_float, div)
+
+    def op_NOT(self, instruction, next_):
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            stack[-1] = Value.from_bool(isFalsey(stack[-1]))
+        return handler
+
+    def op_NEGATE(self, instruction, next_):
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            if not stack[-1].is_number():
+                self.runtimeError("Operand must be a number.")
+                return INTERPRET.RUNTIME_ERROR
+            stack[-1] = Value.from_float(-float(stack[-1]))
+        return handler
+
+    def op_PRINT(self, instruction, next_):
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            print(stack.pop(), file=stdout)
+        return handler
+
+    def op_JUMP(self, instruction, next_):
+        target = instruction[1]
+        def handler(frame):
+            frame.ip = target
+        return handler
+
+    def op_JUMP_IF_FALSE(self, instruction, next_):
+        target = instruction[1]
+        stack = self.stack
+        def handler(frame):
+            frame.ip = target if isFalsey(stack[-1]) else next_
+        return handler
+
+    def op_JUMP_IF_TRUE(self, instruction, next_):
+        target = instruction[1]
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_ if isFalsey(stack[-1]) else target
+        return handler
+
+    def op_POP_JUMP_IF_FALSE(self, instruction, next_):
+        target = instruction[1]
+        stack = self.stack
+        def handler(frame):
+            frame.ip = target if isFalsey(stack.pop()) else next_
+        return handler
+
+    def op_LOOP(self, instruction, next_):
+        target = instruction[1]
+        def handler(frame):
+            frame.ip = target
+        return handler
+
+    def op_CALL(self, instruction, next_):
+        argCount = instruction[1]
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            if not self.callValue(stack[-1 - argCount], argCount):
+                return INTERPRET.RUNTIME_ERROR
+            return FRAME_CHANGED
+        return self._quickening(instruction, next_, handler)
+
+    def op_INVOKE(self, instruction, next_):
+        method = instruction[1]
+        argCount = instruction[2]
+        def handler(frame):
+            frame.ip = next_
+            if not self.invoke(method, argCount):
+                return INTERPRET.RUNTIME_ERROR
+            return FRAME_CHANGED
+        return self._quickening(instruction, next_, handler)
+
+    def op_SUPER_INVOKE(self, instruction, next_):
+        method = instruction[1]
+        argCount = instruction[2]
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            superclass = stack.pop().as_class()
+            if not self.invokeFromClass(superclass, method, argCount):
+                return INTERPRET.RUNTIME_ERROR
+            return FRAME_CHANGED
+        return handler
+
+    def op_TAIL_CALL(self, instruction, next_):
+        argCount = instruction[1]
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            if not self.callValue(stack[-1 - argCount], argCount, True):
+                return INTERPRET.RUNTIME_ERROR
+            return FRAME_CHANGED
+        return handler
+
+    def op_TAIL_INVOKE(self, instruction, next_):
+        method = instruction[1]
+        argCount = instruction[2]
+        def handler(frame):
+            frame.ip = next_
+            if not self.invoke(method, argCount, True):
+                return INTERPRET.RUNTIME_ERROR
+            return FRAME_CHANGED
+        return handler
+
+    def op_CLOSURE(self, instruction, next_):
+        function = instruction[1]
+        upvalues = instruction[2]
+        stack = self.stack
+        push = stack.append
+        def handler(frame):
+            frame.ip = next_
+            closure = ObjClosure(function)
+            push(Value.from_obj(closure))
+            for i, (isLocal, index) in enumerate(upvalues):
+                if isLocal:
+                    closure.upvalues[i] = stack[frame.slots + index]
+                else:
+                    closure.upvalues[i] = frame.closure.upvalues[index]
+        return handler
+
+    def op_BOX(self, instruction, next_):
+        slot = instruction[1]
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            stack[frame.slots + slot] = ObjCell(stack[frame.slots + slot])
+        return handler
+
+    def op_RETURN(self, instruction, next_):
+        stack = self.stack
+        frames = self.frames
+        def handler(frame):
+            frame.ip = next_
+            result = stack.pop()
+            frames.pop()
+            if len(frames) == 0:
+                stack.pop()
+                return INTERPRET.OK
+
+            del stack[frame.slots:]
+            stack.append(result)
+            return FRAME_CHANGED
+        return handler
+
+    def op_CLASS(self, instruction, next_):
+        name = instruction[1]
+        push = self.stack.append
+        def handler(frame):
+            frame.ip = next_
+            push(Value.from_obj(ObjClass(name)))
+        return handler
+
+    def op_INHERIT(self, instruction, next_):
+        stack = self.stack
+        def handler(frame):
+            frame.ip = next_
+            superclass = stack[-2]
+            if not superclass.is_class():
+                self.runtimeError("Superclass must be a class.")
+                return INTERPRET.RUNTIME_ERROR
+
+            subclass = stack[-1].as_class()
+            subclass.methods.update(superclass.as_class().methods)
+            stack.pop() # Subclass.
+        return handler
+
+    def op_METHOD(self, instruction, next_):
+        name = instruction[1]
+        def handler(frame):
+            frame.ip = next_
+            self.defineMethod(name)
+        return handler
+
+    def _quickening(self, instruction, next_, generic):
+        """Wrap a generic handler so that it specializes itself once warm."""
+        counter = 0
+        def handler(frame):
+            nonlocal counter
+            counter += 1
+            if counter >= QUICKEN_WARMUP:
+                specialized = self.specialize(instruction, next_, deoptimize)
+                if specialized is None:
+                    counter = -QUICKEN_BACKOFF
+                else:
+                    counter = 0
+                    self.threadedCode(frame.closure.function.chunk)[next_ - 1] = specialized
+            return generic(frame)
+        def deoptimize(frame):
+            nonlocal counter
+            counter = -QUICKEN_BACKOFF
+            self.threadedCode(frame.closure.function.chunk)[next_ - 1] = handler
+            return generic(frame)
+        return handler
+
+    def specialize(self, instruction, next_, deoptimize):
+        """Return a handler specialized for the operands on the stack, or
+        None if there is no form for them."""
+        stack = self.stack
+        match instruction[0]:
+            case (OP.ADD | OP.SUBTRACT | OP.LESS | OP.GREATER |
+                  OP.LESS_EQUAL | OP.GREATER_EQUAL):
+                a = stack[-2]
+                b = stack[-1]
+                if a.is_number() and b.is_number():
+                    maker = getattr(self, f"quick_{instruction[0].name}_NUM")
+                    return maker(next_, deoptimize)
+                if instruction[0] == OP.ADD and a.is_string() and b.is_string():
+                    return self.quick_ADD_STR(next_, deoptimize)
+            case OP.CALL:
+                argCount = instruction[1]
+                callee = stack[-1 - argCount]
+                if callee.is_closure():
+                    function = callee.as_closure().function
+                    if function.arity == argCount:
+                        return self.quick_CALL_CLOSURE_EXACT_ARITY(
+                            next_, deoptimize, argCount, function)
+                elif callee.is_bound_method():
+                    function = callee.as_bound_method().method.function
+                    if function.arity == argCount:
+                        return self.quick_CALL_BOUND_METHOD_EXACT_ARITY(
+                            next_, deoptimize, argCount, function)
+                elif callee.is_native():
+                    return self.quick_CALL_NATIVE(next_, deoptimize, argCount)
+                elif callee.is_class():
+                    klass = callee.as_class()
+                    initializer = klass.methods.get(self.initString)
+                    if (initializer is not None and
+                            initializer.as_closure().function.arity == argCount):
+                        return self.quick_INSTANTIATE_WITH_INIT(
+                            next_, deoptimize, argCount, klass,
+                            initializer.as_closure())
+            case OP.INVOKE:
+                name = instruction[1]
+                argCount = instruction[2]
+                reciever = stack[-1 - argCount]
+                if reciever.is_instance():
+                    instance = reciever.as_instance()
+                    method = instance.klass.methods.get(name)
+                    if (name not in instance.shape.slots and method is not None and
+                            method.as_closure().function.arity == argCount):
+                        return self.quick_INVOKE_METHOD(
+                            next_, deoptimize, name, argCount, instance.klass,
+                            method.as_closure())
+        return None
+
+    def _binaryNumber(self, next_, deoptimize, valueType, op):
+        stack = self.stack
+        NUMBER = VAL.NUMBER
+        def handler(frame):
+            b = stack[-1]
+            a = stack[-2]
+            if a.type != NUMBER or b.type != NUMBER:
+                return deoptimize(frame)
+            frame.ip = next_
+            stack.pop()
+            stack[-1] = valueType(op(a.as_, b.as_))
+        return handler
+
+    def quick_ADD_NUM(self, next_, deoptimize):
+        return self._binaryNumber(next_, deoptimize, Value.from_float, add)
+
+    def quick_SUBTRACT_NUM(self, next_, deoptimize):
+        return self._binaryNumber(next_, deoptimize, Value.from_float, sub)
+
+    def quick_LESS_NUM(self, next_, deoptimize):
+        return self._binaryNumber(next_, deoptimize, Value.from_bool, lt)
+
+    def quick_GREATER_NUM(self, next_, deoptimize):
+        return self._binaryNumber(next_, deoptimize, Value.from_bool, gt)
+
+    def quick_LESS_EQUAL_NUM(self, next_, deoptimize):
+        return self._binaryNumber(next_, deoptimize, Value.from_bool, le)
+
+    def quick_GREATER_EQUAL_NUM(self, next_, deoptimize):
+        return self._binaryNumber(next_, deoptimize, Value.from_bool, ge)
+
+    def quick_ADD_STR(self, next_, deoptimize):
+        stack = self.stack
+        def handler(frame):
+            b = stack[-1]
+            a = stack[-2]
+            if not (a.is_string() and b.is_string()):
+                return deoptimize(frame)
+            frame.ip = next_
+            stack.pop()
+            stack[-1] = Value.from_obj(copyString(self.strings, a.as_str() + b.as_str()))
+        return handler
+
+    def _pushFrame(self, closure: ObjClosure, argCount: int):
+        if not self.pushFrame(closure, argCount):
+            return INTERPRET.RUNTIME_ERROR
+        return FRAME_CHANGED
+
+    def quick_CALL_CLOSURE_EXACT_ARITY(self, next_, deoptimize, argCount, function):
+        stack = self.stack
+        OBJ_T = VAL.OBJ
+        def handler(frame):
+            callee = stack[-1 - argCount]
+            if (callee.type != OBJ_T or callee.as_.type != OBJ.CLOSURE or
+                    callee.as_.function is not function):
+                return deoptimize(frame)
+            frame.ip = next_
+            return self._pushFrame(callee.as_, argCount)
+        return handler
+
+    def quick_CALL_BOUND_METHOD_EXACT_ARITY(self, next_, deoptimize, argCount, function):
+        stack = self.stack
+        OBJ_T = VAL.OBJ
+        def handler(frame):
+            callee = stack[-1 - argCount]
+            if (callee.type != OBJ_T or callee.as_.type != OBJ.BOUND_METHOD or
+                    callee.as_.method.function is not function):
+                return deoptimize(frame)
+            frame.ip = next_
+            stack[-1 - argCount] = callee.as_.reciever
+            return self._pushFrame(callee.as_.method, argCount)
+        return handler
+
+    def quick_CALL_NATIVE(self, next_, deoptimize, argCount):
+        stack = self.stack
+        def handler(frame):
+            callee = stack[-1 - argCount]
+            if not callee.is_native():
+                return deoptimize(frame)
+            frame.ip = next_
+            result = callee.as_native()(argCount, len(stack) - argCount)
+            del stack[-1 - argCount:]
+            stack.append(result)
+        return handler
+
+    def quick_INSTANTIATE_WITH_INIT(self, next_, deoptimize, argCount, klass, initializer):
+        stack = self.stack
+        def handler(frame):
+            callee = stack[-1 - argCount]
+            if callee.as_ is not klass:
+                return deoptimize(frame)
+            frame.ip = next_
+            stack[-1 - argCount] = Value.from_obj(ObjInstance(klass))
+            return self._pushFrame(initializer, argCount)
+        return handler
+
+    def quick_INVOKE_METHOD(self, next_, deoptimize, name, argCount, klass, method):
+        stack = self.stack
+        OBJ_T = VAL.OBJ
+        def handler(frame):
+            reciever = stack[-1 - argCount]
+            if (reciever.type != OBJ_T or reciever.as_.type != OBJ.INSTANCE or
+                    reciever.as_.klass is not klass or
+                    name in reciever.as_.shape.slots):
+                return deoptimize(frame)
+            frame.ip = next_
+            return self._pushFrame(method, argCount)
+        return handler
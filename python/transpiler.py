@@ -0,0 +1,548 @@
+from chunk import *
+from common import *
+from object import *
+from value import *
+from vm import *
+
+class Untranspilable(Exception):
+    """Raised when a chunk can't be turned into Python source."""
+
+class Block:
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.end = end
+        self.succs = []
+        self.preds = []
+        self.depth = None
+
+class Loop:
+    def __init__(self, header: Block, exit: Block):
+        self.header = header
+        self.exit = exit
+
+NIL = Value.nil()
+TRUE = Value.from_bool(True)
+FALSE = Value.from_bool(False)
+
+# Returned by a transpiled function whose tail call restarted its frame on
+# the callee, for TranspilingVM.call() to run that next.
+TAIL = object()
+
+def _falsey(name: str):
+    return f"({name}.type is BOOL_T and not {name}.as_ or {name}.type is NIL_T)"
+
+class Transpiler:
+    """Turns one ObjFunction's bytecode into the source of a Python function.
+
+    Every stack slot of the frame becomes a Python local named after its
+    height (`s0` is the closure or receiver, then the parameters, then the
+    other Lox locals and the temporaries above them), so OP.GET_LOCAL and
+    friends are plain assignments. The jumps are rebuilt into `if`/`while`
+    blocks from the control flow graph; a
+    chunk whose graph doesn't fit that shape raises Untranspilable.
+
+    The generated function takes the VM and the function's CallFrame and
+    returns the Lox return value, or None after reporting a runtime error,
+    or TAIL once a tail call has handed the frame to another function.
+    """
+    def __init__(self, function: ObjFunction):
+        self.function = function
+        self.code = function.chunk.decode().code
+        self.lines = []
+        self.constants = []
+        self.emitted = set()
+
+    def constant(self, value):
+        for i, constant in enumerate(self.constants):
+            if constant is value: return f"k{i}"
+        self.constants.append(value)
+        return f"k{len(self.constants) - 1}"
+
+    def emit(self, indent: int, line: str):
+        self.lines.append("    " * indent + line)
+
+    def transpile(self):
+        self.buildBlocks()
+        self.findLoops()
+        self.findJoins()
+
+        name = "script" if self.function.name is None else str(self.function.name)
+        body = []
+        self.lines = body
+        slots = ", ".join(f"s{i}" for i in range(self.function.arity + 1))
+        self.emit(1, "stack = vm.stack")
+        self.emit(1, "globals_ = vm.globals")
+        self.emit(1, "upvalues = frame.closure.upvalues")
+        self.emit(1, f"{slots}, = stack[frame.slots:]")
+        self.emitFrom(self.blocks[0], None, None, 1)
+
+        params = ", ".join(f"k{i}" for i in range(len(self.constants)))
+        source = [f"def make({params}):",
+                  f"  def {_identifier(name)}(vm, frame):"]
+        source += ["  " + line for line in body]
+        source.append(f"  return {_identifier(name)}")
+        return "\n".join(source) + "\n", self.constants
+
+    def buildBlocks(self):
+        code = self.code
+        leaders = {0}
+        for i, instruction in enumerate(code):
+            match instruction[0]:
+                case op if op in JUMPS:
+                    leaders.add(instruction[1])
+                    leaders.add(i + 1)
+                case OP.RETURN:
+                    leaders.add(i + 1)
+        starts = sorted(leader for leader in leaders if leader < len(code))
+        ends = starts[1:] + [len(code)]
+        blocks = {start: Block(start, end) for start, end in zip(starts, ends)}
+
+        for block in blocks.values():
+            last = code[block.end - 1]
+            match last[0]:
+                case OP.JUMP | OP.LOOP: targets = [last[1]]
+                case OP.JUMP_IF_FALSE | OP.JUMP_IF_TRUE | OP.POP_JUMP_IF_FALSE:
+                    targets = [block.end, last[1]]
+                case OP.RETURN: targets = []
+                case _: targets = [block.end]
+            for target in targets:
+                if target not in blocks:
+                    raise Untranspilable("jumps off the end of the chunk")
+                block.succs.append(blocks[target])
+
+        # Keep the reachable blocks, in reverse postorder, and work out the
+        # stack height at the start of each one.
+        order = []
+        seen = set()
+        def visit(block):
+            seen.add(block)
+            for succ in block.succs:
+                if succ not in seen: visit(succ)
+            order.append(block)
+        visit(blocks[0])
+        self.blocks = order[::-1]
+
+        self.blocks[0].depth = self.function.arity + 1
+        for block in self.blocks:
+            depth = block.depth
+            for i in range(block.start, block.end):
+                depth += stackEffect(code[i])
+            for succ in block.succs:
+                succ.preds.append(block)
+                if succ.depth is None:
+                    succ.depth = depth
+                elif succ.depth != depth:
+                    raise Untranspilable("inconsistent stack height")
+
+    def findLoops(self):
+        dom = {self.blocks[0]: {self.blocks[0]}}
+        every = set(self.blocks)
+        for block in self.blocks[1:]: dom[block] = every
+        changed = True
+        while changed:
+            changed = False
+            for block in self.blocks[1:]:
+                new = set.intersection(*(dom[pred] for pred in block.preds)) | {block}
+                if new != dom[block]:
+                    dom[block] = new
+                    changed = True
+
+        self.backEdges = set()
+        self.loops = {}
+        for block in self.blocks:
+            for succ in block.succs:
+                if succ in dom[block]:
+                    self.backEdges.add((block, succ))
+
+        for header in {succ for block, succ in self.backEdges}:
+            body = {header}
+            work = [block for block, succ in self.backEdges if succ is header]
+            while work:
+                block = work.pop()
+                if block in body: continue
+                body.add(block)
+                work.extend(block.preds)
+            exits = {succ for block in body for succ in block.succs
+                     if succ not in body}
+            if len(exits) > 1:
+                raise Untranspilable("loop with more than one exit")
+            self.loops[header] = Loop(header, exits.pop() if exits else None)
+
+    def findJoins(self):
+        # Immediate post-dominators, with back edges sent straight to the
+        # exit so that each arm of an `if` ends at its join point, a loop's
+        # `continue`, or a `return`. None stands for the exit.
+        succs = {}
+        for block in self.blocks:
+            succs[block] = [succ for succ in block.succs
+                            if (block, succ) not in self.backEdges]
+            if len(succs[block]) < len(block.succs) or not block.succs:
+                succs[block].append(None)
+
+        every = set(self.blocks) | {None}
+        pdom = {block: every for block in self.blocks}
+        pdom[None] = {None}
+        changed = True
+        while changed:
+            changed = False
+            for block in reversed(self.blocks):
+                new = set.intersection(*(pdom[succ] for succ in succs[block])) | {block}
+                if new != pdom[block]:
+                    pdom[block] = new
+                    changed = True
+
+        # The nearest strict post-dominator is the one with the most
+        # post-dominators of its own.
+        self.joins = {}
+        for block in self.blocks:
+            self.joins[block] = max(pdom[block] - {block}, key=lambda d: len(pdom[d]))
+
+    def transition(self, target: Block, stop: Block, loop: Loop, indent: int):
+        if loop is not None and target is loop.header:
+            self.emit(indent, "continue")
+            return None
+        if loop is not None and target is loop.exit:
+            self.emit(indent, "break")
+            return None
+        if target is None or target is stop:
+            return None
+        if target in self.emitted:
+            raise Untranspilable("block reached from more than one place")
+        return target
+
+    def emitFrom(self, block: Block, stop: Block, loop: Loop, indent: int):
+        while block is not None:
+            if block in self.loops and (loop is None or block is not loop.header):
+                inner = self.loops[block]
+                self.emit(indent, "while True:")
+                self.emitFrom(block, None, inner, indent + 1)
+                following = inner.exit
+            else:
+                following = self.emitBlock(block, stop, loop, indent)
+            if following is None: return
+            block = self.transition(following, stop, loop, indent)
+
+    def emitArm(self, entry: Block, join: Block, loop: Loop, indent: int):
+        size = len(self.lines)
+        block = self.transition(entry, join, loop, indent)
+        if block is not None: self.emitFrom(block, join, loop, indent)
+        if len(self.lines) == size: self.emit(indent, "pass")
+
+    def emitBlock(self, block: Block, stop: Block, loop: Loop, indent: int):
+        self.emitted.add(block)
+        depth = block.depth
+        boolean = None
+        for i in range(block.start, block.end):
+            instruction = self.code[i]
+            op = instruction[0]
+            if op in (OP.JUMP_IF_FALSE, OP.JUMP_IF_TRUE, OP.POP_JUMP_IF_FALSE):
+                condition = f"s{depth - 1}"
+                test = (f"{condition} is FALSE" if boolean == condition
+                        else _falsey(condition))
+                taken, notTaken = block.succs[1], block.succs[0]
+                if op == OP.JUMP_IF_TRUE: taken, notTaken = notTaken, taken
+                join = self.joins[block]
+                self.emit(indent, f"if {test}:")
+                self.emitArm(taken, join, loop, indent + 1)
+                self.emit(indent, "else:")
+                self.emitArm(notTaken, join, loop, indent + 1)
+                return join
+            if op in (OP.JUMP, OP.LOOP):
+                return block.succs[0]
+            boolean = self.emitInstruction(instruction, i, depth, indent)
+            if op == OP.RETURN: return None
+            depth += stackEffect(instruction)
+        return block.succs[0]
+
+    def error(self, indent: int, ip: int, message: str):
+        self.emit(indent, f"frame.ip = {ip + 1}")
+        self.emit(indent, f"vm.runtimeError({message!r})")
+        self.emit(indent, "return None")
+
+    def emitInstruction(self, instruction: tuple, ip: int, depth: int, indent: int):
+        """Emit one instruction, returning the slot it left a known
+        TRUE/FALSE in, if any."""
+        emit = lambda line: self.emit(indent, line)
+        top = f"s{depth}"
+        a = f"s{depth - 2}"
+        b = f"s{depth - 1}"
+        match instruction[0]:
+            case OP.CONSTANT: emit(f"{top} = {self.constant(instruction[1])}")
+            case OP.NIL: emit(f"{top} = NIL")
+            case OP.TRUE: emit(f"{top} = TRUE")
+            case OP.FALSE: emit(f"{top} = FALSE")
+            case OP.POP: pass
+            case OP.GET_LOCAL: emit(f"{top} = s{instruction[1]}")
+            case OP.SET_LOCAL: emit(f"s{instruction[1]} = {b}")
+            case OP.GET_GLOBAL:
+                _, slot, name = instruction
+                emit(f"{top} = globals_[{slot}]")
+                emit(f"if {top} is UNDEFINED:")
+                self.error(indent + 1, ip, f"Undefined variable '{name}'.")
+            case OP.DEFINE_GLOBAL: emit(f"globals_[{instruction[1]}] = {b}")
+            case OP.SET_GLOBAL:
+                _, slot, name = instruction
+                emit(f"if globals_[{slot}] is UNDEFINED:")
+                self.error(indent + 1, ip, f"Undefined variable '{name}'.")
+                emit(f"globals_[{slot}] = {b}")
+            case OP.GET_UPVALUE: emit(f"{top} = upvalues[{instruction[1]}]")
+            case OP.GET_CELL: emit(f"{top} = upvalues[{instruction[1]}].value")
+            case OP.SET_CELL: emit(f"upvalues[{instruction[1]}].value = {b}")
+            case OP.GET_LOCAL_CELL: emit(f"{top} = s{instruction[1]}.value")
+            case OP.SET_LOCAL_CELL: emit(f"s{instruction[1]}.value = {b}")
+            case OP.GET_PROPERTY:
+                emit(f"frame.ip = {ip + 1}")
+                emit(f"{b} = getProperty(vm, {b}, {instruction[1]!r})")
+                emit(f"if {b} is None: return None")
+            case OP.SET_PROPERTY:
+                emit(f"frame.ip = {ip + 1}")
+                emit(f"if not setProperty(vm, {a}, {instruction[1]!r}, {b}): return None")
+                emit(f"{a} = {b}")
+            case OP.GET_SUPER:
+                emit(f"frame.ip = {ip + 1}")
+                emit(f"{a} = getSuper(vm, {a}, {b}, {instruction[1]!r})")
+                emit(f"if {a} is None: return None")
+            case OP.EQUAL:
+                emit(f"{a} = TRUE if {a} == {b} else FALSE")
+                return a
+            case OP.NOT_EQUAL:
+                emit(f"{a} = FALSE if {a} == {b} else TRUE")
+                return a
+            case OP.GREATER | OP.GREATER_EQUAL | OP.LESS | OP.LESS_EQUAL:
+                # >= and <= are the negated < and >, as in VM.run, so that
+                # NaN compares the same.
+                operator = "<" if instruction[0] in (OP.LESS, OP.GREATER_EQUAL) else ">"
+                true, false = "TRUE", "FALSE"
+                if instruction[0] in (OP.GREATER_EQUAL, OP.LESS_EQUAL):
+                    true, false = false, true
+                emit(f"if {a}.type is NUMBER_T and {b}.type is NUMBER_T:")
+                emit(f"    {a} = {true} if {a}.as_ {operator} {b}.as_ else {false}")
+                emit("else:")
+                self.error(indent + 1, ip, "Operands must be numbers.")
+                return a
+            case OP.ADD:
+                emit(f"if {a}.type is NUMBER_T and {b}.type is NUMBER_T:")
+                emit(f"    {a} = Value(NUMBER_T, {a}.as_ + {b}.as_)")
+                emit(f"elif {a}.is_string() and {b}.is_string():")
+                emit(f"    {a} = Value.from_obj(copyString(vm.strings, {a}.as_str() + {b}.as_str()))")
+                emit("else:")
+                self.error(indent + 1, ip, "Operands must be two numbers or two strings.")
+            case OP.SUBTRACT | OP.MULTIPLY | OP.DIVIDE:
+                match instruction[0]:
+                    case OP.SUBTRACT: result = f"{a}.as_ - {b}.as_"
+                    case OP.MULTIPLY: result = f"{a}.as_ * {b}.as_"
+                    case OP.DIVIDE: result = f"div({a}.as_, {b}.as_)"
+                emit(f"if {a}.type is NUMBER_T and {b}.type is NUMBER_T:")
+                emit(f"    {a} = Value(NUMBER_T, {result})")
+                emit("else:")
+                self.error(indent + 1, ip, "Operands must be numbers.")
+            case OP.NOT:
+                emit(f"{b} = TRUE if {_falsey(b)} else FALSE")
+                return b
+            case OP.NEGATE:
+                emit(f"if {b}.type is NUMBER_T:")
+                emit(f"    {b} = Value(NUMBER_T, -{b}.as_)")
+                emit("else:")
+                self.error(indent + 1, ip, "Operand must be a number.")
+            case OP.PRINT: emit(f"print({b}, file=stdout)")
+            case OP.CALL:
+                argCount = instruction[1]
+                callee = depth - argCount - 1
+                window = ", ".join(f"s{i}" for i in range(callee, depth))
+                emit(f"frame.ip = {ip + 1}")
+                emit(f"stack.extend(({window},))")
+                emit(f"if not callValue(vm, {argCount}): return None")
+                emit(f"s{callee} = stack.pop()")
+            case OP.INVOKE:
+                argCount = instruction[2]
+                reciever = depth - argCount - 1
+                window = ", ".join(f"s{i}" for i in range(reciever, depth))
+                emit(f"frame.ip = {ip + 1}")
+                emit(f"stack.extend(({window},))")
+                emit(f"if not invoke(vm, {instruction[1]!r}, {argCount}): return None")
+                emit(f"s{reciever} = stack.pop()")
+            case OP.SUPER_INVOKE:
+                argCount = instruction[2]
+                reciever = depth - argCount - 2
+                window = ", ".join(f"s{i}" for i in range(reciever, depth - 1))
+                emit(f"frame.ip = {ip + 1}")
+                emit(f"stack.extend(({window},))")
+                emit(f"if not superInvoke(vm, {b}, {instruction[1]!r}, {argCount}): return None")
+                emit(f"s{reciever} = stack.pop()")
+            case OP.TAIL_CALL | OP.TAIL_INVOKE:
+                # The OP.RETURN after it hands back whatever this leaves:
+                # the result of a call that didn't take the frame, TAIL or
+                # None.
+                argCount = instruction[-1]
+                callee = depth - argCount - 1
+                window = ", ".join(f"s{i}" for i in range(callee, depth))
+                emit(f"frame.ip = {ip + 1}")
+                emit(f"stack.extend(({window},))")
+                if instruction[0] == OP.TAIL_CALL:
+                    emit(f"s{callee} = tailCall(vm, frame, {argCount})")
+                else:
+                    emit(f"s{callee} = tailInvoke(vm, frame, {instruction[1]!r}, {argCount})")
+            case OP.CLOSURE:
+                emit(f"closure = ObjClosure({self.constant(instruction[1])})")
+                for i, (isLocal, index) in enumerate(instruction[2]):
+                    captured = f"s{index}" if isLocal else f"upvalues[{index}]"
+                    emit(f"closure.upvalues[{i}] = {captured}")
+                emit(f"{top} = Value.from_obj(closure)")
+            case OP.BOX: emit(f"s{instruction[1]} = ObjCell(s{instruction[1]})")
+            case OP.RETURN: emit(f"return {b}")
+            case OP.CLASS: emit(f"{top} = Value.from_obj(ObjClass({instruction[1]!r}))")
+            case OP.INHERIT:
+                emit(f"if not {a}.is_class():")
+                self.error(indent + 1, ip, "Superclass must be a class.")
+                emit(f"{b}.as_class().methods.update({a}.as_class().methods)")
+            case OP.METHOD: emit(f"{a}.as_class().methods[{instruction[1]!r}] = {b}")
+            case op:
+                raise Untranspilable(f"no translation for {op.name}")
+
+def _identifier(name: str):
+    return "lox_" + "".join(c if c.isalnum() else "_" for c in name)
+
+# Runtime helpers for the generated code. Each reports its own runtime
+# error and returns None or False when something goes wrong.
+
+def callValue(vm, argCount: int):
+    depth = len(vm.frames)
+    if not vm.callValue(vm.stack[-1 - argCount], argCount): return False
+    if len(vm.frames) > depth:
+        # Not transpiled, so it's up to VM.run to finish the call.
+        return vm.run(depth) == INTERPRET.OK
+    return True
+
+def invoke(vm, name: str, argCount: int):
+    depth = len(vm.frames)
+    if not vm.invoke(name, argCount): return False
+    if len(vm.frames) > depth:
+        return vm.run(depth) == INTERPRET.OK
+    return True
+
+def superInvoke(vm, superclass: Value, name: str, argCount: int):
+    depth = len(vm.frames)
+    if not vm.invokeFromClass(superclass.as_class(), name, argCount): return False
+    if len(vm.frames) > depth:
+        return vm.run(depth) == INTERPRET.OK
+    return True
+
+def tailCall(vm, frame: CallFrame, argCount: int):
+    if not vm.callValue(vm.stack[-1 - argCount], argCount, True): return None
+    if frame.ip == 0: return TAIL
+    return vm.stack.pop()
+
+def tailInvoke(vm, frame: CallFrame, name: str, argCount: int):
+    if not vm.invoke(name, argCount, True): return None
+    if frame.ip == 0: return TAIL
+    return vm.stack.pop()
+
+def getProperty(vm, reciever: Value, name: str):
+    if not reciever.is_instance():
+        vm.runtimeError("Only instances have properties.")
+        return None
+
+    instance = reciever.as_instance()
+    value = instance.field(name)
+    if value is not None:
+        return value
+
+    vm.stack.append(reciever)
+    if not vm.bindMethod(instance.klass, name): return None
+    return vm.stack.pop()
+
+def setProperty(vm, reciever: Value, name: str, value: Value):
+    if not reciever.is_instance():
+        vm.runtimeError("Only instances have fields.")
+        return False
+
+    reciever.as_instance().setField(name, value)
+    return True
+
+def getSuper(vm, reciever: Value, superclass: Value, name: str):
+    vm.stack.append(reciever)
+    if not vm.bindMethod(superclass.as_class(), name): return None
+    return vm.stack.pop()
+
+_namespace = {
+    "NIL": NIL, "TRUE": TRUE, "FALSE": FALSE,
+    "BOOL_T": VAL.BOOL, "NIL_T": VAL.NIL, "NUMBER_T": VAL.NUMBER,
+    "Value": Value, "ObjString": ObjString, "copyString": copyString, "UNDEFINED": UNDEFINED, "ObjClass": ObjClass,
+    "ObjClosure": ObjClosure, "ObjCell": ObjCell, "div": div, "stdout": stdout,
+    "callValue": callValue, "invoke": invoke, "superInvoke": superInvoke,
+    "tailCall": tailCall, "tailInvoke": tailInvoke,
+    "getProperty": getProperty, "setProperty": setProperty,
+    "getSuper": getSuper,
+}
+
+def transpile(function: ObjFunction):
+    """Compile a function's chunk to a Python function, or return None if
+    it has to run on VM.run instead."""
+    try:
+        source, constants = Transpiler(function).transpile()
+    except Untranspilable:
+        return None
+
+    if DEBUG_PRINT_CODE:
+        print(f"== {function} ==", file=stdout)
+        print(source, file=stdout)
+
+    namespace = dict(_namespace)
+    exec(compile(source, f"<lox {function}>", "exec"), namespace)
+    return namespace["make"](*constants)
+
+class TranspilingVM(VM):
+    """VM that runs functions as transpiled Python code where it can.
+
+    Every function in a script is transpiled ahead of time, right after
+    compiling. Calls to a transpiled function run it to completion inside
+    VM.call, as do the tail calls it makes in turn; anything that couldn't
+    be transpiled is left on the frame stack for VM.run.
+    """
+    superinstructions = False
+
+    def __init__(self, compiler: Compiler=None, framesMax: int=FRAMES_MAX):
+        super().__init__(compiler, framesMax)
+        self.transpiled = {}
+
+    def transpileAll(self, function: ObjFunction):
+        self.transpiled[function.chunk] = (function.chunk.decode(), transpile(function))
+        for constant in function.chunk.constants:
+            if constant.is_function():
+                self.transpileAll(constant.as_function())
+
+    def execute(self, function: ObjFunction):
+        self.transpileAll(function)
+
+        closure = ObjClosure(function)
+        self.stack.append(Value.from_obj(closure))
+        if not self.call(closure, 0):
+            result = INTERPRET.RUNTIME_ERROR
+        elif len(self.frames) > 0:
+            result = self.run()
+        else:
+            result = INTERPRET.OK
+        self.resetFromBruh()
+        return result
+
+    def call(self, closure: ObjClosure, argCount: int, tail: bool=False):
+        if not super().call(closure, argCount, tail): return False
+        # A tail call from transpiled code returns TAIL to the loop below,
+        # and one from VM.run carries on there.
+        if tail: return True
+
+        frame = self.frames[-1]
+        while True:
+            chunk = frame.closure.function.chunk
+            cached = self.transpiled.get(chunk)
+            if cached is None or cached[0] is not chunk.decode() or cached[1] is None:
+                return True
+
+            result = cached[1](self, frame)
+            if result is None: return False
+            if result is not TAIL: break
+
+        self.frames.pop()
+        del self.stack[frame.slots:]
+        self.stack.append(result)
+        return True
@@ -0,0 +1,456 @@
+from chunk import *
+from common import *
+from debug import *
+from object import *
+from value import *
+from vm import *
+
+class Nil:
+    """Type of NIL, the unboxed representation of Lox nil."""
+    def __str__(self):
+        return "nil"
+
+NIL = Nil()
+
+def unbox(value: Value):
+    """The unboxed form of a Value: a float, a bool, NIL or the Obj."""
+    match value.type:
+        case VAL.NUMBER: return float(value.as_)
+        case VAL.BOOL: return bool(value.as_)
+        case VAL.NIL: return NIL
+        case VAL.OBJ: return value.as_
+
+def stringify(value):
+    """Print form of an unboxed value, the same as str() of its Value."""
+    if type(value) is float: return "%g"%value
+    if value is True: return "true"
+    if value is False: return "false"
+    return str(value)
+
+def valuesEqual(a, b):
+    # Checking the type first keeps true from equalling 1 and nil from
+    # equalling anything but nil, as Value.__eq__ does.
+    return type(a) is type(b) and a == b
+
+def isFalsey(value):
+    return value is NIL or value is False
+
+def unboxCode(decoded: DecodedChunk):
+    """Copy of a decoded chunk's code with its constants unboxed, including
+    those the superinstructions carry."""
+    code = []
+    for instruction in decoded.code:
+        if any(type(operand) is Value for operand in instruction):
+            instruction = tuple(unbox(operand) if type(operand) is Value else operand
+                                for operand in instruction)
+        code.append(instruction)
+    return code
+
+class UnboxedVM(VM):
+    """VM whose stack, globals and fields hold unboxed values.
+
+    Lox numbers are Python floats, booleans are True and False, nil is
+    NIL and every other value is its Obj, so type checks are `type(x) is`
+    tests and arithmetic allocates nothing but the float it produces.
+    Chunks are still compiled to boxed constants; each one is unboxed once,
+    the first time a frame runs it, and natives' results are unboxed as
+    they return.
+
+    run() executes the same superinstructions and inline caches as VM.run,
+    keeps the running frame's ip and slots in locals, writing ip back to
+    the frame before anything that can call or report an error, and calls
+    closures without going through callValue(). Its cases come roughly in
+    order of how often they run.
+    """
+
+    def __init__(self, compiler: Compiler=None, framesMax: int=FRAMES_MAX):
+        super().__init__(compiler, framesMax)
+        self.unboxedChunks = {}
+
+    def unboxedCode(self, chunk: Chunk):
+        """The chunk's decoded code, unboxed, and its inline caches."""
+        decoded = chunk.decode(self.superinstructions)
+        cached = self.unboxedChunks.get(chunk)
+        if cached is None or cached[0] is not decoded:
+            cached = (decoded, unboxCode(decoded), self.cachesFor(chunk, decoded))
+            self.unboxedChunks[chunk] = cached
+        return cached[1], cached[2]
+
+    def execute(self, function: ObjFunction):
+        closure = ObjClosure(function)
+        self.stack.append(closure)
+        self.call(closure, 0)
+
+        result = self.run()
+        self.resetFromBruh()
+        return result
+
+    def run(self, exitDepth: int=0):
+        stack = self.stack
+        frame = self.frames[-1]
+        code, caches = self.unboxedCode(frame.closure.function.chunk)
+        ip = frame.ip
+        slots = frame.slots
+
+        while True:
+            if DEBUG_TRACE_EXECUTION:
+                print("          ", end="", file=stdout)
+                for slot in stack:
+                    print("[ %s ]"%stringify(slot), end="", file=stdout)
+                print(file=stdout)
+                chunk = frame.closure.function.chunk
+                disassembleInstruction(chunk, chunk.decode(self.superinstructions).offsets[ip])
+            instruction = code[ip]
+            ip += 1
+            match instruction[0]:
+                case OP.GET_LOCAL: stack.append(stack[slots + instruction[1]])
+                case OP.CONSTANT: stack.append(instruction[1])
+                case OP.GET_GLOBAL:
+                    value = self.globals[instruction[1]]
+                    if value is UNDEFINED:
+                        frame.ip = ip
+                        self.runtimeError(f"Undefined variable '{instruction[2]}'.")
+                        return INTERPRET.RUNTIME_ERROR
+                    stack.append(value)
+                case OP.GET_LOCAL_CONSTANT_LESS_POP_JUMP_IF_FALSE:
+                    a = stack[slots + instruction[1]]
+                    b = instruction[2]
+                    if type(a) is not float or type(b) is not float:
+                        frame.ip = ip
+                        self.runtimeError("Operands must be numbers.")
+                        return INTERPRET.RUNTIME_ERROR
+                    if not a < b: ip = instruction[3]
+                case OP.GET_LOCAL_GET_LOCAL_ADD:
+                    a = stack[slots + instruction[1]]
+                    b = stack[slots + instruction[2]]
+                    if type(a) is float and type(b) is float:
+                        stack.append(a + b)
+                    elif type(a) is ObjString and type(b) is ObjString:
+                        stack.append(copyString(self.strings, a.as_ + b.as_))
+                    else:
+                        frame.ip = ip
+                        self.runtimeError(
+                            "Operands must be two numbers or two strings.")
+                        return INTERPRET.RUNTIME_ERROR
+                case OP.CONSTANT_ADD:
+                    a = stack[-1]
+                    b = instruction[1]
+                    if type(a) is float and type(b) is float:
+                        stack[-1] = a + b
+                    elif type(a) is ObjString and type(b) is ObjString:
+                        stack[-1] = copyString(self.strings, a.as_ + b.as_)
+                    else:
+                        frame.ip = ip
+                        self.runtimeError(
+                            "Operands must be two numbers or two strings.")
+                        return INTERPRET.RUNTIME_ERROR
+                case (OP.LESS | OP.SUBTRACT | OP.GREATER | OP.MULTIPLY |
+                      OP.LESS_EQUAL | OP.GREATER_EQUAL | OP.DIVIDE):
+                    b = stack[-1]
+                    a = stack[-2]
+                    if type(a) is not float or type(b) is not float:
+                        frame.ip = ip
+                        self.runtimeError("Operands must be numbers.")
+                        return INTERPRET.RUNTIME_ERROR
+                    stack.pop()
+                    match instruction[0]:
+                        case OP.LESS: stack[-1] = a < b
+                        case OP.SUBTRACT: stack[-1] = a - b
+                        case OP.GREATER: stack[-1] = a > b
+                        case OP.MULTIPLY: stack[-1] = a * b
+                        case OP.LESS_EQUAL: stack[-1] = le(a, b)
+                        case OP.GREATER_EQUAL: stack[-1] = ge(a, b)
+                        case OP.DIVIDE: stack[-1] = div(a, b)
+                case OP.ADD:
+                    b = stack[-1]
+                    a = stack[-2]
+                    if type(a) is float and type(b) is float:
+                        stack.pop()
+                        stack[-1] = a + b
+                    elif type(a) is ObjString and type(b) is ObjString:
+                        stack.pop()
+                        stack[-1] = copyString(self.strings, a.as_ + b.as_)
+                    else:
+                        frame.ip = ip
+                        self.runtimeError(
+                            "Operands must be two numbers or two strings.")
+                        return INTERPRET.RUNTIME_ERROR
+                case OP.POP_JUMP_IF_FALSE:
+                    value = stack.pop()
+                    if value is NIL or value is False: ip = instruction[1]
+                case OP.CALL:
+                    argCount = instruction[1]
+                    callee = stack[-1 - argCount]
+                    frame.ip = ip
+                    if type(callee) is ObjClosure and callee.function.arity == argCount:
+                        called = self.pushFrame(callee, argCount)
+                    else:
+                        called = self.callValue(callee, argCount)
+                    if not called:
+                        return INTERPRET.RUNTIME_ERROR
+                    frame = self.frames[-1]
+                    code, caches = self.unboxedCode(frame.closure.function.chunk)
+                    ip = frame.ip
+                    slots = frame.slots
+                case OP.RETURN:
+                    result = stack.pop()
+                    self.frames.pop()
+                    if len(self.frames) == 0:
+                        stack.pop()
+                        return INTERPRET.OK
+
+                    del stack[slots:]
+                    stack.append(result)
+                    if len(self.frames) == exitDepth: return INTERPRET.OK
+                    frame = self.frames[-1]
+                    code, caches = self.unboxedCode(frame.closure.function.chunk)
+                    ip = frame.ip
+                    slots = frame.slots
+                case OP.POP: stack.pop()
+                case OP.SET_LOCAL: stack[slots + instruction[1]] = stack[-1]
+                case OP.JUMP: ip = instruction[1]
+                case OP.LOOP: ip = instruction[1]
+                case OP.GET_LOCAL_GET_PROPERTY:
+                    instance = stack[slots + instruction[1]]
+                    stack.append(instance)
+                    if type(instance) is not ObjInstance:
+                        frame.ip = ip
+                        self.runtimeError("Only instances have properties.")
+                        return INTERPRET.RUNTIME_ERROR
+
+                    cache = caches[ip - 1]
+                    if cache is not None and cache[0] is instance.shape:
+                        bound = ObjBoundMethod(None, cache[1])
+                        bound.reciever = instance
+                        stack[-1] = bound
+                        continue
+
+                    name = instruction[2]
+                    index = instance.shape.slots.get(name)
+                    if index is not None:
+                        stack[-1] = instance.values[index]
+                        continue
+
+                    frame.ip = ip
+                    if not self.bindMethod(instance.klass, name):
+                        return INTERPRET.RUNTIME_ERROR
+                    self.cacheMethod(caches, ip - 1, instance, name)
+                case OP.GET_PROPERTY:
+                    instance = stack[-1]
+                    if type(instance) is not ObjInstance:
+                        frame.ip = ip
+                        self.runtimeError("Only instances have properties.")
+                        return INTERPRET.RUNTIME_ERROR
+
+                    cache = caches[ip - 1]
+                    if cache is not None and cache[0] is instance.shape:
+                        bound = ObjBoundMethod(None, cache[1])
+                        bound.reciever = instance
+                        stack[-1] = bound
+                        continue
+
+                    name = instruction[1]
+                    index = instance.shape.slots.get(name)
+                    if index is not None:
+                        stack[-1] = instance.values[index]
+                        continue
+
+                    frame.ip = ip
+                    if not self.bindMethod(instance.klass, name):
+                        return INTERPRET.RUNTIME_ERROR
+                    self.cacheMethod(caches, ip - 1, instance, name)
+                case OP.INVOKE:
+                    name, argCount = instruction[1], instruction[2]
+                    instance = stack[-argCount - 1]
+                    cache = caches[ip - 1]
+                    frame.ip = ip
+                    if (cache is not None and type(instance) is ObjInstance and
+                            cache[0] is instance.shape):
+                        if not self.call(cache[1], argCount):
+                            return INTERPRET.RUNTIME_ERROR
+                    else:
+                        if not self.invoke(name, argCount):
+                            return INTERPRET.RUNTIME_ERROR
+                        if type(instance) is ObjInstance and name not in instance.shape.slots:
+                            self.cacheMethod(caches, ip - 1, instance, name)
+                    frame = self.frames[-1]
+                    code, caches = self.unboxedCode(frame.closure.function.chunk)
+                    ip = frame.ip
+                    slots = frame.slots
+                case OP.SET_PROPERTY:
+                    instance = stack[-2]
+                    if type(instance) is not ObjInstance:
+                        frame.ip = ip
+                        self.runtimeError("Only instances have fields.")
+                        return INTERPRET.RUNTIME_ERROR
+
+                    value = stack.pop()
+                    instance.setField(instruction[1], value)
+                    stack[-1] = value
+                case OP.EQUAL:
+                    b = stack.pop()
+                    stack[-1] = valuesEqual(stack[-1], b)
+                case OP.NOT_EQUAL:
+                    b = stack.pop()
+                    stack[-1] = not valuesEqual(stack[-1], b)
+                case OP.JUMP_IF_FALSE:
+                    if isFalsey(stack[-1]): ip = instruction[1]
+                case OP.JUMP_IF_TRUE:
+                    if not isFalsey(stack[-1]): ip = instruction[1]
+                case OP.NIL: stack.append(NIL)
+                case OP.TRUE: stack.append(True)
+                case OP.FALSE: stack.append(False)
+                case OP.GET_UPVALUE: stack.append(frame.closure.upvalues[instruction[1]])
+                case OP.GET_CELL: stack.append(frame.closure.upvalues[instruction[1]].value)
+                case OP.SET_CELL: frame.closure.upvalues[instruction[1]].value = stack[-1]
+                case OP.GET_LOCAL_CELL: stack.append(stack[slots + instruction[1]].value)
+                case OP.SET_LOCAL_CELL: stack[slots + instruction[1]].value = stack[-1]
+                case OP.SET_GLOBAL:
+                    if self.globals[instruction[1]] is UNDEFINED:
+                        frame.ip = ip
+                        self.runtimeError(f"Undefined variable '{instruction[2]}'.")
+                        return INTERPRET.RUNTIME_ERROR
+                    self.globals[instruction[1]] = stack[-1]
+                case OP.DEFINE_GLOBAL:
+                    self.globals[instruction[1]] = stack.pop()
+                case OP.NOT:
+                    stack[-1] = isFalsey(stack[-1])
+                case OP.NEGATE:
+                    if type(stack[-1]) is not float:
+                        frame.ip = ip
+                        self.runtimeError("Operand must be a number.")
+                        return INTERPRET.RUNTIME_ERROR
+                    stack[-1] = -stack[-1]
+                case OP.PRINT:
+                    print(stringify(stack.pop()), file=stdout)
+                case OP.GET_SUPER:
+                    superclass = stack.pop()
+                    frame.ip = ip
+                    if not self.bindMethod(superclass, instruction[1]):
+                        return INTERPRET.RUNTIME_ERROR
+                case OP.SUPER_INVOKE:
+                    superclass = stack.pop()
+                    frame.ip = ip
+                    if not self.invokeFromClass(superclass, instruction[1], instruction[2]):
+                        return INTERPRET.RUNTIME_ERROR
+                    frame = self.frames[-1]
+                    code, caches = self.unboxedCode(frame.closure.function.chunk)
+                    ip = frame.ip
+                    slots = frame.slots
+                # The callee takes over the frame, restarting it at ip 0, or
+                # leaves it where it was if it isn't a function.
+                case OP.TAIL_CALL:
+                    argCount = instruction[1]
+                    frame.ip = ip
+                    if not self.callValue(stack[-1 - argCount], argCount, True):
+                        return INTERPRET.RUNTIME_ERROR
+                    code, caches = self.unboxedCode(frame.closure.function.chunk)
+                    ip = frame.ip
+                case OP.TAIL_INVOKE:
+                    name, argCount = instruction[1], instruction[2]
+                    instance = stack[-argCount - 1]
+                    index = ip - 1
+                    cache = caches[index]
+                    frame.ip = ip
+                    if (cache is not None and type(instance) is ObjInstance and
+                            cache[0] is instance.shape):
+                        if not self.call(cache[1], argCount, True):
+                            return INTERPRET.RUNTIME_ERROR
+                    else:
+                        if not self.invoke(name, argCount, True):
+                            return INTERPRET.RUNTIME_ERROR
+                        if type(instance) is ObjInstance and name not in instance.shape.slots:
+                            self.cacheMethod(caches, index, instance, name)
+                    code, caches = self.unboxedCode(frame.closure.function.chunk)
+                    ip = frame.ip
+                case OP.CLOSURE:
+                    closure = ObjClosure(instruction[1])
+                    stack.append(closure)
+                    for i, (isLocal, index) in enumerate(instruction[2]):
+                        if isLocal:
+                            closure.upvalues[i] = stack[slots + index]
+                        else:
+                            closure.upvalues[i] = frame.closure.upvalues[index]
+                case OP.BOX:
+                    slot = slots + instruction[1]
+                    stack[slot] = ObjCell(stack[slot])
+                case OP.CLASS:
+                    stack.append(ObjClass(instruction[1]))
+                case OP.INHERIT:
+                    superclass = stack[-2]
+                    if type(superclass) is not ObjClass:
+                        frame.ip = ip
+                        self.runtimeError("Superclass must be a class.")
+                        return INTERPRET.RUNTIME_ERROR
+
+                    subclass = stack.pop()
+                    subclass.methods.update(superclass.methods)
+                    self.invalidateCaches(subclass)
+                case OP.METHOD:
+                    self.defineMethod(instruction[1])
+                    self.invalidateCaches(stack[-1])
+
+    def callValue(self, callee, argCount: int, tail: bool=False):
+        kind = type(callee)
+        if kind is ObjBoundMethod:
+            self.stack[-argCount - 1] = callee.reciever
+            return self.call(callee.method, argCount, tail)
+        if kind is ObjClass:
+            self.stack[-argCount - 1] = ObjInstance(callee)
+            if self.initString in callee.methods:
+                return self.call(callee.methods[self.initString], argCount, tail)
+            elif argCount != 0:
+                self.runtimeError(f"Expected 0 arguments but got {argCount}.")
+                return False
+            return True
+        if kind is ObjClosure:
+            return self.call(callee, argCount, tail)
+        if kind is ObjNative:
+            result = callee.function(argCount, len(self.stack) - argCount)
+            del self.stack[-argCount - 1:]
+            self.stack.append(unbox(result))
+            return True
+        self.runtimeError("Can only call functions and classes.")
+        return False
+
+    def defineNative(self, name: str, function: FunctionType):
+        self.globals[self.compiler.globalSlot(name)] = ObjNative(function)
+
+    def defineMethod(self, name: str):
+        method = self.stack.pop()
+        self.stack[-1].methods[name] = method
+
+    def methodClosure(self, klass: ObjClass, name: str):
+        return klass.methods[name]
+
+    def bindMethod(self, klass: ObjClass, name: str):
+        if name not in klass.methods:
+            self.runtimeError(f"Undefined property '{name}'.")
+            return False
+
+        # Passing the receiver to the constructor would take its Obj
+        # copy-constructor path, so it is set afterwards.
+        bound = ObjBoundMethod(None, klass.methods[name])
+        bound.reciever = self.stack[-1]
+        self.stack[-1] = bound
+        return True
+
+    def invoke(self, name: str, argCount: int, tail: bool=False):
+        reciever = self.stack[-argCount-1]
+
+        if type(reciever) is not ObjInstance:
+            self.runtimeError("Only instances have methods.")
+            return False
+
+        value = reciever.field(name)
+        if value is not None:
+            self.stack[-argCount-1] = value
+            return self.callValue(value, argCount, tail)
+
+        return self.invokeFromClass(reciever.klass, name, argCount, tail)
+
+    def invokeFromClass(self, klass: ObjClass, name: str, argCount: int, tail: bool=False):
+        if name not in klass.methods:
+            self.runtimeError(f"Undefined property '{name}'.")
+            return False
+        return self.call(klass.methods[name], argCount, tail)
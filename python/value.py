@@ -8,6 +8,8 @@ class VAL(enum):
     OBJ = enum_auto()
 
 class Value:
+    __slots__ = ("type", "as_")
+
     def __init__(self, type_: VAL, value: bool|float|Obj):
         self.type = type_
         self.as_ = value
@@ -118,6 +120,28 @@ class Value:
     def from_obj(value: Obj):
         return Value(VAL.OBJ, value)
 
+# Held by a global variable's slot until its definition runs. It is never
+# pushed, so engines only ever compare slots against it with `is`.
+UNDEFINED = Value.nil()
+
+def isFalsey(value: Value):
+    return value.is_nil() or (value.is_bool() and not bool(value))
+
+# Lox's >= and <= are `not <` and `not >`, which differ from Python's >=
+# and <= when a NaN is involved.
+def ge(a, b):
+    return not a < b
+
+def le(a, b):
+    return not a > b
+
+def div(a, b):
+    if b == 0:
+        if a == 0:
+            return float("nan")
+        return a * float("inf")
+    return a/b
+
 #class ValueArray(list):pass
 
 #class ValueArray:
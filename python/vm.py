@@ -1,10 +1,4 @@
 from operator import add, sub, mul, gt, lt
-def div(a, b):
-    if b == 0:
-        if a == 0:
-            return float("nan")
-        return a * float("inf")
-    return a/b
 import time
 from types import FunctionType
 
@@ -16,9 +10,10 @@ from object import *
 from value import *
 
 FRAMES_MAX = 64
-STACK_MAX = FRAMES_MAX + UINT8_COUNT
 
 class CallFrame:
+    __slots__ = ("closure", "ip", "slots")
+
     def __init__(self, closure: ObjClosure, slots: int):
         self.closure = closure
         self.ip = 0
@@ -29,25 +24,46 @@ class INTERPRET(enum):
     COMPILE_ERROR = enum_auto()
     RUNTIME_ERROR = enum_auto()
 
-def isFalsey(value: Value):
-    return value.is_nil() or (value.is_bool() and not bool(value))
-
 def clockNative(argCount: int, args: list[Value]):
     return Value.from_float(time.time())
 
 class VM:
-    def __init__(self, compiler: Compiler=None):
+    # Whether run() executes the superinstructions Chunk.fuse() left in
+    # the bytecode. Engines that build their own code from the plain
+    # instructions turn it off, and instructionLine() follows suit.
+    superinstructions = True
+
+    def __init__(self, compiler: Compiler=None, framesMax: int=FRAMES_MAX):
         self.frames = []
-        self.openUpvalues = None
+        # The call depth that is a stack overflow, and one CallFrame for each
+        # depth reached so far, which every later call to that depth reuses.
+        self.framesMax = framesMax
+        self.framePool = []
+        # The value stack slots the frames may fill between them, as in
+        # clox's STACK_MAX. A frame's region reaches its function's
+        # maxStack slots past its base, and has to fit below this.
+        self.stackMax = framesMax * UINT8_COUNT
 
         self.stack: list[Value] = []
-        self.globals = {}
 
         self.compiler = compiler
         if compiler is None:
             self.compiler = Compiler(TYPE.SCRIPT)
-
-        self.initString = "init"
+        # Global variables live in the slots the compiler hands out.
+        self.globals = self.compiler.globalValues
+        # Interned strings, shared with the compiler so literals and
+        # identifiers are the same objects the VM makes at runtime.
+        self.strings = self.compiler.strings
+        # Chunk -> (its DecodedChunk, inline caches); see cachesFor().
+        self.inlineCaches = {}
+        # id() of a class -> the inline cache entries holding its methods,
+        # as {(id(caches), index): caches}. An entry keeps its class alive,
+        # so the ids stay its own while it is listed here.
+        self.cacheSites = {}
+        # A BytecodeCache for compile() to go through, if any.
+        self.cache = None
+
+        self.initString = copyString(self.strings, "init").as_
 
         self.defineNative("clock", clockNative)
 
@@ -56,8 +72,7 @@ class VM:
 
         for frame in reversed(self.frames):
             function = frame.closure.function
-            instruction = frame.ip - 1
-            print(f"[line {function.chunk.lines[instruction]}] in ",
+            print(f"[line {self.instructionLine(frame)}] in ",
                   file=stderr,end="")
             if function.name is None:
                 print("script",file=stderr)
@@ -66,14 +81,25 @@ class VM:
         self.stack.clear()
         self.frames.clear()
 
+    def instructionLine(self, frame: CallFrame):
+        """Source line of the instruction the frame last executed."""
+        return frame.closure.function.chunk.decode(self.superinstructions).lines[frame.ip - 1]
+
     def resetFromBruh(self):
         self.stack.clear()
         self.frames.clear()
 
+    def compile(self, source: str):
+        if self.cache is None: return self.compiler.compile(source)
+        return self.cache.compile(self.compiler, source)
+
     def interpret(self, source: str):
-        function = self.compiler.compile(source)
+        function = self.compile(source)
         if function is None: return INTERPRET.COMPILE_ERROR
+        return self.execute(function)
 
+    def execute(self, function: ObjFunction):
+        """Run a compiled script function to the end."""
         closure = ObjClosure(function)
         self.stack.append(Value.from_obj(closure))
         self.call(closure, 0)
@@ -82,16 +108,6 @@ class VM:
         self.resetFromBruh()
         return result
 
-    def READ_BYTE(self):
-        self.frames[-1].ip+=1
-        return self.frames[-1].closure.function.chunk.code[self.frames[-1].ip-1]
-    def READ_SHORT(self):
-        a = self.READ_BYTE()
-        b = self.READ_BYTE()
-        return (a<<8)|b
-    def READ_CONSTANT(self):
-        return self.frames[-1].closure.function.chunk.constants[self.READ_BYTE()]
-    def READ_STRING(self):return self.READ_CONSTANT().as_str()
     def BINARY_OP(self, valueType, op):
         if not (self.stack[-1].is_number() and self.peek(1).is_number()):
             self.runtimeError("Operands must be numbers.")
@@ -100,8 +116,20 @@ class VM:
         a = float(self.stack.pop())
         self.stack.append(valueType(op(a, b)))
 
-    def run(self):
+    def add(self, a: Value, b: Value):
+        """OP.ADD of two values, or None after reporting the error."""
+        if a.is_string() and b.is_string():
+            return Value.from_obj(copyString(self.strings, a.as_str() + b.as_str()))
+        if a.is_number() and b.is_number():
+            return Value.from_float(float(a) + float(b))
+        self.runtimeError("Operands must be two numbers or two strings.")
+        return None
+
+    def run(self, exitDepth: int=0):
         frame = self.frames[-1]
+        decoded = frame.closure.function.chunk.decode(self.superinstructions)
+        code = decoded.code
+        caches = self.cachesFor(frame.closure.function.chunk, decoded)
 
         while True:
             if DEBUG_TRACE_EXECUTION:
@@ -109,78 +137,129 @@ class VM:
                 for slot in self.stack:
                     print("[ %s ]"%slot, end="", file=stdout)
                 print(file=stdout)
-                disassembleInstruction(frame.closure.function.chunk, frame.ip)
-            instruction = self.READ_BYTE()
-            match instruction:
-                case OP.CONSTANT:
-                    constant = self.READ_CONSTANT()
-                    self.stack.append(constant)
+                chunk = frame.closure.function.chunk
+                disassembleInstruction(chunk, chunk.decode(self.superinstructions).offsets[frame.ip])
+            instruction = code[frame.ip]
+            frame.ip += 1
+            match instruction[0]:
+                case OP.CONSTANT: self.stack.append(instruction[1])
+                case OP.CONSTANT_ADD:
+                    a = self.stack[-1]
+                    b = instruction[1]
+                    if a.is_number() and b.is_number():
+                        self.stack[-1] = Value.from_float(a.as_ + b.as_)
+                    elif (result := self.add(a, b)) is not None:
+                        self.stack[-1] = result
+                    else:
+                        return INTERPRET.RUNTIME_ERROR
+
                 case OP.NIL: self.stack.append(Value.nil())
                 case OP.TRUE: self.stack.append(Value.from_bool(True))
                 case OP.FALSE: self.stack.append(Value.from_bool(False))
                 case OP.POP: self.stack.pop()
-                case OP.GET_LOCAL: self.stack.append(self.stack[frame.slots+self.READ_BYTE()])
-                case OP.SET_LOCAL: self.stack[frame.slots+self.READ_BYTE()] = self.stack[-1]
+                case OP.POP_JUMP_IF_FALSE:
+                    if isFalsey(self.stack.pop()): frame.ip = instruction[1]
+                case OP.GET_LOCAL: self.stack.append(self.stack[frame.slots+instruction[1]])
+                case OP.GET_LOCAL_GET_PROPERTY:
+                    self.stack.append(self.stack[frame.slots + instruction[1]])
+                    if not self.stack[-1].is_instance():
+                        self.runtimeError("Only instances have properties.")
+                        return INTERPRET.RUNTIME_ERROR
+
+                    instance = self.stack[-1].as_instance()
+                    name = instruction[2]
+
+                    cache = caches[frame.ip - 1]
+                    if cache is not None and cache[0] is instance.shape:
+                        bound = ObjBoundMethod(self.stack[-1], cache[1])
+                        self.stack[-1] = Value.from_obj(bound)
+                        continue
+
+                    index = instance.shape.slots.get(name)
+                    if index is not None:
+                        self.stack[-1] = instance.values[index]
+                        continue
+
+                    if not self.bindMethod(instance.klass, name):
+                        return INTERPRET.RUNTIME_ERROR
+                    self.cacheMethod(caches, frame.ip - 1, instance, name)
+                case OP.GET_LOCAL_GET_LOCAL_ADD:
+                    a = self.stack[frame.slots + instruction[1]]
+                    b = self.stack[frame.slots + instruction[2]]
+                    if a.is_number() and b.is_number():
+                        self.stack.append(Value.from_float(a.as_ + b.as_))
+                    elif (result := self.add(a, b)) is not None:
+                        self.stack.append(result)
+                    else:
+                        return INTERPRET.RUNTIME_ERROR
+                case OP.GET_LOCAL_CONSTANT_LESS_POP_JUMP_IF_FALSE:
+                    a = self.stack[frame.slots + instruction[1]]
+                    b = instruction[2]
+                    if not (a.is_number() and b.is_number()):
+                        self.runtimeError("Operands must be numbers.")
+                        return INTERPRET.RUNTIME_ERROR
+                    if not a.as_ < b.as_: frame.ip = instruction[3]
+                case OP.SET_LOCAL: self.stack[frame.slots+instruction[1]] = self.stack[-1]
                 case OP.GET_GLOBAL:
-                    name = self.READ_STRING()
-                    if name not in self.globals:
-                        self.runtimeError(f"Undefined variable '{name}'.")
+                    value = self.globals[instruction[1]]
+                    if value is UNDEFINED:
+                        self.runtimeError(f"Undefined variable '{instruction[2]}'.")
                         return INTERPRET.RUNTIME_ERROR
-                    self.stack.append(self.globals[name])
+                    self.stack.append(value)
                 case OP.DEFINE_GLOBAL:
-                    name = self.READ_STRING()
-                    self.globals[name] = self.stack[-1]
+                    self.globals[instruction[1]] = self.stack[-1]
                     self.stack.pop()
                 case OP.SET_GLOBAL:
-                    name = self.READ_STRING()
-                    if name not in self.globals:
-                        self.runtimeError(f"Undefined variable '{name}'.")
+                    if self.globals[instruction[1]] is UNDEFINED:
+                        self.runtimeError(f"Undefined variable '{instruction[2]}'.")
                         return INTERPRET.RUNTIME_ERROR
-                    self.globals[name] = self.stack[-1]
+                    self.globals[instruction[1]] = self.stack[-1]
                 case OP.GET_UPVALUE:
-                    #slot = READ_BYTE()
-                    upvalue = frame.closure.upvalues[self.READ_BYTE()]
-                    if upvalue.location is None:
-                        self.stack.append(upvalue.closed)
-                    else:
-                        self.stack.append(self.stack[upvalue.location])
-                case OP.SET_UPVALUE:
-                    #slot = READ_BYTE()
-                    upvalue = frame.closure.upvalues[self.READ_BYTE()]
-                    if upvalue.location is None:
-                        upvalue.closed = self.stack[-1]
-                    else:
-                        self.stack[upvalue.location] = self.stack[-1]
+                    self.stack.append(frame.closure.upvalues[instruction[1]])
+                case OP.GET_CELL:
+                    self.stack.append(frame.closure.upvalues[instruction[1]].value)
+                case OP.SET_CELL:
+                    frame.closure.upvalues[instruction[1]].value = self.stack[-1]
+                case OP.GET_LOCAL_CELL:
+                    self.stack.append(self.stack[frame.slots + instruction[1]].value)
+                case OP.SET_LOCAL_CELL:
+                    self.stack[frame.slots + instruction[1]].value = self.stack[-1]
                 case OP.GET_PROPERTY:
                     if not self.stack[-1].is_instance():
                         self.runtimeError("Only instances have properties.")
                         return INTERPRET.RUNTIME_ERROR
 
                     instance = self.stack[-1].as_instance()
-                    name = self.READ_STRING()
+                    name = instruction[1]
 
-                    if name in instance.fields:
-                        self.stack.pop()
-                        self.stack.append(instance.fields[name])
+                    cache = caches[frame.ip - 1]
+                    if cache is not None and cache[0] is instance.shape:
+                        bound = ObjBoundMethod(self.stack[-1], cache[1])
+                        self.stack[-1] = Value.from_obj(bound)
+                        continue
+
+                    index = instance.shape.slots.get(name)
+                    if index is not None:
+                        self.stack[-1] = instance.values[index]
                         continue
 
                     if not self.bindMethod(instance.klass, name):
                         return INTERPRET.RUNTIME_ERROR
+                    self.cacheMethod(caches, frame.ip - 1, instance, name)
                 case OP.SET_PROPERTY:
                     if not self.peek(1).is_instance():
                         self.runtimeError("Only instances have fields.")
                         return INTERPRET.RUNTIME_ERROR
 
                     instance = self.peek(1).as_instance()
-                    instance.fields[self.READ_STRING()] = self.stack[-1]
+                    instance.setField(instruction[1], self.stack[-1])
                     value = self.stack.pop()
                     self.stack.pop()
                     self.stack.append(value)
                 case OP.GET_SUPER:
-                    name = self.READ_STRING()
                     superclass = self.stack.pop().as_class()
 
-                    if not self.bindMethod(superclass, name):
+                    if not self.bindMethod(superclass, instruction[1]):
                         return INTERPRET.RUNTIME_ERROR
                 case OP.EQUAL:
                     b = self.stack.pop()
@@ -194,7 +273,7 @@ class VM:
                     if self.stack[-1].is_string() and self.peek(1).is_string():
                         b = self.stack.pop().as_str()
                         a = self.stack.pop().as_str()
-                        self.stack.append(Value.from_obj(ObjString(a + b)))
+                        self.stack.append(Value.from_obj(copyString(self.strings, a + b)))
                     elif self.stack[-1].is_number() and self.peek(1).is_number():
                         b = float(self.stack.pop())
                         a = float(self.stack.pop())
@@ -219,60 +298,71 @@ class VM:
                 case OP.PRINT:
                     print(self.stack.pop(), file=stdout)
                 case OP.JUMP:
-                    offset = self.READ_SHORT()
-                    frame.ip += offset
+                    frame.ip = instruction[1]
                 case OP.JUMP_IF_FALSE:
-                    offset = self.READ_SHORT()
-                    if isFalsey(self.stack[-1]): frame.ip += offset
+                    if isFalsey(self.stack[-1]): frame.ip = instruction[1]
                 case OP.LOOP:
-                    offset = self.READ_SHORT()
-                    frame.ip -= offset
+                    frame.ip = instruction[1]
                 case OP.CALL:
-                    argCount = self.READ_BYTE()
+                    argCount = instruction[1]
                     if not self.callValue(self.peek(argCount), argCount):
                         return INTERPRET.RUNTIME_ERROR
                     frame = self.frames[-1]
+                    decoded = frame.closure.function.chunk.decode(self.superinstructions)
+                    code = decoded.code
+                    caches = self.cachesFor(frame.closure.function.chunk, decoded)
                 case OP.INVOKE:
-                    method = self.READ_STRING()
-                    argCount = self.READ_BYTE()
-                    if not self.invoke(method, argCount):
-                        return INTERPRET.RUNTIME_ERROR
+                    name, argCount = instruction[1], instruction[2]
+                    instance = self.stack[-argCount - 1].as_
+                    cache = caches[frame.ip - 1]
+                    if (cache is not None and type(instance) is ObjInstance and
+                            cache[0] is instance.shape):
+                        if not self.call(cache[1], argCount):
+                            return INTERPRET.RUNTIME_ERROR
+                    else:
+                        if not self.invoke(name, argCount):
+                            return INTERPRET.RUNTIME_ERROR
+                        if type(instance) is ObjInstance and name not in instance.shape.slots:
+                            self.cacheMethod(caches, frame.ip - 1, instance, name)
                     frame = self.frames[-1]
+                    decoded = frame.closure.function.chunk.decode(self.superinstructions)
+                    code = decoded.code
+                    caches = self.cachesFor(frame.closure.function.chunk, decoded)
                 case OP.SUPER_INVOKE:
-                    method = self.READ_STRING()
-                    argCount = self.READ_BYTE()
                     superclass = self.stack.pop().as_class()
-                    if not self.invokeFromClass(superclass, method, argCount):
+                    if not self.invokeFromClass(superclass, instruction[1], instruction[2]):
                         return INTERPRET.RUNTIME_ERROR
                     frame = self.frames[-1]
+                    decoded = frame.closure.function.chunk.decode(self.superinstructions)
+                    code = decoded.code
+                    caches = self.cachesFor(frame.closure.function.chunk, decoded)
                 case OP.CLOSURE:
-                    function = self.READ_CONSTANT().as_function()
-                    closure = ObjClosure(function)
+                    closure = ObjClosure(instruction[1])
                     self.stack.append(Value.from_obj(closure))
-                    for i in range(len(closure.upvalues)):
-                        isLocal = self.READ_BYTE()
-                        index = self.READ_BYTE()
+                    for i, (isLocal, index) in enumerate(instruction[2]):
                         if isLocal:
-                            closure.upvalues[i] = self.captureUpvalue(frame.slots + index)
+                            closure.upvalues[i] = self.stack[frame.slots + index]
                         else:
                             closure.upvalues[i] = frame.closure.upvalues[index]
-                case OP.CLOSE_UPVALUE:
-                    self.closeUpvalues(len(self.stack) - 1)
-                    self.stack.pop()
+                case OP.BOX:
+                    slot = frame.slots + instruction[1]
+                    self.stack[slot] = ObjCell(self.stack[slot])
                 case OP.RETURN:
                     result = self.stack.pop()
-                    self.closeUpvalues(frame.slots)
                     self.frames.pop()
                     if len(self.frames) == 0:
                         self.stack.pop()
                         return INTERPRET.OK
 
-                    for i in range(len(self.stack)-frame.slots):
-                        self.stack.pop()
+                    del self.stack[frame.slots:]
                     self.stack.append(result)
+                    if len(self.frames) == exitDepth: return INTERPRET.OK
                     frame = self.frames[-1]
+                    decoded = frame.closure.function.chunk.decode(self.superinstructions)
+                    code = decoded.code
+                    caches = self.cachesFor(frame.closure.function.chunk, decoded)
                 case OP.CLASS:
-                    self.stack.append(Value.from_obj(ObjClass(self.READ_STRING())))
+                    self.stack.append(Value.from_obj(ObjClass(instruction[1])))
                 case OP.INHERIT:
                     superclass = self.peek(1)
                     if not superclass.is_class():
@@ -282,33 +372,118 @@ class VM:
                     subclass = self.stack[-1].as_class()
                     subclass.methods.update(superclass.as_class().methods)
                     self.stack.pop() # Subclass.
+                    self.invalidateCaches(subclass)
                 case OP.METHOD:
-                    self.defineMethod(self.READ_STRING())
+                    self.defineMethod(instruction[1])
+                    self.invalidateCaches(self.stack[-1].as_class())
+                # Written by Chunk.optimize(). They come last so as not to
+                # add a comparison to the dispatch of anything above.
+                case OP.NOT_EQUAL:
+                    b = self.stack.pop()
+                    a = self.stack.pop()
+                    self.stack.append(Value.from_bool(not a == b))
+                case OP.GREATER_EQUAL:
+                    if(a:=self.BINARY_OP(Value.from_bool,ge))is not None:return a
+                case OP.LESS_EQUAL:
+                    if(a:=self.BINARY_OP(Value.from_bool,le))is not None:return a
+                case OP.JUMP_IF_TRUE:
+                    if not isFalsey(self.stack[-1]): frame.ip = instruction[1]
+                # Written by Compiler.tailCall(). The callee takes over the
+                # frame, so only the code needs reloading.
+                case OP.TAIL_CALL:
+                    argCount = instruction[1]
+                    if not self.callValue(self.peek(argCount), argCount, True):
+                        return INTERPRET.RUNTIME_ERROR
+                    decoded = frame.closure.function.chunk.decode(self.superinstructions)
+                    code = decoded.code
+                    caches = self.cachesFor(frame.closure.function.chunk, decoded)
+                case OP.TAIL_INVOKE:
+                    name, argCount = instruction[1], instruction[2]
+                    instance = self.stack[-argCount - 1].as_
+                    index = frame.ip - 1
+                    cache = caches[index]
+                    if (cache is not None and type(instance) is ObjInstance and
+                            cache[0] is instance.shape):
+                        if not self.call(cache[1], argCount, True):
+                            return INTERPRET.RUNTIME_ERROR
+                    else:
+                        if not self.invoke(name, argCount, True):
+                            return INTERPRET.RUNTIME_ERROR
+                        if type(instance) is ObjInstance and name not in instance.shape.slots:
+                            self.cacheMethod(caches, index, instance, name)
+                    decoded = frame.closure.function.chunk.decode(self.superinstructions)
+                    code = decoded.code
+                    caches = self.cachesFor(frame.closure.function.chunk, decoded)
+
+    def cachesFor(self, chunk: Chunk, decoded: DecodedChunk):
+        """The inline cache side table for a chunk's decoded code: one
+        entry per instruction, None until a GET_PROPERTY or INVOKE there
+        resolves a method, then the receiver's shape, the method closure
+        it found and the receiver's class. The shape stands for both the
+        class and the absence of a field shadowing the method."""
+        cached = self.inlineCaches.get(chunk)
+        if cached is None or cached[0] is not decoded:
+            # The REPL recompiles into the same script chunk, so a table is
+            # only kept while the chunk's decoded form is.
+            if cached is not None:
+                for index in range(len(cached[1])):
+                    self.uncacheMethod(cached[1], index)
+            cached = (decoded, [None] * len(decoded.code))
+            self.inlineCaches[chunk] = cached
+        return cached[1]
+
+    def cacheMethod(self, caches: list, index: int, instance: ObjInstance, name: str):
+        """Fill in an inline cache entry, and note where it is under the
+        receiver's class for invalidateCaches()."""
+        self.uncacheMethod(caches, index)
+        klass = instance.klass
+        caches[index] = (instance.shape, self.methodClosure(klass, name), klass)
+        self.cacheSites.setdefault(id(klass), {})[(id(caches), index)] = caches
+
+    def uncacheMethod(self, caches: list, index: int):
+        """Empty an inline cache entry, if it is filled in."""
+        old = caches[index]
+        if old is None: return
+        caches[index] = None
+        sites = self.cacheSites[id(old[2])]
+        del sites[(id(caches), index)]
+        if not sites: del self.cacheSites[id(old[2])]
+
+    def methodClosure(self, klass: ObjClass, name: str):
+        return klass.methods[name].as_closure()
+
+    def invalidateCaches(self, klass: ObjClass):
+        """Empty the entries cached for klass, whose methods changed. The
+        entries for every other class stay as they are."""
+        # Emptied in place, since run() loops further up the Python stack
+        # hold on to the lists.
+        for (_, index), caches in self.cacheSites.pop(id(klass), {}).items():
+            caches[index] = None
 
     def peek(self, distance: int):
         return self.stack[-1 - distance]
 
-    def callValue(self, callee: Value, argCount: int):
+    def callValue(self, callee: Value, argCount: int, tail: bool=False):
         if callee.is_obj():
             match callee.obj_type():
                 case OBJ.BOUND_METHOD:
                     bound = callee.as_bound_method()
                     self.stack[-argCount - 1] = bound.reciever
-                    return self.call(bound.method, argCount)
+                    return self.call(bound.method, argCount, tail)
                 case OBJ.CLASS:
                     klass = callee.as_class()
                     self.stack[-argCount - 1] = Value.from_obj(ObjInstance(klass))
                     if self.initString in klass.methods:
-                        return self.call(klass.methods[self.initString].as_closure(), argCount)
+                        return self.call(klass.methods[self.initString].as_closure(), argCount, tail)
                     elif argCount != 0:
                         self.runtimeError(f"Expected 0 arguments but got {argCount}.")
                         return False
                     return True
                 case OBJ.CLOSURE:
-                    return self.call(callee.as_closure(), argCount)
+                    return self.call(callee.as_closure(), argCount, tail)
                 case OBJ.NATIVE:
                     result = callee.as_native()(argCount, len(self.stack) - argCount)
-                    for i in range(argCount + 1): self.stack.pop()
+                    del self.stack[-argCount - 1:]
                     self.stack.append(result)
                     return True
                 case _: # Non-callable object type.
@@ -316,48 +491,49 @@ class VM:
         self.runtimeError("Can only call functions and classes.")
         return False
 
-    def call(self, closure: ObjClosure, argCount: int):
+    def call(self, closure: ObjClosure, argCount: int, tail: bool=False):
+        """Start a call to the closure. A tail call hands the caller's frame
+        and stack window over to the callee, restarting the frame at ip 0,
+        where any other call pushes a new frame."""
         if argCount != closure.function.arity:
             self.runtimeError(f"Expected {closure.function.arity} arguments but got {argCount}.")
             return False
 
-        if len(self.frames) == FRAMES_MAX:
+        if tail:
+            frame = self.frames[-1]
+            if frame.slots + closure.function.maxStack > self.stackMax:
+                self.runtimeError("Stack overflow.")
+                return False
+            del self.stack[frame.slots:-argCount - 1]
+            frame.closure = closure
+            frame.ip = 0
+            return True
+
+        return self.pushFrame(closure, argCount)
+
+    def pushFrame(self, closure: ObjClosure, argCount: int, slots: int=None):
+        """Push a frame for the closure, its window starting at slots: by
+        default the callee slot just under the arguments on top of the
+        stack."""
+        if slots is None: slots = len(self.stack)-argCount-1
+        depth = len(self.frames)
+        if depth == self.framesMax or slots + closure.function.maxStack > self.stackMax:
             self.runtimeError("Stack overflow.")
             return False # reutnr lmao
 
-        self.frames.append(CallFrame(closure, len(self.stack)-argCount-1))
+        if depth == len(self.framePool):
+            frame = CallFrame(closure, slots)
+            self.framePool.append(frame)
+        else:
+            frame = self.framePool[depth]
+            frame.closure = closure
+            frame.ip = 0
+            frame.slots = slots
+        self.frames.append(frame)
         return True
 
     def defineNative(self, name: str, function: FunctionType):
-        self.globals[name] = Value.from_obj(ObjNative(function))
-
-    def captureUpvalue(self, local: int):
-        prevUpvalue = None
-        upvalue = self.openUpvalues
-        while upvalue is not None and upvalue.location > local:
-            prevUpvalue = upvalue
-            upvalue = upvalue.next
-
-        if upvalue is not None and upvalue.location == local:
-            return upvalue
-
-        createdUpvalue = ObjUpvalue(local)
-        createdUpvalue.next = upvalue
-
-        if prevUpvalue is None:
-            self.openUpvalues = createdUpvalue
-        else:
-            prevUpvalue.next = createdUpvalue
-
-        return createdUpvalue
-
-    def closeUpvalues(self, last: int):
-        while (self.openUpvalues is not None and
-               self.openUpvalues.location >= last):
-            upvalue = self.openUpvalues
-            upvalue.closed = self.stack[upvalue.location]
-            upvalue.location = None
-            self.openUpvalues = upvalue.next
+        self.globals[self.compiler.globalSlot(name)] = Value.from_obj(ObjNative(function))
 
     def defineMethod(self, name: ObjString):
         method = self.stack[-1]
@@ -370,12 +546,11 @@ class VM:
             self.runtimeError(f"Undefined property '{name}'.")
             return False
 
-        bound = ObjBoundMethod(self.stack[-1], ObjClosure(klass.methods[name].as_closure()))
-        self.stack.pop()
-        self.stack.append(Value.from_obj(bound))
+        bound = ObjBoundMethod(self.stack[-1], klass.methods[name].as_closure())
+        self.stack[-1] = Value.from_obj(bound)
         return True
 
-    def invoke(self, name: ObjString, argCount: int):
+    def invoke(self, name: ObjString, argCount: int, tail: bool=False):
         reciever = self.stack[-argCount-1]
 
         if not reciever.is_instance():
@@ -384,15 +559,21 @@ class VM:
 
         instance = reciever.as_instance()
 
-        if name in instance.fields:
-            value = instance.fields[name]
+        value = instance.field(name)
+        if value is not None:
+            if value.is_bound_method():
+                # Straight to the method, without parking the bound method
+                # in the callee slot only for callValue() to replace it.
+                bound = value.as_bound_method()
+                self.stack[-argCount-1] = bound.reciever
+                return self.call(bound.method, argCount, tail)
             self.stack[-argCount-1] = value
-            return self.callValue(value, argCount)
+            return self.callValue(value, argCount, tail)
 
-        return self.invokeFromClass(instance.klass, name, argCount)
+        return self.invokeFromClass(instance.klass, name, argCount, tail)
 
-    def invokeFromClass(self, klass: ObjClass, name: ObjString, argCount: int):
+    def invokeFromClass(self, klass: ObjClass, name: ObjString, argCount: int, tail: bool=False):
         if name not in klass.methods:
             self.runtimeError(f"Undefined property '{name}'.")
             return False
-        return self.call(klass.methods[name].as_closure(), argCount)
+        return self.call(klass.methods[name].as_closure(), argCount, tail)